@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Benchmark classifying crawled entities against the local snapshot
+
+Loads a synthetic tracking snapshot into a `state.Snapshot`, then runs a
+crawl of the same entities with a fixed churn rate through
+`pipeline.classify` and `pipeline.iter_changes`, the stages a monitoring
+run executes, and times both.  The md5s of new and updated files are
+looked up from a fake Synapse without latency.  Time per entity should
+stay roughly constant as the number of entities grows.
+"""
+import argparse
+import tempfile
+import time
+
+from synapsemonitor import crawler, pipeline, state
+
+from fake_synapse import FakeSynapse
+
+# Files whose fingerprint did not change keep their tracked md5 when
+# there is a watermark
+WATERMARK = 0
+
+
+def synthetic_project(size, churn=0.01):
+    """Builds a fake project of `size` tracked files where `churn` of the
+    files are new, updated and deleted
+
+    Returns:
+        tuple - FakeSynapse, function yielding the TrackedRow of each
+                tracked file, function yielding the crawled headers
+    """
+    changed = int(size * churn)
+    syn = FakeSynapse(depth=0, files_per_folder=size + changed)
+
+    def header(index):
+        return dict(syn._header(syn._file_id(0, index)),
+                    parentId=syn.projectid)
+
+    def iter_tracked():
+        for index in range(size):
+            tracked = header(index)
+            yield state.TrackedRow(
+                tracked['id'], f"md5-{tracked['id']}", tracked['name'],
+                crawler.entity_date_to_timestamp(tracked['modifiedOn']),
+                crawler.get_fingerprint(tracked), syn.projectid,
+                row_id=index + 1, row_version=1
+            )
+
+    def iter_crawled():
+        # The first `changed` files are deleted, the next `changed` are
+        # updated and the last `changed` are new
+        for index in range(changed, size + changed):
+            crawled = header(index)
+            if index < changed * 2:
+                crawled['versionNumber'] += 1
+            yield crawled
+
+    return syn, iter_tracked, iter_crawled
+
+
+def build_parser():
+    """Set up argument parser and returns"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+',
+        default=[1000, 10000, 100000, 1000000],
+        help='Number of synthetic entities to classify'
+    )
+    return parser
+
+
+def main():
+    """Invoke"""
+    args = build_parser().parse_args()
+    print(f"{'entities':>10} {'load s':>10} {'classify s':>10} "
+          f"{'us/entity':>10}")
+    for size in args.sizes:
+        syn, iter_tracked, iter_crawled = synthetic_project(size)
+        with tempfile.TemporaryDirectory() as state_dir, \
+                state.Snapshot(syn.projectid, state_dir) as snapshot:
+            start = time.perf_counter()
+            snapshot.replace(iter_tracked())
+            snapshot.commit()
+            loaded = time.perf_counter() - start
+            report = pipeline.Report(("New", "Updated", "Deleted"))
+            start = time.perf_counter()
+            rows = sum(1 for _ in pipeline.iter_changes(
+                pipeline.classify(syn, iter_crawled(), snapshot,
+                                  watermark=WATERMARK),
+                snapshot, report
+            ))
+            elapsed = time.perf_counter() - start
+        changed = int(size * 0.01)
+        assert rows == changed * 3, rows
+        assert all(report.counts[status] == changed
+                   for status in ("New", "Updated", "Deleted")), \
+            report.counts
+        assert report.counts["Existing"] == size - changed * 2, report.counts
+        print(f"{size:>10} {loaded:>10.3f} {elapsed:>10.3f} "
+              f"{elapsed / size * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
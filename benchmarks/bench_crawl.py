@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Benchmark crawl throughput against the crawl concurrency
+
+Crawls a synthetic project with injected request latency and reports
+entities listed per second for each number of workers.
+"""
+import argparse
+import time
+
+from synapsemonitor import crawler
+
+from fake_synapse import FakeSynapse
+
+
+def build_parser():
+    """Set up argument parser and returns"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32],
+                        help='Crawl concurrency levels')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Folder levels below the project')
+    parser.add_argument('--fanout', type=int, default=5,
+                        help='Sub folders per folder')
+    parser.add_argument('--files-per-folder', type=int, default=20,
+                        help='Files per folder')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds each request takes')
+    return parser
+
+
+def main():
+    """Invoke"""
+    args = build_parser().parse_args()
+    syn = FakeSynapse(depth=args.depth, fanout=args.fanout,
+                      files_per_folder=args.files_per_folder,
+                      latency=args.latency)
+    print(f"{'workers':>8} {'entities':>10} {'seconds':>10} "
+          f"{'entities/s':>12}")
+    for workers in args.workers:
+        start = time.perf_counter()
+        count = sum(1 for _ in crawler.crawl(syn, syn.projectid,
+                                             max_workers=workers))
+        elapsed = time.perf_counter() - start
+        assert count == syn.num_files
+        print(f"{workers:>8} {count:>10} {elapsed:>10.3f} "
+              f"{count / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
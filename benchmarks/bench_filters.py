@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Benchmark entity filters evaluated during the crawl
+
+Monitors a synthetic project with and without excluding the subtree of
+some of its top-level folders and compares the requests of the runs, then
+times evaluating filter rules against synthetic entity headers.  Excluded
+folders are never listed, so the requests should drop with the excluded
+fraction of the project, and filtering should cost a few microseconds per
+entity.  Each run starts from a new state, so the rows tracked before the
+exclusion must be kept without the local state knowing the excluded
+folders.
+"""
+import argparse
+import contextlib
+import io
+import tempfile
+import time
+
+from synapsemonitor import filters, monitor
+
+from fake_synapse import FILE_TYPE, FakeSynapse
+
+RULES = {
+    'exclude': [{'path': 'scratch/**'}, {'name_regex': r'^\.'},
+                {'type': ['link', 'entityview']}],
+    'include': [{'path': '**/*.txt'}, {'name': '*.csv'}]
+}
+
+
+def run_monitor(syn, settings):
+    """Monitors the fake project once in a fresh state
+
+    Returns:
+        tuple - number of requests, number of tracked entities, number of
+                deleted entities
+    """
+    calls = syn.calls
+    with tempfile.TemporaryDirectory() as state_dir, \
+            contextlib.redirect_stdout(io.StringIO()):
+        _, report = monitor.monitor_project(syn, syn.projectid,
+                                            state_dir=state_dir,
+                                            filter_settings=settings)
+    return syn.calls - calls, report.total, report.counts["Deleted"]
+
+
+def build_parser():
+    """Set up argument parser and returns"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Folder levels below the project')
+    parser.add_argument('--fanout', type=int, default=5,
+                        help='Sub folders per folder')
+    parser.add_argument('--files-per-folder', type=int, default=20,
+                        help='Files per folder')
+    parser.add_argument('--excluded', type=int, default=3,
+                        help='Number of top-level folders excluded')
+    parser.add_argument('--headers', type=int, default=100000,
+                        help='Number of headers filtered')
+    return parser
+
+
+def main():
+    """Invoke"""
+    args = build_parser().parse_args()
+    syn = FakeSynapse(depth=args.depth, fanout=args.fanout,
+                      files_per_folder=args.files_per_folder)
+    folders = [f"folder{index}" for index in range(args.excluded)]
+    print(f"{'excluded':>9} {'requests':>9} {'entities':>9}")
+    results = []
+    for settings in (None, {'exclude': [{'path': f"{folder}/**"}
+                                        for folder in folders]}):
+        requests, entities, deleted = run_monitor(syn, settings)
+        assert not deleted, f"{deleted} excluded entities were deleted"
+        results.append((requests, entities))
+        print(f"{len(settings['exclude']) if settings else 0:>9} "
+              f"{requests:>9} {entities:>9}")
+    fraction = args.excluded / args.fanout
+    # The monitor's own requests do not depend on the project size
+    assert results[1][0] < results[0][0] * (1 - fraction / 2), results
+    assert results[1][1] < results[0][1] * (1 - fraction / 2), results
+
+    entity_filter = filters.EntityFilter.from_settings(RULES)
+    headers = []
+    for i in range(args.headers):
+        name = f"file{i}.{['csv', 'txt', 'bam'][i % 3]}"
+        headers.append({'id': f"syn{i}", 'name': name, 'type': FILE_TYPE,
+                        'path': f"folder{i % 7}/sub{i % 11}/{name}"})
+    start = time.perf_counter()
+    included = sum(1 for header in headers if entity_filter.includes(header))
+    elapsed = time.perf_counter() - start
+    print(f"{'headers':>9} {'included':>9} {'us/header':>9}")
+    print(f"{len(headers):>9} {included:>9} "
+          f"{elapsed / len(headers) * 1e6:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Benchmark the start-up time of the command line
+
+Measures the import time of the command line with `python -X importtime`,
+the wall time of `synapsemonitor --help` and the local overhead of a run
+that finds no changes, and checks that the heavy libraries are only
+imported by the commands that need them.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from synapsemonitor import monitor
+
+from fake_synapse import FakeSynapse
+
+# Modules that importing the command line must not load
+HEAVY_MODULES = ["pandas", "numpy", "synapsegenie", "synapseclient",
+                 "requests"]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run_python(args):
+    """Runs python from the repository root, returns (seconds, stderr)"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + args, cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    return time.perf_counter() - start, result.stderr
+
+
+def import_times(module):
+    """Imports a module in a fresh interpreter with -X importtime
+
+    Args:
+        module: Module imported
+
+    Returns:
+        dict - {module: cumulative import time in microseconds}
+    """
+    _, stderr = _run_python(["-X", "importtime", "-c", f"import {module}"])
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def no_change_run(entities_depth, files_per_folder):
+    """Seconds of a run that finds no changes, without request latency"""
+    syn = FakeSynapse(depth=entities_depth, files_per_folder=files_per_folder)
+    with tempfile.TemporaryDirectory() as state_dir:
+        monitor.monitor_project(syn, syn.projectid, state_dir=state_dir)
+        start = time.perf_counter()
+        _, report = monitor.monitor_project(syn, syn.projectid,
+                                            state_dir=state_dir)
+        elapsed = time.perf_counter() - start
+    assert not set(report.counts) - {"Existing"}, report.counts
+    return elapsed
+
+
+def build_parser():
+    """Set up argument parser and returns"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs of each measurement, the fastest counts')
+    parser.add_argument('--max-import-ms', type=float, default=150,
+                        help='Fail if importing the command line takes '
+                             'longer')
+    parser.add_argument('--max-help-ms', type=float, default=500,
+                        help='Fail if synapsemonitor --help takes longer')
+    parser.add_argument('--max-run-ms', type=float, default=1000,
+                        help='Fail if a run that finds no changes takes '
+                             'longer')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='Folder levels of the project of the run')
+    parser.add_argument('--files-per-folder', type=int, default=100,
+                        help='Files per folder of the project of the run')
+    return parser
+
+
+def main():
+    """Invoke"""
+    args = build_parser().parse_args()
+    runs = [import_times("synapsemonitor.__main__")
+            for _ in range(args.repeat)]
+    loaded = sorted(module for module in HEAVY_MODULES if module in runs[0])
+    import_ms = min(times["synapsemonitor.__main__"] for times in runs) / 1000
+    slowest = sorted(runs[0].items(), key=lambda item: -item[1])[:10]
+    print("Slowest imports (cumulative ms)")
+    for module, cumulative in slowest:
+        print(f"{cumulative / 1000:>10.1f} {module}")
+    help_ms = min(_run_python(["-m", "synapsemonitor", "--help"])[0]
+                  for _ in range(args.repeat)) * 1000
+    run_ms = min(no_change_run(args.depth, args.files_per_folder)
+                 for _ in range(args.repeat)) * 1000
+    print(f"{'import ms':>10} {'--help ms':>10} {'run ms':>10}")
+    print(f"{import_ms:>10.1f} {help_ms:>10.1f} {run_ms:>10.1f}")
+    assert not loaded, f"Importing the command line loads {loaded}"
+    assert import_ms <= args.max_import_ms, \
+        f"Import takes {import_ms:.1f} ms, over {args.max_import_ms} ms"
+    assert help_ms <= args.max_help_ms, \
+        f"--help takes {help_ms:.1f} ms, over {args.max_help_ms} ms"
+    assert run_ms <= args.max_run_ms, \
+        f"A run without changes takes {run_ms:.1f} ms, over " \
+        f"{args.max_run_ms} ms"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Benchmark peak memory of monitoring against the project size
+
+Monitors synthetic projects of growing size for the first time, which
+adds every entity to the tracking table, and reports the peak memory
+allocated by Python.  The peak should stay roughly flat as the number of
+entities grows.
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+
+from synapsemonitor import monitor
+
+from fake_synapse import FakeSynapse
+
+
+def build_parser():
+    """Set up argument parser and returns"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 2, 3, 4],
+                        help='Folder levels below the project, 4 levels '
+                             'is over a million entities')
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='Sub folders per folder')
+    parser.add_argument('--files-per-folder', type=int, default=100,
+                        help='Files per folder')
+    parser.add_argument('--max-peak-mb', type=float, default=100,
+                        help='Fail if the peak memory of the largest '
+                             'project exceeds this many MB')
+    return parser
+
+
+def main():
+    """Invoke"""
+    args = build_parser().parse_args()
+    print(f"{'entities':>10} {'seconds':>10} {'peak MB':>10}")
+    for depth in args.depths:
+        syn = FakeSynapse(depth=depth, fanout=args.fanout,
+                          files_per_folder=args.files_per_folder)
+        with tempfile.TemporaryDirectory() as state_dir:
+            tracemalloc.start()
+            start = time.perf_counter()
+            _, report = monitor.monitor_project(syn, syn.projectid,
+                                                state_dir=state_dir)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        assert report.total == syn.num_files
+        peak_mb = peak / 2 ** 20
+        print(f"{report.total:>10} {elapsed:>10.1f} {peak_mb:>10.1f}")
+    assert peak_mb <= args.max_peak_mb, \
+        f"Peak memory {peak_mb:.1f} MB exceeds {args.max_peak_mb} MB"
+
+
+if __name__ == "__main__":
+    main()
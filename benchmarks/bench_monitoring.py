@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Benchmark monitoring runs phase by phase against a fake Synapse
+
+Monitors a synthetic project once to track every entity, then again after
+each round of churn, and reports the time `monitor.monitoring` spent in
+each of its instrumented phases.  Results can be
+written as JSON so runs can be compared over time.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import tempfile
+from unittest import mock
+
+from synapsemonitor import metrics, monitor
+
+from fake_synapse import FakeSynapse
+
+# Phases of `synapsemonitor.metrics`, time outside of them is "other"
+PHASES = ["login", "setup", "sync", "crawl", "classify", "update", "notify",
+          "other"]
+
+
+def build_parser():
+    """Set up argument parser and returns"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Folder levels below the project')
+    parser.add_argument('--fanout', type=int, default=5,
+                        help='Sub folders per folder')
+    parser.add_argument('--files-per-folder', type=int, default=20,
+                        help='Files per folder')
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help='Fraction of files updated, deleted and added '
+                             'before each run after the first')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Number of runs after the first')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds each request takes')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Probability of a request failing')
+    parser.add_argument('--retry-delay', type=float, default=0.0,
+                        help='Seconds before a failed request is retried')
+    parser.add_argument('--crawl-workers', type=int,
+                        default=monitor.crawler.DEFAULT_WORKERS,
+                        help='Number of concurrent Synapse requests')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random errors and churn')
+    parser.add_argument('--output',
+                        help='Write the results to this JSON file')
+    return parser
+
+
+def run_monitoring(syn, state_dir, crawl_workers):
+    """Runs `monitor.monitoring` on the fake project and times its phases
+
+    Returns:
+        dict - run results
+    """
+    reports = []
+
+    def monitor_project(*args, **kwargs):
+        result = monitor_project.original(*args, **kwargs)
+        reports.append(result[1])
+        return result
+    monitor_project.original = monitor.monitor_project
+
+    calls, errors = syn.calls, syn.errors
+    metrics.METRICS.reset()
+    with mock.patch.object(monitor, "_login", lambda *args, **kwargs: syn), \
+            mock.patch.object(monitor, "monitor_project", monitor_project), \
+            contextlib.redirect_stdout(io.StringIO()):
+        monitor.monitoring(syn.projectid, state_dir=state_dir,
+                           crawl_workers=crawl_workers)
+    summary = metrics.METRICS.summary()
+    phases = {phase: summary['phases'].get(phase, 0.0)
+              for phase in PHASES[:-1]}
+    phases["other"] = summary['seconds'] - sum(phases.values())
+    report = reports[0]
+    return {
+        'entities': report.total,
+        'statuses': dict(report.counts),
+        'requests': syn.calls - calls,
+        'errors': syn.errors - errors,
+        'seconds': summary['seconds'],
+        'entities_per_second': summary['entities_per_second'],
+        'phases': phases
+    }
+
+
+def main():
+    """Invoke"""
+    args = build_parser().parse_args()
+    syn = FakeSynapse(depth=args.depth, fanout=args.fanout,
+                      files_per_folder=args.files_per_folder,
+                      latency=args.latency, error_rate=args.error_rate,
+                      retry_delay=args.retry_delay, seed=args.seed)
+    runs = []
+    print(f"{'run':>4} {'entities':>9} {'changed':>8} {'requests':>9} "
+          f"{'errors':>7} " + " ".join(f"{phase:>9}" for phase in PHASES) +
+          f" {'total':>9}")
+    with tempfile.TemporaryDirectory() as state_dir:
+        for run in range(args.runs + 1):
+            if run:
+                syn.churn(args.churn)
+            result = dict(run=run, **run_monitoring(syn, state_dir,
+                                                    args.crawl_workers))
+            assert result['entities'] == syn.num_files
+            runs.append(result)
+            changed = sum(count for status, count
+                          in result['statuses'].items()
+                          if status != "Existing")
+            print(f"{run:>4} {result['entities']:>9} {changed:>8} "
+                  f"{result['requests']:>9} {result['errors']:>7} " +
+                  " ".join(f"{result['phases'][phase]:>9.3f}"
+                           for phase in PHASES) +
+                  f" {result['seconds']:>9.3f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump({
+                'benchmark': "monitoring",
+                'timestamp': datetime.datetime.now(
+                    datetime.timezone.utc
+                ).isoformat(),
+                'python': platform.python_version(),
+                'parameters': vars(args),
+                'runs': runs
+            }, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
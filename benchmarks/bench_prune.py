@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Benchmark skipping folders whose contents did not change
+
+Monitors two identical synthetic projects where a fraction of hot folders
+change before every run, one listing every folder and one with a
+`max_folder_age`, and compares the requests of each run.  Once folders
+were listed twice without changing, the requests of a run should drop
+roughly in proportion to the fraction of cold folders while both find the
+same changes.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import random
+import tempfile
+
+from synapsemonitor import monitor
+
+from fake_synapse import FakeSynapse
+
+
+def hot_churn(syn, hot_folders, run):
+    """Updates a random file and adds a file in each hot folder"""
+    rng = random.Random(run)
+    modifiedon = (datetime.datetime(2021, 1, 1) +
+                  datetime.timedelta(seconds=run)).strftime(
+                      "%Y-%m-%dT%H:%M:%S.000Z")
+    for folder in hot_folders:
+        synid = syn._file_id(folder, rng.randrange(syn.files_per_folder))
+        version = syn._header(synid)['versionNumber'] + 1
+        syn.changed.setdefault(synid, {}).update(versionNumber=version,
+                                                 modifiedOn=modifiedon)
+        synid = syn.add_file(syn._folder_id(folder), f"added{run}.txt")
+        syn.changed[synid].update(modifiedOn=modifiedon)
+
+
+def run_monitor(syn, state_dir, max_folder_age):
+    """Monitors the fake project once
+
+    Returns:
+        tuple - number of requests, {status: count} of the changes
+    """
+    calls = syn.calls
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, report = monitor.monitor_project(syn, syn.projectid,
+                                            state_dir=state_dir,
+                                            max_folder_age=max_folder_age)
+    assert report.total == syn.num_files, (report.total, syn.num_files)
+    return syn.calls - calls, {status: count for status, count
+                               in report.counts.items()
+                               if status != "Existing"}
+
+
+def build_parser():
+    """Set up argument parser and returns"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Folder levels below the project')
+    parser.add_argument('--fanout', type=int, default=5,
+                        help='Sub folders per folder')
+    parser.add_argument('--files-per-folder', type=int, default=20,
+                        help='Files per folder')
+    parser.add_argument('--hot', type=float, default=0.1,
+                        help='Fraction of the folders changing before '
+                             'every run')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Number of runs with changes')
+    parser.add_argument('--max-folder-age', type=float, default=3600,
+                        help='Seconds folders may go without being listed')
+    parser.add_argument('--min-saving', type=float, default=0.5,
+                        help='Fail if the runs after warming up do not make '
+                             'this fraction fewer requests')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the hot folders')
+    return parser
+
+
+def main():
+    """Invoke"""
+    args = build_parser().parse_args()
+    fakes = [FakeSynapse(depth=args.depth, fanout=args.fanout,
+                         files_per_folder=args.files_per_folder)
+             for _ in range(2)]
+    num_folders = fakes[0].num_folders
+    hot_folders = random.Random(args.seed).sample(
+        range(num_folders), max(1, int(num_folders * args.hot))
+    )
+    print(f"{len(hot_folders)} hot folders of {num_folders}")
+    print(f"{'run':>4} {'changes':>8} {'all req':>8} {'pruned req':>11} "
+          f"{'saving':>7}")
+    with tempfile.TemporaryDirectory() as full_dir, \
+            tempfile.TemporaryDirectory() as pruned_dir:
+        # The first two runs list every folder: once to track the entities
+        # and once to see that the folders did not change
+        for run in range(args.runs + 2):
+            if run:
+                for syn in fakes:
+                    hot_churn(syn, hot_folders, run)
+            full_requests, full_changes = run_monitor(fakes[0], full_dir, 0)
+            pruned_requests, pruned_changes = run_monitor(
+                fakes[1], pruned_dir, args.max_folder_age
+            )
+            assert pruned_changes == full_changes, \
+                (pruned_changes, full_changes)
+            saving = 1 - pruned_requests / full_requests
+            print(f"{run:>4} {sum(full_changes.values()):>8} "
+                  f"{full_requests:>8} {pruned_requests:>11} "
+                  f"{saving:>7.0%}")
+    assert saving >= args.min_saving, \
+        f"Pruning saves only {saving:.0%} of the requests"
+
+
+if __name__ == "__main__":
+    main()
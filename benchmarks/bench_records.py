@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Benchmark memory per tracked entity of compact records and DataFrames
+
+Builds synthetic tracking tables as a DataFrame of Python strings, the way
+table queries are read, and as compact `records.TrackingTable` columns,
+reports the memory allocated per entity by each and times diffing a crawl
+with a fixed churn rate against the tracking table.  Compact records
+should take several times less memory per entity.
+"""
+import argparse
+import hashlib
+import time
+import tracemalloc
+
+import pandas as pd
+
+from synapsemonitor import records, writer
+
+MODIFIED_ON = "2020-01-01T00:00:00.000Z"
+
+
+def synthetic_rows(size, churn=0.01, offset=0):
+    """Tracking table rows of `size` entities, with row ids and versions,
+    where the first `churn` of the entities are renamed"""
+    changed = int(size * churn)
+    for i in range(offset, offset + size):
+        name = f"renamed{i}.txt" if i < offset + changed else f"file{i}.txt"
+        yield (f"syn{i}", hashlib.md5(str(i).encode()).hexdigest(), name,
+               1577836800000 + i, f"1@{MODIFIED_ON}", f"syn{i // 100 + 1}",
+               i, 1)
+
+
+def _allocated(build):
+    """Bytes allocated by what `build` returns, and the result"""
+    tracemalloc.start()
+    result = build()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated, result
+
+
+def build_parser():
+    """Set up argument parser and returns"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help='Number of synthetic entities')
+    parser.add_argument('--min-ratio', type=float, default=3,
+                        help='Fail if compact records do not take this many '
+                             'times less memory than a DataFrame')
+    return parser
+
+
+def main():
+    """Invoke"""
+    args = build_parser().parse_args()
+    columns = writer.TRACKING_COLUMNS
+    print(f"{'entities':>10} {'df B/ent':>10} {'rec B/ent':>10} "
+          f"{'ratio':>8} {'diff s':>8}")
+    for size in args.sizes:
+        df_bytes, _ = _allocated(lambda: pd.DataFrame(
+            [row[:len(columns)] for row in synthetic_rows(size)],
+            columns=columns,
+            index=[f"{row[-2]}_{row[-1]}" for row in synthetic_rows(size)]
+        ))
+        record_bytes, tracked = _allocated(
+            lambda: records.TrackingTable(synthetic_rows(size))
+        )
+        # Drop the first 1% of the entities, rename the next 1% and add 1%
+        changed = int(size * 0.01)
+        current = records.TrackingTable(
+            row[:len(columns)]
+            for row in synthetic_rows(size, churn=0.02)
+            if int(row[0][3:]) >= changed
+        )
+        for row in synthetic_rows(changed, offset=size):
+            current.append(row[:len(columns)])
+        start = time.perf_counter()
+        changeset = writer.get_changeset(current, tracked)
+        elapsed = time.perf_counter() - start
+        assert [len(changes) for changes in changeset] == [changed] * 3
+        ratio = df_bytes / record_bytes
+        print(f"{size:>10} {df_bytes / size:>10.0f} "
+              f"{record_bytes / size:>10.0f} {ratio:>8.1f} "
+              f"{elapsed:>8.2f}")
+    assert ratio >= args.min_ratio, \
+        f"Compact records take only {ratio:.1f} times less memory"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,499 @@
+"""In-process stand-in for `synapseclient.Synapse` used by the benchmarks
+
+The project tree is generated on demand from its shape, so projects of
+millions of entities cost no memory until they are changed, and the
+tracking tables are kept in an on-disk SQLite database like remote tables.
+Requests can be slowed down with latency and fail transiently, in which
+case they are retried like the Synapse client retries them.
+"""
+import csv
+import datetime
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+import pandas as pd
+import requests
+import synapseclient
+from synapseclient.core.exceptions import SynapseHTTPError
+
+from synapsemonitor import metrics
+
+FILE_TYPE = "org.sagebionetworks.repo.model.FileEntity"
+FOLDER_TYPE = "org.sagebionetworks.repo.model.Folder"
+PROJECT_TYPE = "org.sagebionetworks.repo.model.Project"
+MODIFIED_ON = "2020-01-01T00:00:00.000Z"
+PAGE_SIZE = 50
+TABLE_ID = "syn0"
+TABLE_TYPE = "org.sagebionetworks.repo.model.table.TableEntity"
+USER = {'ownerId': '1', 'userName': 'fake-user'}
+
+
+def _not_found(uri):
+    """Synapse error of a missing resource"""
+    response = requests.Response()
+    response.status_code = 404
+    return SynapseHTTPError(f"404 Not Found for {uri}", response=response)
+
+
+class FakeEntity(dict):
+    """Minimal Synapse Entity: annotations are items, properties are
+    attributes"""
+    def __init__(self, properties, **annotations):
+        super().__init__(**annotations)
+        self.properties = type("Properties", (), {})()
+        for key, value in properties.items():
+            setattr(self.properties, key, value)
+        self.properties.get = lambda key, default=None: \
+            properties.get(key, default)
+        self.id = properties['id']
+        self.name = properties['name']
+
+
+class FakeQueryResult:
+    """Table query result downloaded as CSV, like `CsvFileTable`"""
+    def __init__(self, tableid, filepath, etag):
+        self.tableId = tableid
+        self.filepath = filepath
+        self.etag = etag
+
+    def asDataFrame(self):
+        """DataFrame indexed by "{rowid}_{version}" """
+        tabledf = pd.read_csv(self.filepath, dtype={'md5': str,
+                                                    'fingerprint': str})
+        tabledf.index = [f"{row_id}_{row_version}" for row_id, row_version
+                         in zip(tabledf.pop('ROW_ID'),
+                                tabledf.pop('ROW_VERSION'))]
+        return tabledf
+
+
+class FakeSynapse:
+    """Synthetic project tree of `depth` levels of `fanout` folders, each
+    folder holding `files_per_folder` files.  Every request sleeps for
+    `latency` seconds and fails with a probability of `error_rate`, failed
+    requests are retried after `retry_delay` seconds.
+
+    Args:
+        depth: Number of folder levels below the project
+        fanout: Number of sub folders per folder
+        files_per_folder: Number of files per folder
+        latency: Seconds each request takes
+        error_rate: Probability of a request failing
+        retry_delay: Seconds before a failed request is retried
+        seed: Seed of the random errors and churn
+    """
+    fileHandleEndpoint = "https://file.fake"
+
+    def __init__(self, depth=2, fanout=5, files_per_folder=20, latency=0.0,
+                 error_rate=0.0, retry_delay=0.0, seed=None):
+        self.depth = depth
+        self.fanout = fanout
+        self.files_per_folder = files_per_folder
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_delay = retry_delay
+        self.random = random.Random(seed)
+        self.projectid = "syn1"
+        self.num_folders = sum(fanout ** level for level in range(depth + 1))
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.messages = []
+        # Contents of the stored files by name
+        self.files = {}
+        # Wiki pages by (owner, page id)
+        self.wikis = {}
+        # Changes to the generated tree
+        self.changed = {}
+        self.deleted = set()
+        self.added = {}
+        # Generated files moved to another container
+        self.moved = set()
+        self._next_id = 1 + self.num_folders * (1 + files_per_folder)
+        self._num_generated = self._next_id
+        self._table_dir = tempfile.mkdtemp()
+        self._table = sqlite3.connect(
+            os.path.join(self._table_dir, "table.db"),
+            check_same_thread=False
+        )
+        self._table.execute(
+            "CREATE TABLE rows (row_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "tableid TEXT, row_version INTEGER, id TEXT, md5 TEXT, "
+            "name TEXT, modifiedon INTEGER, fingerprint TEXT, parentid TEXT)"
+        )
+        self._table.execute("CREATE INDEX rows_id ON rows (tableid, id)")
+        # Tracking tables in the project: {name: Synapse id},
+        # {Synapse id: version} and {Synapse id: column names}
+        self.tables = {}
+        self._table_versions = {}
+        self.table_columns = {}
+
+    @property
+    def num_files(self):
+        """Number of non-folder entities in the project, without the files
+        stored by the monitor"""
+        return (self.num_folders * self.files_per_folder +
+                sum(map(len, self.added.values())) -
+                len(self.deleted) - len(self.moved) - len(self.files))
+
+    def _folder_id(self, folder):
+        return f"syn{1 + folder}"
+
+    def _file_id(self, folder, index):
+        number = self.num_folders + folder * self.files_per_folder + index
+        return f"syn{1 + number}"
+
+    def _header(self, synid):
+        """Generates the header of an entity in the tree"""
+        number = int(synid[3:]) - 1
+        if number == 0:
+            header = {'id': synid, 'name': "project", 'type': PROJECT_TYPE}
+        elif number < self.num_folders:
+            header = {'id': synid, 'type': FOLDER_TYPE,
+                      'name': f"folder{(number - 1) % self.fanout}"}
+        else:
+            index = (number - self.num_folders) % self.files_per_folder
+            header = {'id': synid, 'name': f"file{index}.txt",
+                      'type': FILE_TYPE}
+        header.update({'versionNumber': 1, 'modifiedOn': MODIFIED_ON,
+                       'modifiedBy': USER['ownerId']})
+        header.update(self.changed.get(synid, {}))
+        return header
+
+    def _parent(self, synid):
+        """Synapse id of the container of an entity in the tree"""
+        for parentid, children in self.added.items():
+            if synid in children:
+                return parentid
+        number = int(synid[3:]) - 1
+        if number < self.num_folders:
+            return self._folder_id((number - 1) // self.fanout)
+        return self._folder_id(
+            (number - self.num_folders) // self.files_per_folder
+        )
+
+    def _iter_children(self, parentid):
+        """Yields the headers of the children of a container"""
+        folder = int(parentid[3:]) - 1
+        if folder < self.num_folders:
+            for index in range(self.files_per_folder):
+                synid = self._file_id(folder, index)
+                if synid not in self.deleted and synid not in self.moved:
+                    yield self._header(synid)
+            if folder * self.fanout + 1 < self.num_folders:
+                for child in range(self.fanout):
+                    yield self._header(
+                        self._folder_id(folder * self.fanout + 1 + child)
+                    )
+        for synid in self.added.get(parentid, []):
+            if synid not in self.deleted:
+                yield self._header(synid)
+
+    def add_file(self, parentid, name):
+        """Adds a file to a container and returns its Synapse id"""
+        synid = f"syn{self._next_id}"
+        self._next_id += 1
+        self.added.setdefault(parentid, []).append(synid)
+        self.changed[synid] = {'name': name, 'type': FILE_TYPE}
+        return synid
+
+    def move(self, synid, parentid):
+        """Moves a file to another container"""
+        for children in self.added.values():
+            if synid in children:
+                children.remove(synid)
+        if int(synid[3:]) < self._num_generated:
+            self.moved.add(synid)
+        self.added.setdefault(parentid, []).append(synid)
+        self.changed.setdefault(synid, {})['modifiedOn'] = \
+            datetime.datetime.now(datetime.timezone.utc).strftime(
+                "%Y-%m-%dT%H:%M:%S.000Z"
+            )
+
+    def churn(self, rate):
+        """Updates, deletes and adds `rate` of the generated files each
+
+        Returns:
+            tuple - Synapse ids of the updated, deleted and added files
+        """
+        generated = self.num_folders * self.files_per_folder
+        count = min(int(generated * rate),
+                    (generated - len(self.deleted)) // 2)
+        modifiedon = datetime.datetime.now(datetime.timezone.utc).strftime(
+            "%Y-%m-%dT%H:%M:%S.000Z"
+        )
+        picked = set()
+        while len(picked) < 2 * count:
+            synid = self._file_id(self.random.randrange(self.num_folders),
+                                  self.random.randrange(self.files_per_folder))
+            if synid not in self.deleted:
+                picked.add(synid)
+        picked = sorted(picked)
+        updated, deleted = picked[:count], picked[count:]
+        for synid in updated:
+            version = self._header(synid)['versionNumber'] + 1
+            self.changed.setdefault(synid, {}).update(
+                versionNumber=version, modifiedOn=modifiedon
+            )
+        self.deleted.update(deleted)
+        added = [
+            self.add_file(
+                self._folder_id(self.random.randrange(self.num_folders)),
+                f"added{self._next_id}.txt"
+            )
+            for _ in range(count)
+        ]
+        return updated, deleted, added
+
+    def _request(self, endpoint):
+        """Counts a request in `calls` and the run metrics"""
+        metrics.METRICS.add_request(endpoint)
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        while self.error_rate and self.random.random() < self.error_rate:
+            metrics.METRICS.add_retry()
+            with self._lock:
+                self.errors += 1
+            time.sleep(self.retry_delay + self.latency)
+
+    def login(self, *args, **kwargs):
+        """Logs in"""
+        self._request("GET /session")
+
+    def getUserProfile(self, principalid=None):
+        """Gets the profile of the logged in user"""
+        self._request("GET /userProfile")
+        return dict(USER)
+
+    def getChildren(self, parent, includeTypes=None, **kwargs):
+        """One request per page of children, like Synapse.  Tables are
+        listed after the other children of the project."""
+        self._request("POST /entity/children")
+        children = iter(())
+        if includeTypes is None or set(includeTypes) - {'table'}:
+            children = self._iter_children(parent)
+        if parent == self.projectid and (includeTypes is None or
+                                         'table' in includeTypes):
+            children = itertools.chain(children, [
+                {'id': tableid, 'name': name, 'type': TABLE_TYPE,
+                 'versionNumber': 1, 'modifiedOn': MODIFIED_ON,
+                 'modifiedBy': USER['ownerId']}
+                for name, tableid in list(self.tables.items())
+            ])
+        for count, child in enumerate(children):
+            if count and count % PAGE_SIZE == 0:
+                self._request("POST /entity/children")
+            yield child
+
+    def get(self, synid, downloadFile=True):
+        """Gets an entity or a tracking table schema"""
+        self._request("GET /entity/{id}")
+        if synid in self.table_columns:
+            name = next(name for name, tableid in self.tables.items()
+                        if tableid == synid)
+            schema = synapseclient.Schema(name=name, parent=self.projectid)
+            schema.properties.id = synid
+            return schema
+        return FakeEntity(self._header(synid), md5=f"md5-{synid}")
+
+    def restGET(self, uri, **kwargs):
+        """Supports GET /entity/{id}, /entity/{id}/annotations2 and
+        /userGroupHeaders/batch"""
+        self._request(metrics.get_endpoint("GET", uri))
+        if uri.startswith("/userGroupHeaders/batch"):
+            return {'children': [
+                {'ownerId': principalid, 'userName': f"user{principalid}"}
+                for principalid in uri.split("ids=")[1].split(",")
+            ]}
+        synid = uri.split("/")[2]
+        if uri.endswith("/annotations2"):
+            if synid in self.deleted:
+                raise _not_found(uri)
+            return {'id': synid, 'annotations': {
+                key: {'type': 'STRING', 'value': [value]}
+                for key, value in self._annotations(synid).items()
+            }}
+        if synid in self.deleted:
+            raise _not_found(uri)
+        header = self._header(synid)
+        return dict(header, dataFileHandleId=f"fh-{synid}",
+                    parentId=self._parent(synid),
+                    concreteType=header['type'])
+
+    def restPOST(self, uri, body, **kwargs):
+        """Supports POST /fileHandle/batch and /entity/header"""
+        self._request(metrics.get_endpoint("POST", uri))
+        request = json.loads(body)
+        if uri == "/entity/header":
+            return {'results': [self._header(reference['targetId'])
+                                for reference in request['references']]}
+        return {'requestedFiles': [
+            {'fileHandleId': requested['fileHandleId'],
+             'fileHandle': {
+                 'id': requested['fileHandleId'],
+                 'contentMd5': f"md5-{requested['associateObjectId']}"
+             }}
+            for requested in request['requestedFiles']
+        ]}
+
+    def get_table_etag(self, tableid):
+        """Etag of a tracking table"""
+        return f"etag-{tableid}-{self._table_versions[tableid]}"
+
+    @property
+    def table_etag(self):
+        """Etag of the first tracking table"""
+        return self.get_table_etag(TABLE_ID)
+
+    def tableQuery(self, query, **kwargs):
+        """Supports "select * from {table} [where id in (...)]" and
+        "select id from {table} limit 1" on the tracking tables"""
+        self._request("POST /entity/{id}/table/query/async/start")
+        tableid = re.search(r"from (syn\d+)", query).group(1)
+        columns = self.table_columns[tableid]
+        sql = (f"SELECT row_id, row_version, {', '.join(columns)} FROM rows "
+               "WHERE tableid = ?")
+        params = [tableid]
+        match = re.search(r"where id in \((.*)\)", query)
+        if match is not None:
+            synids = [synid.strip(" '") for synid in match.group(1).split(",")]
+            sql += f" AND id IN ({', '.join('?' * len(synids))})"
+            params += synids
+        if "limit 1" in query:
+            sql += " LIMIT 1"
+        handle, filepath = tempfile.mkstemp(suffix=".csv",
+                                            dir=self._table_dir)
+        with os.fdopen(handle, "w", newline="") as query_file:
+            writer = csv.writer(query_file)
+            writer.writerow(['ROW_ID', 'ROW_VERSION'] + columns)
+            with self._lock:
+                cursor = self._table.execute(sql, params)
+                for rows in iter(lambda: cursor.fetchmany(1000), []):
+                    writer.writerows(rows)
+        return FakeQueryResult(tableid, filepath,
+                               self.get_table_etag(tableid))
+
+    def store(self, obj, **kwargs):
+        """Stores a file, a tracking table schema or tracking table rows"""
+        if isinstance(obj, synapseclient.File):
+            return self._store_file(obj)
+        if isinstance(obj, synapseclient.Wiki):
+            self._request("PUT /entity/{id}/wiki2")
+            self.wikis[obj.ownerId, getattr(obj, 'id', None)] = obj
+            return obj
+        self._request("POST /entity/{id}/table/transaction/async/start")
+        with self._lock:
+            if isinstance(obj, synapseclient.Schema):
+                # Tables are found by name like `bootstrap._create_table`
+                if obj.name not in self.tables:
+                    tableid = (TABLE_ID if not self._table_versions
+                               else f"syn0{len(self._table_versions)}")
+                    self.tables[obj.name] = tableid
+                    self._table_versions[tableid] = 0
+                    self.table_columns[tableid] = []
+                tableid = self.tables[obj.name]
+                if obj.columns_to_store:
+                    # Schema changes are table transactions
+                    self.table_columns[tableid] += [
+                        col['name'] for col in obj.columns_to_store
+                    ]
+                    self._table_versions[tableid] += 1
+                obj.properties.id = tableid
+                return obj
+            return self._store_rows(obj)
+
+    def _store_rows(self, obj):
+        """Applies a CSV of appended, updated and deleted rows"""
+        tableid = obj.tableId
+        etag = self.get_table_etag(tableid)
+        if obj.etag is not None and obj.etag != etag:
+            raise ValueError(f"Etag {obj.etag} != {etag}")
+        self._table_versions[tableid] += 1
+        version = self._table_versions[tableid]
+        columns = self.table_columns[tableid]
+        with open(obj.filepath, newline="") as rows_file:
+            rows = csv.DictReader(rows_file)
+            unknown = set(rows.fieldnames) - set(columns) - {'ROW_ID',
+                                                             'ROW_VERSION'}
+            if unknown:
+                raise ValueError(f"{tableid} has no columns {unknown}")
+            for row in rows:
+                values = [row.get(col, '') for col in
+                          ['id', 'md5', 'name', 'modifiedon', 'fingerprint',
+                           'parentid']]
+                if not row['ROW_ID']:
+                    self._table.execute(
+                        "INSERT INTO rows (tableid, row_version, id, md5, "
+                        "name, modifiedon, fingerprint, parentid) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [tableid, version] + values
+                    )
+                elif not any(values):
+                    self._table.execute("DELETE FROM rows WHERE row_id = ?",
+                                        (row['ROW_ID'],))
+                else:
+                    self._table.execute(
+                        "UPDATE rows SET row_version = ?, id = ?, md5 = ?, "
+                        "name = ?, modifiedon = ?, fingerprint = ?, "
+                        "parentid = ? WHERE row_id = ?",
+                        [version] + values + [row['ROW_ID']]
+                    )
+        self._table.commit()
+        obj.etag = self.get_table_etag(tableid)
+        return obj
+
+    def delete(self, obj, version=None):
+        """Deletes a tracking table"""
+        self._request("DELETE /entity/{id}")
+        with self._lock:
+            for name, tableid in list(self.tables.items()):
+                if tableid == obj:
+                    del self.tables[name]
+            self._table.execute("DELETE FROM rows WHERE tableid = ?", (obj,))
+            self._table.commit()
+
+    def _store_file(self, file_entity):
+        """Adds a file to its parent or updates the file of the same name"""
+        self._request("POST /entity")
+        with open(file_entity.path, "rb") as stored_file:
+            self.files[file_entity.name] = stored_file.read()
+        for synid in self.added.get(file_entity.parentId, []):
+            header = self._header(synid)
+            if header['name'] == file_entity.name:
+                self.changed[synid]['versionNumber'] = \
+                    header['versionNumber'] + 1
+                break
+        else:
+            synid = self.add_file(file_entity.parentId, file_entity.name)
+        file_entity.properties.id = synid
+        return file_entity
+
+    def _annotations(self, synid):
+        """Generates the annotations of an entity, changed annotations are
+        under "annotations" in `changed`"""
+        number = int(synid[3:])
+        annotations = {'center': f"center{number % 3}",
+                       'fileType': ["csv", "txt"][number % 2]}
+        annotations.update(self.changed.get(synid, {}).get('annotations', {}))
+        return annotations
+
+    def getWiki(self, owner, subpageId=None):
+        """Gets a wiki page stored with `store`"""
+        self._request("GET /entity/{id}/wiki2")
+        if (owner, subpageId) not in self.wikis:
+            raise _not_found(f"/entity/{owner}/wiki2")
+        return self.wikis[owner, subpageId]
+
+    def sendMessage(self, userIds, messageSubject, messageBody,
+                    contentType="text/plain"):
+        """Records a message"""
+        self._request("POST /message")
+        self.messages.append((userIds, messageSubject, messageBody))
@@ -1,18 +1,27 @@
 #!/usr/bin/env python
 """Command line client"""
 import argparse
+import re
+import sys
 
-from . import monitor
+from . import (config, crawler, daemon, filters, governor, history, metrics,
+               monitor, notify, scheduler, state)
 
+COMMANDS = ['run', 'serve', 'history']
+STATUSES = ['New', 'Updated', 'Deleted', 'Moved']
 
-def build_parser():
-    """Set up argument parser and returns"""
-    parser = argparse.ArgumentParser(
-        description='Checks for new/modified entities in a project.'
+
+def _build_common_parser():
+    """Set up the arguments shared by the commands"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        'projectid', metavar='projectid', type=str, nargs='*',
+        help='Synapse IDs of projects to be monitored.'
     )
     parser.add_argument(
-        'projectid', metavar='projectid', type=str,
-        help='Synapse ID of project to be monitored.'
+        '--config', metavar='file', type=str,
+        help='JSON config file listing projects to be monitored '
+             'and their recipients'
     )
     parser.add_argument(
         '--userid',
@@ -29,15 +38,310 @@ def build_parser():
         help='Synapse config file with user credentials '
              '(overrides default ~/.synapseConfig)'
     )
+    parser.add_argument(
+        '--state-dir', dest='state_dir', metavar='dir', type=str,
+        help='Directory of local monitoring state '
+             '(defaults to ~/.synapsemonitor)'
+    )
+    parser.add_argument(
+        '--crawl-workers', dest='crawl_workers', metavar='n', type=int,
+        default=crawler.DEFAULT_WORKERS,
+        help='Number of concurrent Synapse requests while crawling '
+             f'(defaults to {crawler.DEFAULT_WORKERS})'
+    )
+    parser.add_argument(
+        '--project-workers', dest='project_workers', metavar='n', type=int,
+        default=monitor.DEFAULT_PROJECT_WORKERS,
+        help='Number of projects monitored at the same time '
+             f'(defaults to {monitor.DEFAULT_PROJECT_WORKERS})'
+    )
+    parser.add_argument(
+        '--project-timeout', dest='project_timeout', metavar='seconds',
+        type=float,
+        help='Seconds each project crawl may take before it is abandoned'
+    )
+    parser.add_argument(
+        '--max-request-rate', dest='max_request_rate', metavar='n',
+        type=float, default=governor.DEFAULT_MAX_RATE,
+        help='Maximum Synapse requests per second, lowered while Synapse '
+             f'throttles (defaults to {governor.DEFAULT_MAX_RATE:g})'
+    )
+    parser.add_argument(
+        '--shards', metavar='n', type=int, default=1,
+        help='Number of tracking tables the entities of each project are '
+             'spread over, tables of another number are migrated '
+             '(defaults to 1)'
+    )
+    parser.add_argument(
+        '--max-folder-age', dest='max_folder_age', metavar='seconds',
+        type=float, default=0,
+        help='Skip listing folders whose contents showed no change when '
+             'they were listed less than this many seconds ago, changes '
+             'inside them are found within this time (defaults to 0, '
+             'every folder is listed)'
+    )
+    parser.add_argument(
+        '--exclude', metavar='glob', action='append', default=[],
+        help='Skip the entities whose path in the project matches this '
+             'glob, like scratch/** or **/*.tmp.  Matching folders are not '
+             'listed.  Can be given more than once.'
+    )
+    parser.add_argument(
+        '--include', metavar='glob', action='append', default=[],
+        help='Only track the entities whose path in the project matches '
+             'this glob.  Can be given more than once.'
+    )
+    parser.add_argument(
+        '--exclude-types', dest='exclude_types', metavar='type',
+        action='append', default=[],
+        help='Skip the entities of this type, like link or entityview.  '
+             'Can be given more than once.'
+    )
+    parser.add_argument(
+        '--notify-statuses', dest='notify_statuses', metavar='status',
+        nargs='+', choices=STATUSES,
+        help='Statuses of the entities to notify recipients of, any of '
+             f'{", ".join(STATUSES)} (defaults to the config file or New)'
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Print the time spent in each phase and the Synapse calls made'
+    )
+    parser.add_argument(
+        '--metrics-json', dest='metrics_json', metavar='file', type=str,
+        help='Append the run metrics to this JSON lines file, after each '
+             'poll with serve, where they add up since the daemon started'
+    )
+    parser.add_argument(
+        '--metrics-prom', dest='metrics_prom', metavar='file', type=str,
+        help='Write the run metrics to this Prometheus textfile, after each '
+             'poll with serve, where they add up since the daemon started'
+    )
+    return parser
+
+
+def build_parser():
+    """Set up argument parser and returns"""
+    parser = argparse.ArgumentParser(
+        description='Checks for new/modified entities in projects.'
+    )
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    common = _build_common_parser()
+
+    run_parser = subparsers.add_parser(
+        'run', parents=[common],
+        help='Monitor the projects once (default command)'
+    )
+    run_parser.add_argument(
+        '--full-sync', dest='full_sync', action='store_true',
+        help='Fetch every entity instead of only the entities modified '
+             'since the last run'
+    )
+    run_parser.add_argument(
+        '--resume', action='store_true',
+        help='Continue the crawls the last run did not finish instead of '
+             'starting over'
+    )
+    run_parser.add_argument(
+        '--check-drift', dest='check_drift', action='store_true',
+        help='Compare the local state with the tracking tables instead '
+             'of monitoring'
+    )
+    run_parser.add_argument(
+        '--repair-drift', dest='repair_drift', action='store_true',
+        help='Update the tracking tables to match the local state '
+             'instead of monitoring'
+    )
+
+    serve_parser = subparsers.add_parser(
+        'serve', parents=[common],
+        help='Keep monitoring the projects, polling each project more '
+             'often the more it changes'
+    )
+    serve_parser.add_argument(
+        '--interval', metavar='seconds', type=float,
+        default=scheduler.DEFAULT_INTERVAL,
+        help='Initial seconds between polls of a project '
+             f'(defaults to {scheduler.DEFAULT_INTERVAL})'
+    )
+    serve_parser.add_argument(
+        '--min-interval', dest='min_interval', metavar='seconds', type=float,
+        default=scheduler.DEFAULT_MIN_INTERVAL,
+        help='Minimum seconds between polls of a project '
+             f'(defaults to {scheduler.DEFAULT_MIN_INTERVAL})'
+    )
+    serve_parser.add_argument(
+        '--max-interval', dest='max_interval', metavar='seconds', type=float,
+        default=scheduler.DEFAULT_MAX_INTERVAL,
+        help='Maximum seconds between polls of a project '
+             f'(defaults to {scheduler.DEFAULT_MAX_INTERVAL})'
+    )
+    serve_parser.add_argument(
+        '--jitter', metavar='fraction', type=float,
+        default=scheduler.DEFAULT_JITTER,
+        help='Fraction of the interval polls are moved at random '
+             f'(defaults to {scheduler.DEFAULT_JITTER})'
+    )
+    serve_parser.add_argument(
+        '--notify-window', dest='notify_window', metavar='seconds',
+        type=float, default=notify.DEFAULT_WINDOW,
+        help='Seconds the notifications of a recipient are gathered before '
+             f'they are sent (defaults to {notify.DEFAULT_WINDOW})'
+    )
+    serve_parser.add_argument(
+        '--request-rate', dest='request_rate', metavar='n', type=float,
+        help='Synapse requests per second all polls may make on average '
+             '(defaults to unlimited)'
+    )
+
+    history_parser = subparsers.add_parser(
+        'history',
+        help='Summarize the changes the monitor recorded in the local state '
+             'without querying Synapse'
+    )
+    history_parser.add_argument(
+        'projectid', metavar='projectid', type=str, nargs='*',
+        help='Synapse IDs of projects to summarize (defaults to the config '
+             'file or every recorded project)'
+    )
+    history_parser.add_argument(
+        '--config', metavar='file', type=str,
+        help='JSON config file listing the projects to summarize'
+    )
+    history_parser.add_argument(
+        '--state-dir', dest='state_dir', metavar='dir', type=str,
+        help='Directory of local monitoring state '
+             '(defaults to ~/.synapsemonitor)'
+    )
+    history_parser.add_argument(
+        '--since', metavar='time', type=history.parse_time,
+        help='Start of the time range, a duration before now like 7d, 12h '
+             'or 2w or an ISO date (defaults to the first change)'
+    )
+    history_parser.add_argument(
+        '--until', metavar='time', type=history.parse_time,
+        help='End of the time range, like --since (defaults to now)'
+    )
+    history_parser.add_argument(
+        '--by', choices=list(state.EVENT_GROUPS), default='event',
+        help='Count the changes of each event type by this grouping '
+             '(defaults to event)'
+    )
+    history_parser.add_argument(
+        '--list', dest='list_events', action='store_true',
+        help='List every change instead of counting them'
+    )
     return parser
 
 
-def main():
+def _print_history(args, projectids):
+    """Prints the change history of projects"""
+    projectids = projectids or None
+    if args.list_events:
+        events = state.iter_events(projectids, start=args.since,
+                                   end=args.until, state_dir=args.state_dir)
+        for line in history.format_events(events):
+            print(line)
+        return
+    counts = state.count_events(projectids, start=args.since, end=args.until,
+                                by=args.by, state_dir=args.state_dir)
+    print(history.format_counts(counts, args.by))
+
+
+def _report_metrics(args):
+    """Outputs the run metrics requested on the command line"""
+    summary = metrics.METRICS.summary()
+    if args.metrics_json is not None:
+        metrics.write_json(summary, args.metrics_json)
+    if args.metrics_prom is not None:
+        metrics.write_prometheus(summary, args.metrics_prom)
+    if args.profile:
+        print(metrics.format_summary(summary))
+
+
+def main(argv=None):
     """Invoke"""
-    args = build_parser().parse_args()
-    # func has to match the set_defaults
-    monitor.monitoring(args.projectid, synapseconfig=args.synapseconfig,
-                       userid=args.userid, email_subject=args.email_subject)
+    argv = sys.argv[1:] if argv is None else argv
+    # Monitoring once is the default command
+    if not argv or argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['run'] + argv
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    projects = {}
+    if args.command == 'history':
+        if args.config is not None:
+            projects.update(config.get_projects(
+                config.read_config(args.config)
+            ))
+        projects.update({projectid: None for projectid in args.projectid})
+        _print_history(args, list(projects))
+        return
+    sinks, statuses, dashboards, entity_filters = None, None, None, {}
+    if args.config is not None:
+        monitor_config = config.read_config(args.config)
+        projects.update(config.get_projects(monitor_config))
+        sinks, statuses = config.get_notifications(monitor_config)
+        dashboards = config.get_dashboards(monitor_config)
+        entity_filters = config.get_filters(monitor_config)
+    if args.notify_statuses is not None:
+        statuses = args.notify_statuses
+    statuses = tuple(statuses or ["New"])
+    projects.update({projectid: None for projectid in args.projectid})
+    if not projects:
+        parser.error("specify projectid or --config")
+    # Filters of the command line apply to every project
+    rules = {'exclude': [{'path': glob} for glob in args.exclude],
+             'include': [{'path': glob} for glob in args.include]}
+    if args.exclude_types:
+        rules['exclude'].append({'type': args.exclude_types})
+    entity_filters = {
+        projectid: {key: entity_filters.get(projectid, {}).get(key, []) +
+                    rules[key] for key in rules}
+        for projectid in projects
+    }
+    for settings in entity_filters.values():
+        try:
+            filters.EntityFilter.from_settings(settings)
+        except (ValueError, re.error) as error:
+            parser.error(f"invalid filter - {error}")
+    if args.command == 'serve':
+        daemon.serve(
+            projects, synapseconfig=args.synapseconfig, userid=args.userid,
+            email_subject=args.email_subject, state_dir=args.state_dir,
+            crawl_workers=args.crawl_workers,
+            project_workers=args.project_workers,
+            project_timeout=args.project_timeout, interval=args.interval,
+            min_interval=args.min_interval, max_interval=args.max_interval,
+            jitter=args.jitter, request_rate=args.request_rate,
+            max_request_rate=args.max_request_rate, sinks=sinks,
+            statuses=statuses, notify_window=args.notify_window,
+            shards=args.shards, dashboards=dashboards,
+            max_folder_age=args.max_folder_age, entity_filters=entity_filters,
+            after_poll=lambda: _report_metrics(args)
+        )
+        return
+    if args.check_drift or args.repair_drift:
+        monitor.check_drift(projects, synapseconfig=args.synapseconfig,
+                            state_dir=args.state_dir,
+                            repair=args.repair_drift,
+                            max_request_rate=args.max_request_rate,
+                            shards=args.shards)
+        _report_metrics(args)
+        return
+    failures = monitor.monitor_projects(
+        projects, synapseconfig=args.synapseconfig, userid=args.userid,
+        email_subject=args.email_subject, full_sync=args.full_sync,
+        state_dir=args.state_dir, crawl_workers=args.crawl_workers,
+        project_workers=args.project_workers,
+        project_timeout=args.project_timeout,
+        max_request_rate=args.max_request_rate, resume=args.resume,
+        sinks=sinks, statuses=statuses, shards=args.shards,
+        dashboards=dashboards, max_folder_age=args.max_folder_age,
+        entity_filters=entity_filters
+    )
+    _report_metrics(args)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
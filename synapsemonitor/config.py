@@ -0,0 +1,104 @@
+"""Configuration file"""
+import json
+
+
+def read_config(path):
+    """Reads a JSON configuration file
+
+    Args:
+        path: Path of configuration file
+
+    Returns:
+        dict - configuration
+    """
+    with open(path, "r") as config_file:
+        return json.load(config_file)
+
+
+def get_projects(config):
+    """Gets the projects to monitor and their recipients.  Projects are
+    listed under "projects" either as Synapse ids or as objects with a
+    "projectid" and optional "userids", i.e.
+
+        {"projects": ["syn123", {"projectid": "syn456", "userids": ["1"]}]}
+
+    Args:
+        config: Configuration from `read_config`
+
+    Returns:
+        dict - {Synapse project id: list of recipient user ids or None}
+    """
+    projects = {}
+    for project in config.get("projects", []):
+        if isinstance(project, str):
+            projects[project] = None
+        else:
+            projects[project["projectid"]] = project.get("userids")
+    return projects
+
+
+def get_dashboards(config):
+    """Gets the activity dashboards of the projects listed under "projects"
+    with a "dashboard", i.e.
+
+        {"projects": [{"projectid": "syn456",
+                       "dashboard": {"owner": "syn456", "subpage": 1234,
+                                     "annotations": ["center"]}}]}
+
+    Args:
+        config: Configuration from `read_config`
+
+    Returns:
+        dict - {Synapse project id: dashboard config}
+    """
+    return {project["projectid"]: project["dashboard"]
+            for project in config.get("projects", [])
+            if not isinstance(project, str) and "dashboard" in project}
+
+
+def get_filters(config):
+    """Gets the entity filters of the projects listed under "projects".
+    Rules under "filters" apply to every project, followed by the rules
+    of the "filters" of each project, i.e.
+
+        {"filters": {"exclude": [{"path": "scratch/**"}]},
+         "projects": ["syn123",
+                      {"projectid": "syn456",
+                       "filters": {"include": [{"name": "*.bam"}]}}]}
+
+    Args:
+        config: Configuration from `read_config`
+
+    Returns:
+        dict - {Synapse project id: {"exclude": rules, "include": rules}}
+    """
+    common = config.get("filters", {})
+    filters = {}
+    for project in config.get("projects", []):
+        if isinstance(project, str):
+            projectid, settings = project, {}
+        else:
+            projectid, settings = project["projectid"], project.get(
+                "filters", {}
+            )
+        filters[projectid] = {
+            key: common.get(key, []) + settings.get(key, [])
+            for key in ("exclude", "include")
+        }
+    return filters
+
+
+def get_notifications(config):
+    """Gets the notification settings listed under "notifications", i.e.
+
+        {"notifications": {"sinks": [{"type": "file", "path": "out.jsonl"}],
+                           "statuses": ["New", "Updated", "Deleted"]}}
+
+    Args:
+        config: Configuration from `read_config`
+
+    Returns:
+        tuple - list of sink configs or None, list of statuses or None
+    """
+    notifications = config.get("notifications", {})
+    return notifications.get("sinks"), notifications.get("statuses")
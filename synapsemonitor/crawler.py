@@ -0,0 +1,302 @@
+"""Concurrent project crawler"""
+import calendar
+import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import datetime
+import json
+
+FILE_TYPE = "org.sagebionetworks.repo.model.FileEntity"
+FOLDER_TYPE = "org.sagebionetworks.repo.model.Folder"
+DEFAULT_WORKERS = 8
+# Maximum number of file handles per /fileHandle/batch request
+FILE_HANDLE_BATCH_SIZE = 100
+
+# Compact tracking row built from entity headers, in tracking table order
+# followed by the principal id of the last contributor and the entity type
+EntityRecord = collections.namedtuple(
+    "EntityRecord",
+    ["id", "md5", "name", "modifiedon", "fingerprint", "parentid",
+     "modifiedby", "type"],
+    defaults=(None, None)
+)
+
+
+def get_fingerprint(header):
+    """Gets the change signature of an entity from fields of its header.
+    Any change to an entity updates its modifiedOn and a content change of
+    a versioned entity also bumps its versionNumber, so comparing
+    signatures tells whether an entity changed and the version tells
+    whether its content changed.
+
+    Args:
+        header: Entity header or Entity properties
+
+    Returns:
+        str - "{versionNumber}@{modifiedOn}"
+    """
+    return f"{header.get('versionNumber', '')}@{header['modifiedOn']}"
+
+
+def entity_date_to_timestamp(entity_date_time):
+    """Converts a Synapse date like the modifiedOn of an entity to Unix
+    epoch time in milliseconds, dropping fractions of seconds
+
+    Args:
+        entity_date_time: UTC date and time, "2020-01-31T12:00:00.000Z"
+
+    Returns:
+        int - Unix epoch time in milliseconds
+    """
+    date_time = datetime.datetime.strptime(entity_date_time[:19],
+                                           "%Y-%m-%dT%H:%M:%S")
+    return calendar.timegm(date_time.timetuple()) * 1000
+
+
+def _list_children(syn, parentid):
+    """Lists all pages of children of a container"""
+    return list(syn.getChildren(parentid))
+
+
+def _bounded_map(func, items, max_workers, max_in_flight):
+    """Maps `func` over `items` on a thread pool, never holding more than
+    `max_in_flight` results that the consumer has not taken yet.
+
+    Results are yielded in completion order, not in input order.
+    """
+    items = iter(items)
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight.add(executor.submit(func, item))
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def crawl(syn, synid, max_workers=DEFAULT_WORKERS, max_in_flight=None,
+          start=None, on_listed=None, descend=None, before_wait=None):
+    """Breadth-first listing of a container, listing up to `max_workers`
+    folders at a time.  Folder listings are only submitted while the
+    consumer keeps up, so a slow consumer applies backpressure to the crawl.
+
+    Args:
+        syn: Synapse connection
+        synid: Synapse id of project or folder
+        max_workers: Number of concurrent folder listings
+        max_in_flight: Maximum number of folder listings submitted but not
+                       yet consumed (defaults to twice `max_workers`)
+        start: (Synapse id, path) of the containers to list, to continue
+               an earlier crawl (defaults to `synid`)
+        on_listed: Function called with the Synapse id and the children
+                   headers of each listed container before its children
+                   are yielded
+        descend: Function called with the header of each sub folder, the
+                 folder is only listed if it returns True (defaults to
+                 listing every folder)
+        before_wait: Function called before waiting for folder listings
+
+    Yields:
+        dict - Entity header of each entity that isn't a folder, with the
+               Synapse id of its container as parentId and its path below
+               `synid` as path, like "folder/file.txt"
+    """
+    max_in_flight = max_workers * 2 if max_in_flight is None else max_in_flight
+    pending = collections.deque([(synid, "")] if start is None else start)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                parentid, path = pending.popleft()
+                in_flight[executor.submit(_list_children, syn,
+                                          parentid)] = parentid, path
+            if before_wait is not None:
+                before_wait()
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                parentid, path = in_flight.pop(future)
+                children = future.result()
+                for child in children:
+                    child['parentId'] = parentid
+                    child['path'] = (f"{path}/{child['name']}" if path
+                                     else child['name'])
+                if on_listed is not None:
+                    on_listed(parentid, children)
+                for child in children:
+                    if child['type'] != FOLDER_TYPE:
+                        yield child
+                    elif descend is None or descend(child):
+                        pending.append((child['id'], child['path']))
+
+
+def iter_subfolders(syn, synid):
+    """Lists the folders below a container without their other children
+
+    Args:
+        syn: Synapse connection
+        synid: Synapse id of project or folder
+
+    Yields:
+        dict - Entity header of each folder with the Synapse id of its
+               container as parentId
+    """
+    pending = collections.deque([synid])
+    while pending:
+        parentid = pending.popleft()
+        for child in syn.getChildren(parentid, includeTypes=['folder']):
+            if child['type'] == FOLDER_TYPE:
+                child['parentId'] = parentid
+                pending.append(child['id'])
+                yield child
+
+
+def _get_data_file_handle_id(syn, synid):
+    """Gets the file handle id of a file entity without its bundle"""
+    return synid, syn.restGET(f"/entity/{synid}")['dataFileHandleId']
+
+
+def _get_file_handle_md5s(syn, file_handles):
+    """Looks up the md5 of a batch of file handles in one request
+
+    Args:
+        syn: Synapse connection
+        file_handles: list of (entity id, file handle id)
+
+    Returns:
+        dict - {entity id: md5}
+    """
+    request = {
+        'requestedFiles': [
+            {'fileHandleId': file_handle_id,
+             'associateObjectId': synid,
+             'associateObjectType': 'FileEntity'}
+            for synid, file_handle_id in file_handles
+        ],
+        'includeFileHandles': True,
+        'includePreSignedURLs': False,
+        'includePreviewPreSignedURLs': False
+    }
+    response = syn.restPOST("/fileHandle/batch", body=json.dumps(request),
+                            endpoint=syn.fileHandleEndpoint)
+    synids = {file_handle_id: synid
+              for synid, file_handle_id in file_handles}
+    return {synids[result['fileHandleId']]:
+            result['fileHandle'].get('contentMd5', 'NA')
+            for result in response['requestedFiles']
+            if 'fileHandle' in result}
+
+
+def get_file_md5s(syn, synids, max_workers=DEFAULT_WORKERS,
+                  batch_size=FILE_HANDLE_BATCH_SIZE):
+    """Looks up the md5 of file entities without fetching each entity
+    bundle.  File handles are resolved `batch_size` at a time.
+
+    Args:
+        syn: Synapse connection
+        synids: Iterable of file entity Synapse ids
+        max_workers: Number of concurrent requests
+        batch_size: Number of file handles per request
+
+    Returns:
+        dict - {entity id: md5}, files without an md5 are left out
+    """
+    file_handles = _bounded_map(
+        lambda synid: _get_data_file_handle_id(syn, synid), synids,
+        max_workers, max_workers * 2
+    )
+    md5s = {}
+    batch = []
+    for file_handle in file_handles:
+        batch.append(file_handle)
+        if len(batch) == batch_size:
+            md5s.update(_get_file_handle_md5s(syn, batch))
+            batch = []
+    if batch:
+        md5s.update(_get_file_handle_md5s(syn, batch))
+    return md5s
+
+
+def _get_entity_header(syn, synid):
+    """Gets the header of an entity from its properties, None if it no
+    longer exists"""
+    from synapseclient.core.exceptions import SynapseHTTPError
+
+    try:
+        entity = syn.restGET(f"/entity/{synid}")
+    except SynapseHTTPError as error:
+        if getattr(error.response, 'status_code', None) == 404:
+            return synid, None
+        raise
+    header = {key: entity[key] for key in
+              ('id', 'name', 'versionNumber', 'modifiedOn', 'modifiedBy',
+               'parentId') if key in entity}
+    header['type'] = entity['concreteType']
+    return synid, header
+
+
+def get_entity_headers(syn, synids, max_workers=DEFAULT_WORKERS):
+    """Looks up entities concurrently, with their parent
+
+    Args:
+        syn: Synapse connection
+        synids: Iterable of Synapse ids
+        max_workers: Number of concurrent requests
+
+    Returns:
+        dict - {entity id: entity header with parentId}, deleted entities
+               are left out
+    """
+    return {
+        synid: header for synid, header in _bounded_map(
+            lambda synid: _get_entity_header(syn, synid), synids,
+            max_workers, max_workers * 2
+        ) if header is not None
+    }
+
+
+def _get_annotations(syn, synid):
+    """Gets the annotations of an entity, None if it no longer exists"""
+    from synapseclient.core.exceptions import SynapseHTTPError
+
+    try:
+        annotations = syn.restGET(f"/entity/{synid}/annotations2")
+    except SynapseHTTPError as error:
+        if getattr(error.response, 'status_code', None) == 404:
+            return synid, None
+        raise
+    return synid, annotations.get('annotations', {})
+
+
+def get_annotations(syn, synids, keys, max_workers=DEFAULT_WORKERS):
+    """Looks up annotations of entities concurrently
+
+    Args:
+        syn: Synapse connection
+        synids: Iterable of Synapse ids
+        keys: Annotation keys to look up
+        max_workers: Number of concurrent requests
+
+    Returns:
+        dict - {entity id: {key: first value or None}}, deleted entities
+               are left out
+    """
+    values = {}
+    for synid, annotations in _bounded_map(
+            lambda synid: _get_annotations(syn, synid), synids,
+            max_workers, max_workers * 2):
+        if annotations is None:
+            continue
+        values[synid] = {
+            key: (annotations[key].get('value') or [None])[0]
+            if key in annotations else None
+            for key in keys
+        }
+    return values
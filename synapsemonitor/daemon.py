@@ -0,0 +1,173 @@
+"""Long running monitoring daemon
+
+Keeps one Synapse session, principal cache and local state open and polls
+each project on its adaptive schedule.  SIGTERM and SIGINT stop new polls,
+let running polls finish and save the schedule before exiting.  Polls
+interrupted by a crash resume from their last checkpoint.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait
+import signal
+import threading
+import time
+
+from . import (crawler, governor, metrics, monitor, notify, principals,
+               scheduler, state)
+
+# Longest sleep between checks of the schedule and running polls
+TICK = 1.0
+
+
+def _poll_done(future, projectid, projects, userid, queue, principal_cache,
+               schedule, state_dir):
+    """Queues the notifications of a finished poll and reschedules the
+    project
+
+    Returns:
+        float - Unix time of the next poll of the project
+    """
+    try:
+        project_ent, report = future.result()
+    except Exception as error:
+        print(f'{projectid}: monitoring failed - {error!r}')
+        changes = None
+    else:
+        changes = sum(count for status, count in report.counts.items()
+                      if status != "Existing")
+        monitor.add_project_result(queue, projects[projectid] or [userid],
+                                   project_ent, report, principal_cache)
+    now = time.time()
+    next_run = schedule.reschedule(projectid, changes, now)
+    state.set_schedule(projectid, schedule.intervals[projectid], next_run,
+                       state_dir)
+    print(f'{projectid}: {"failed" if changes is None else changes} '
+          f'changes, next poll in {next_run - now:.0f} seconds')
+    return next_run
+
+
+def serve(projects, synapseconfig=None, userid=None,
+          email_subject="New Synapse Files", state_dir=None,
+          crawl_workers=crawler.DEFAULT_WORKERS,
+          project_workers=monitor.DEFAULT_PROJECT_WORKERS,
+          project_timeout=None, interval=scheduler.DEFAULT_INTERVAL,
+          min_interval=scheduler.DEFAULT_MIN_INTERVAL,
+          max_interval=scheduler.DEFAULT_MAX_INTERVAL,
+          jitter=scheduler.DEFAULT_JITTER, request_rate=None,
+          max_request_rate=governor.DEFAULT_MAX_RATE, sinks=None,
+          statuses=("New",), notify_window=notify.DEFAULT_WINDOW,
+          shards=1, dashboards=None, max_folder_age=0, entity_filters=None,
+          after_poll=None, stop_event=None):
+    """Monitors projects until stopped
+
+    Args:
+        projects: dict of {Synapse project id: list of recipient user ids}.
+                  Recipients default to `userid` if None.
+        synapseconfig: Synapse config file with user credentials
+        userid: User Id of individual to send report, defaults to current
+                user
+        email_subject: Subject heading of the email
+        state_dir: Directory of local state files
+        crawl_workers: Number of concurrent Synapse requests per project
+        project_workers: Number of projects polled at the same time
+        project_timeout: Seconds each project crawl may take
+        interval: Initial seconds between polls of a project
+        min_interval: Minimum seconds between polls of a project
+        max_interval: Maximum seconds between polls of a project
+        jitter: Fraction of the interval polls are moved at random
+        request_rate: Synapse requests per second all polls may make on
+                      average, unlimited if None
+        max_request_rate: Maximum Synapse requests per second
+        sinks: Notification sink configs for `notify.build_sinks`,
+               defaults to Synapse messages
+        statuses: Statuses of the entities to report
+        notify_window: Seconds the notifications of a recipient are
+                       coalesced before they are sent
+        shards: Number of tracking tables of each project
+        dashboards: {Synapse project id: dashboard config} of the projects
+                    with an activity dashboard
+        max_folder_age: Seconds a folder whose subtree showed no change
+                        may go without being listed, every folder is listed
+                        if 0
+        entity_filters: {Synapse project id: exclude and include rules} of
+                        the projects with entity filters
+        after_poll: Function called without arguments after each poll
+        stop_event: threading.Event that stops the daemon, SIGTERM and
+                    SIGINT set it when called from the main thread
+    """
+    stop_event = threading.Event() if stop_event is None else stop_event
+    previous_handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            previous_handlers[signum] = signal.signal(
+                signum, lambda signum, frame: stop_event.set()
+            )
+
+    try:
+        with metrics.span("login"):
+            syn = monitor._login(synapseconfig,
+                                 max_request_rate=max_request_rate)
+            principal_cache = principals.PrincipalCache(syn)
+            profile = principal_cache.get_profile()
+        userid = profile['ownerId'] if userid is None else userid
+        username = profile['userName']
+        schedule = scheduler.Scheduler(
+            projects, time.time(), interval=interval,
+            min_interval=min_interval, max_interval=max_interval,
+            jitter=jitter, saved=state.get_schedule(state_dir)
+        )
+        budget = (None if request_rate is None
+                  else scheduler.RequestBudget(request_rate))
+        queue = notify.NotificationQueue(notify.build_sinks(syn, sinks),
+                                         username, email_subject,
+                                         window=notify_window)
+        poll_args = (projects, userid, queue, principal_cache, schedule,
+                     state_dir)
+
+        running = {}
+        with queue, ThreadPoolExecutor(
+                max_workers=project_workers) as executor:
+            while not stop_event.is_set():
+                now = time.time()
+                if budget is not None:
+                    budget.update(metrics.METRICS.request_count(), now)
+                while (len(running) < project_workers and
+                       (budget is None or budget.available())):
+                    projectid = schedule.pop_due(now)
+                    if projectid is None:
+                        break
+                    future = executor.submit(
+                        monitor.monitor_project, syn, projectid,
+                        state_dir=state_dir, crawl_workers=crawl_workers,
+                        timeout=project_timeout, resume=True,
+                        statuses=statuses, shards=shards,
+                        dashboard_settings=(dashboards or {}).get(projectid),
+                        principal_cache=principal_cache,
+                        max_folder_age=max_folder_age,
+                        filter_settings=(entity_filters or {}).get(projectid)
+                    )
+                    running[future] = projectid
+
+                for future in [future for future in running
+                               if future.done()]:
+                    _poll_done(future, running.pop(future), *poll_args)
+                    if after_poll is not None:
+                        after_poll()
+
+                sleep = TICK
+                if len(running) < project_workers:
+                    due_in = schedule.next_due_in(time.time())
+                    if due_in is not None:
+                        sleep = min(sleep, due_in)
+                    if budget is not None:
+                        sleep = max(sleep, min(budget.wait_time(), TICK))
+                stop_event.wait(sleep)
+
+            if running:
+                print(f'Stopping, waiting for {len(running)} polls to finish')
+            wait(running)
+            for future, projectid in running.items():
+                _poll_done(future, projectid, *poll_args)
+            if running and after_poll is not None:
+                after_poll()
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
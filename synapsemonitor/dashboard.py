@@ -0,0 +1,169 @@
+"""Project activity dashboards
+
+Replaces wiki pages of `synapsetable` widgets, which run their GROUP BY
+queries on every page view, with static tables.  The changes of each run
+are counted in daily aggregates of the local state by contributor and by
+annotations like center, fileType and dataType, only looking up the
+annotations of the entities that changed.  The rolling weekly and
+monthly tables are rendered from the aggregates and the wiki page is only
+updated when they change.
+
+Dashboards are configured per project in the config file, i.e.
+
+    {"projects": [{"projectid": "syn123",
+                   "dashboard": {"owner": "syn123", "subpage": 396117,
+                                 "annotations": ["center", "fileType"]}}]}
+"""
+import hashlib
+import time
+
+from . import crawler, state
+
+DEFAULT_ANNOTATIONS = ["center", "fileType", "dataType"]
+# Title and days of each rolling window
+WINDOWS = [("Last 7 days", 7), ("Last 30 days", 30)]
+# Number of values listed per table
+DEFAULT_TOP = 5
+TITLE = "Project Activity"
+
+
+def update_activity(syn, snapshot, annotations=DEFAULT_ANNOTATIONS,
+                    crawl_workers=crawler.DEFAULT_WORKERS):
+    """Counts the queued changes of a project in its activity
+
+    Args:
+        syn: Synapse connection
+        snapshot: state.Snapshot of the project keeping its activity
+        annotations: Annotation keys counted
+        crawl_workers: Number of concurrent Synapse requests
+
+    Returns:
+        int - number of changes counted
+    """
+    now = int(time.time() * 1000)
+    snapshot.start_activity(now)
+    counted = 0
+    while True:
+        snapshot.commit()
+        changes = snapshot.get_activity_queue()
+        if not changes:
+            break
+        values = crawler.get_annotations(
+            syn, {change[0] for change in changes}, annotations,
+            max_workers=crawl_workers
+        ) if annotations else {}
+        snapshot.add_activity(
+            (change, dict(values.get(change[0], {}), event=change[2],
+                          contributor=change[3]))
+            for change in changes
+        )
+        counted += len(changes)
+    snapshot.prune_activity(now)
+    snapshot.commit()
+    return counted
+
+
+def _render_table(title, column, groups):
+    """Renders a markdown table of (label, count)"""
+    lines = [f"**{title}**", "", f"| {column} | Changes |", "| --- | ---: |"]
+    lines += [f"| {label} | {count} |" for label, count in groups]
+    return "\n".join(lines + [""])
+
+
+def render(snapshot, user_names, annotations=DEFAULT_ANNOTATIONS,
+           top=DEFAULT_TOP, now=None):
+    """Renders the dashboard of a project as wiki markdown
+
+    Args:
+        snapshot: state.Snapshot of the project keeping its activity
+        user_names: {principal id: user name} of the contributors
+        annotations: Annotation keys counted
+        top: Number of values listed per table
+        now: Unix epoch time in milliseconds, defaults to the current time
+
+    Returns:
+        str - markdown
+    """
+    now = int(time.time() * 1000) if now is None else now
+    sections = []
+    for title, days in WINDOWS:
+        since = now - (days - 1) * state.DAY
+        events = dict(snapshot.count_activity("event", since,
+                                              len(state.EVENTS)))
+        tables = [_render_table("Changes", "Event", [
+            (event, events.get(event, 0))
+            for event in ("New", "Updated", "Moved")
+        ])]
+        contributors = snapshot.count_activity("contributor", since, top)
+        tables.append(_render_table("Contributors", "Contributor", [
+            (user_names.get(userid, userid), count)
+            for userid, count in contributors
+        ]))
+        for annotation in annotations:
+            groups = snapshot.count_activity(annotation, since, top)
+            if groups:
+                tables.append(_render_table(annotation, annotation, groups))
+        sections.append(f"### {title}\n\n" + "\n".join(tables))
+    return "\n".join(sections)
+
+
+def publish(syn, owner, markdown, subpage=None):
+    """Replaces the markdown of a wiki page.  The root wiki page of
+    `owner` is created if it does not exist.
+
+    Args:
+        syn: Synapse connection
+        owner: Synapse id of the entity owning the wiki
+        markdown: Markdown of the page
+        subpage: Wiki page id, the root page if None
+    """
+    import synapseclient
+    from synapseclient.core.exceptions import SynapseHTTPError
+
+    try:
+        wiki = syn.getWiki(owner, subpageId=subpage)
+    except SynapseHTTPError as error:
+        if (subpage is not None or
+                getattr(error.response, 'status_code', None) != 404):
+            raise
+        wiki = synapseclient.Wiki(owner=owner, title=TITLE)
+    wiki.markdown = markdown
+    syn.store(wiki)
+
+
+def update(syn, snapshot, settings, principal_cache,
+           crawl_workers=crawler.DEFAULT_WORKERS):
+    """Updates the activity of a project and publishes its dashboard if
+    the tables changed since it was last published
+
+    Args:
+        syn: Synapse connection
+        snapshot: state.Snapshot of the project keeping its activity
+        settings: Dashboard config with the "owner" of the wiki (defaults
+                  to the project), its "subpage", the "annotations" counted
+                  and the "top" number of values listed
+        principal_cache: principals.PrincipalCache to resolve contributors
+        crawl_workers: Number of concurrent Synapse requests
+
+    Returns:
+        bool - whether the dashboard was published
+    """
+    annotations = settings.get("annotations", DEFAULT_ANNOTATIONS)
+    top = settings.get("top", DEFAULT_TOP)
+    update_activity(syn, snapshot, annotations=annotations,
+                    crawl_workers=crawl_workers)
+    now = int(time.time() * 1000)
+    user_names = principal_cache.get_user_names({
+        userid for _, days in WINDOWS for userid, _ in
+        snapshot.count_activity("contributor", now - (days - 1) * state.DAY,
+                                top)
+    })
+    markdown = render(snapshot, user_names, annotations=annotations, top=top,
+                      now=now)
+    digest = hashlib.sha256(markdown.encode()).hexdigest()
+    if digest == snapshot.get_dashboard_digest():
+        return False
+    publish(syn, settings.get("owner", snapshot.projectid), markdown,
+            subpage=settings.get("subpage"))
+    snapshot.set_dashboard_digest(digest)
+    return True
@@ -0,0 +1,206 @@
+"""Digest message rendering
+
+Messages are rendered from templates compiled once at import.  Each
+project section lists at most `max_rows` entities.  When more entities
+changed, the section summarizes them by folder, entity type and
+contributor and links to the full list, a compressed CSV file stored next
+to the tracking table.  Message size and rendering time are bounded
+however many entities changed.
+"""
+import collections
+import csv
+import gzip
+import html
+import itertools
+import string
+
+SYNAPSE_URL = "https://www.synapse.org/#!Synapse:"
+# Name of the file listing every changed entity of a project
+ATTACHMENT_NAME = "Project Monitoring Changes.csv.gz"
+ATTACHMENT_COLUMNS = ['status', 'id', 'name', 'type', 'parentid',
+                      'modifiedby']
+DEFAULT_MAX_ROWS = 100
+# Number of largest groups of each summary
+DEFAULT_MAX_GROUPS = 10
+# Summary title and state.Snapshot column of each summary
+SUMMARIES = [("Folder", "parentid"), ("Type", "type"),
+             ("Contributor", "modifiedby")]
+
+# Summaries and rows of one status of a project.  `rows` are (Synapse id,
+# name, contributor), `summaries` are {title: [(label, Synapse id or None,
+# count)]} and `attachment` is the Synapse id of the full list or None.
+ProjectDigest = collections.namedtuple(
+    "ProjectDigest",
+    ["projectid", "project_name", "status", "total", "rows", "summaries",
+     "attachment"]
+)
+
+_MESSAGE = string.Template("Hello $username,<br/><br/>$sections")
+_SECTION = string.Template(
+    "These are the $status synapse entities for synapse project: "
+    "$project<br/><br/>$summaries$table$more"
+)
+_LINK = string.Template("<a href='$url'>$label</a>")
+_TABLE = string.Template(
+    "<table border='1'><thead><tr>$header</tr></thead>"
+    "<tbody>$rows</tbody></table><br/><br/>"
+)
+_HEADER = string.Template("<th>$column</th>")
+_ROW = string.Template("<tr><td>$id</td><td>$name</td><td>$contributor</td>"
+                       "</tr>")
+_SUMMARY_ROW = string.Template("<tr><td>$label</td><td>$count</td></tr>")
+_MORE = string.Template("and $more more $status entities$listed<br/><br/>")
+_LISTED = string.Template(", all $total are listed in $attachment")
+
+
+def _link(synid, label=None):
+    """Links to a Synapse entity"""
+    return _LINK.substitute(
+        url=SYNAPSE_URL + html.escape(synid, quote=True),
+        label=html.escape(synid if label is None else label)
+    )
+
+
+def _render_table(columns, rows):
+    """Renders rows of already escaped cells"""
+    return _TABLE.substitute(
+        header="".join(_HEADER.substitute(column=column)
+                       for column in columns),
+        rows="".join(rows)
+    )
+
+
+def get_type_label(entity_type):
+    """Short name of an entity type, like "FileEntity" """
+    return "" if entity_type is None else entity_type.rsplit(".", 1)[-1]
+
+
+def label_summaries(summaries, folder_names, user_names):
+    """Labels summary groups for `render_section`
+
+    Args:
+        summaries: {title: [(value, count)]} with the SUMMARIES titles
+        folder_names: {Synapse id: folder name}
+        user_names: {principal id: user name}
+
+    Returns:
+        dict - {title: [(label, Synapse id or None, count)]}
+    """
+    labels = {
+        "Folder": lambda synid: (folder_names.get(synid, synid), synid),
+        "Type": lambda entity_type: (get_type_label(entity_type), None),
+        "Contributor": lambda userid: (user_names.get(userid, userid), None)
+    }
+    return {
+        title: [labels[title](value or "") + (count,)
+                for value, count in groups]
+        for title, groups in summaries.items()
+    }
+
+
+def merge(earlier, later, max_rows=DEFAULT_MAX_ROWS,
+          max_groups=DEFAULT_MAX_GROUPS):
+    """Merges two digests of the same project and status
+
+    Args:
+        earlier: ProjectDigest
+        later: ProjectDigest
+        max_rows: Maximum number of rows kept
+        max_groups: Maximum number of groups kept per summary
+
+    Returns:
+        ProjectDigest - digest with the totals, rows and summaries of both
+    """
+    later_ids = {row[0] for row in later.rows}
+    rows = [row for row in earlier.rows if row[0] not in later_ids]
+    summaries = {}
+    for title in dict.fromkeys(itertools.chain(earlier.summaries,
+                                               later.summaries)):
+        counts = collections.Counter()
+        for label, synid, count in itertools.chain(
+                earlier.summaries.get(title, []),
+                later.summaries.get(title, [])):
+            counts[label, synid] += count
+        summaries[title] = [(label, synid, count) for (label, synid), count
+                            in counts.most_common(max_groups)]
+    return later._replace(
+        total=earlier.total + later.total,
+        rows=(rows + list(later.rows))[:max_rows],
+        summaries=summaries,
+        attachment=later.attachment or earlier.attachment
+    )
+
+
+def render_section(project_digest):
+    """Renders the section of a project
+
+    Args:
+        project_digest: ProjectDigest
+
+    Returns:
+        str - HTML section
+    """
+    status = project_digest.status.lower()
+    summaries = "".join(
+        _render_table([title, "count"], (
+            _SUMMARY_ROW.substitute(
+                label=(html.escape(label) if synid is None
+                       else _link(synid, label)),
+                count=count
+            )
+            for label, synid, count in groups
+        ))
+        for title, groups in project_digest.summaries.items() if groups
+    )
+    table = _render_table(["id", "name", "contributor"], (
+        _ROW.substitute(id=_link(synid), name=html.escape(name),
+                        contributor=html.escape(contributor or ""))
+        for synid, name, contributor in project_digest.rows
+    ))
+    more = ""
+    if project_digest.total > len(project_digest.rows):
+        listed = ""
+        if project_digest.attachment is not None:
+            listed = _LISTED.substitute(
+                total=project_digest.total,
+                attachment=_link(project_digest.attachment, ATTACHMENT_NAME)
+            )
+        more = _MORE.substitute(
+            more=project_digest.total - len(project_digest.rows),
+            status=status, listed=listed
+        )
+    return _SECTION.substitute(
+        status=status,
+        project=_link(project_digest.projectid, project_digest.project_name),
+        summaries=summaries, table=table, more=more
+    )
+
+
+def render_message(username, project_digests):
+    """Renders one message covering several projects
+
+    Args:
+        username: Synapse user name to greet
+        project_digests: Iterable of ProjectDigest
+
+    Returns:
+        str - HTML message
+    """
+    return _MESSAGE.substitute(
+        username=html.escape(username),
+        sections="".join(map(render_section, project_digests))
+    )
+
+
+def write_attachment(rows, path):
+    """Writes changed entities as a compressed CSV file
+
+    Args:
+        rows: Iterable of rows with ATTACHMENT_COLUMNS
+        path: Path of the file
+    """
+    with gzip.open(path, "wt", newline="") as attachment:
+        writer = csv.writer(attachment)
+        writer.writerow(ATTACHMENT_COLUMNS)
+        writer.writerows(rows)
+
@@ -0,0 +1,255 @@
+"""Entity filters evaluated during the crawl
+
+Filters are rules of conditions on the path of an entity in its project,
+its name, its type and its annotations, i.e.
+
+    {"exclude": [{"path": "scratch/**"},
+                 {"name_regex": "^\\\\."},
+                 {"type": ["link", "entityview"]}],
+     "include": [{"name": "*.bam", "annotations": {"assay": "rnaSeq"}}]}
+
+A rule matches an entity when all of its conditions do.  An entity is
+excluded when any exclude rule matches it or, if there are include rules,
+when no include rule does.  Folders matching an exclude rule are not
+listed at all, include rules and annotations only apply to the entities
+that are not folders.
+
+Paths and names are matched with globs, where `*` matches within a folder,
+`**` across folders and a trailing `/**` also matches the folder itself, or
+with regular expressions.  Types are the short names of the concrete types
+like "file", "folder", "table" or "entityview".  Changing an annotation
+changes the entity, so annotations are only looked up for entities that
+changed since they were tracked or excluded by the same rules.
+"""
+import functools
+import hashlib
+import json
+import re
+
+from . import crawler, pipeline
+
+# Keys of the conditions of a rule
+RULE_KEYS = {"path", "path_regex", "name", "name_regex", "type",
+             "annotations"}
+
+
+@functools.lru_cache(maxsize=None)
+def type_name(concrete_type):
+    """Short name of a concrete entity type, "file" for
+    "org.sagebionetworks.repo.model.FileEntity" """
+    name = concrete_type.rsplit(".", 1)[-1].lower()
+    if name.endswith("entity") and name != "entity":
+        name = name[:-len("entity")]
+    return name
+
+
+def compile_glob(pattern):
+    """Compiles a glob where `*` does not match "/" and `**` does
+
+    Args:
+        pattern: Glob of paths like "data/**/*.csv"
+
+    Returns:
+        re.Pattern - pattern of the whole path
+    """
+    regex = ""
+    index = 0
+    if pattern.endswith("/**"):
+        pattern, suffix = pattern[:-len("/**")], "(/.*)?"
+    else:
+        suffix = ""
+    while index < len(pattern):
+        if pattern.startswith("**/", index):
+            regex += "(.*/)?"
+            index += 3
+        elif pattern.startswith("**", index):
+            regex += ".*"
+            index += 2
+        elif pattern[index] == "*":
+            regex += "[^/]*"
+            index += 1
+        elif pattern[index] == "?":
+            regex += "[^/]"
+            index += 1
+        else:
+            regex += re.escape(pattern[index])
+            index += 1
+    return re.compile(regex + suffix + r"\Z")
+
+
+class Rule:
+    """Compiled filter rule
+
+    Args:
+        rule: dict of conditions, see the module docstring
+    """
+    def __init__(self, rule):
+        unknown = set(rule) - RULE_KEYS
+        if unknown:
+            raise ValueError(f"Unknown filter conditions {sorted(unknown)}")
+        self.patterns = []
+        for key in ("path", "name"):
+            if key in rule:
+                self.patterns.append((key, compile_glob(rule[key]).match))
+            if f"{key}_regex" in rule:
+                self.patterns.append(
+                    (key, re.compile(rule[f"{key}_regex"]).search)
+                )
+        types = rule.get("type")
+        types = [types] if isinstance(types, str) else types
+        self.types = None if types is None else {
+            type_name(entity_type) for entity_type in types
+        }
+        self.annotations = {
+            key: {str(value) for value in
+                  (values if isinstance(values, list) else [values])}
+            for key, values in rule.get("annotations", {}).items()
+        }
+
+    def matches(self, header, annotations=None):
+        """Whether an entity matches the rule
+
+        Args:
+            header: Entity header with its path
+            annotations: {key: value} of the annotations of the rule, the
+                         annotation conditions are not checked if None
+
+        Returns:
+            bool - whether the entity matches
+        """
+        if (self.types is not None and
+                type_name(header['type']) not in self.types):
+            return False
+        for key, match in self.patterns:
+            if not match(header[key]):
+                return False
+        if annotations is None:
+            return True
+        return all(str(annotations.get(key)) in values
+                   for key, values in self.annotations.items())
+
+
+class EntityFilter:
+    """Exclude and include rules of a project
+
+    Args:
+        exclude: Iterable of exclude rule dicts
+        include: Iterable of include rule dicts
+    """
+    def __init__(self, exclude=(), include=()):
+        exclude, include = list(exclude), list(include)
+        # Entities excluded by their annotations are kept with this digest
+        self.digest = hashlib.sha256(json.dumps(
+            [exclude, include], sort_keys=True
+        ).encode()).hexdigest()
+        self.exclude = [Rule(rule) for rule in exclude]
+        self.include = [Rule(rule) for rule in include]
+        # Folders are only excluded by rules without annotations
+        self.folder_exclude = [rule for rule in self.exclude
+                               if not rule.annotations]
+        self.annotation_keys = sorted({
+            key for rule in self.exclude + self.include
+            for key in rule.annotations
+        })
+
+    @classmethod
+    def from_settings(cls, settings=None, exclude=()):
+        """Builds the filter of a project config
+
+        Args:
+            settings: dict with "exclude" and "include" rule lists, or None
+            exclude: Exclude rules added to the config
+
+        Returns:
+            EntityFilter
+        """
+        settings = settings or {}
+        return cls(exclude=list(exclude) + settings.get("exclude", []),
+                   include=settings.get("include", []))
+
+    def lists(self, header):
+        """Whether to list a folder, False if an exclude rule matches it"""
+        return not any(rule.matches(header) for rule in self.folder_exclude)
+
+    def includes(self, header, annotations=None):
+        """Whether to track an entity that is not a folder
+
+        Args:
+            header: Entity header with its path
+            annotations: {key: value} of the annotations of the rules.  If
+                         None, exclude rules with annotations do not match
+                         and the annotations of include rules do, like for
+                         an entity that was included when it was tracked.
+
+        Returns:
+            bool - whether the entity is included
+        """
+        exclude = self.folder_exclude if annotations is None else \
+            self.exclude
+        if any(rule.matches(header, annotations) for rule in exclude):
+            return False
+        return not self.include or any(rule.matches(header, annotations)
+                                       for rule in self.include)
+
+    def iter_included(self, syn, headers, snapshot=None,
+                      chunk_size=pipeline.DEFAULT_CHUNK_SIZE,
+                      crawl_workers=crawler.DEFAULT_WORKERS):
+        """Filters entity headers a chunk at a time, looking up the
+        annotations the rules need of the entities that changed since they
+        were tracked or excluded.  Excluded entities are marked as crawled
+        in the snapshot, so that their tracked rows are kept.
+
+        Args:
+            syn: Synapse connection
+            headers: Iterable of entity headers with their path
+            snapshot: state.Snapshot of the project or None
+            chunk_size: Number of entities filtered at a time
+            crawl_workers: Number of concurrent Synapse requests
+
+        Yields:
+            dict - header of each included entity
+        """
+        for chunk in pipeline.iter_chunks(headers, chunk_size):
+            included = [header for header in chunk if self.includes(header)]
+            if self.annotation_keys and included:
+                included = self._filter_annotations(syn, included, snapshot,
+                                                     crawl_workers)
+            if snapshot is not None and len(included) < len(chunk):
+                kept = {header['id'] for header in included}
+                snapshot.mark_seen([header['id'] for header in chunk
+                                    if header['id'] not in kept])
+            yield from included
+
+    def _filter_annotations(self, syn, headers, snapshot, crawl_workers):
+        """Filters entity headers by the rules with annotations"""
+        synids = [header['id'] for header in headers]
+        tracked_rows, filtered = {}, {}
+        if snapshot is not None:
+            tracked_rows = snapshot.lookup(synids)
+            filtered = snapshot.get_filtered(synids, self.digest)
+            snapshot.commit()
+        fingerprints = {header['id']: crawler.get_fingerprint(header)
+                        for header in headers}
+        # Unchanged entities are still included or excluded
+        excluded = {synid for synid, fingerprint in filtered.items()
+                    if fingerprints[synid] == fingerprint}
+        to_lookup = {
+            synid for synid in synids if synid not in excluded and
+            getattr(tracked_rows.get(synid), 'fingerprint', None) !=
+            fingerprints[synid]
+        }
+        values = crawler.get_annotations(syn, to_lookup,
+                                         self.annotation_keys,
+                                         max_workers=crawl_workers)
+        for header in headers:
+            synid = header['id']
+            if synid in values and not self.includes(header, values[synid]):
+                excluded.add(synid)
+        if snapshot is not None:
+            snapshot.set_filtered({synid: fingerprints[synid]
+                                   for synid in excluded
+                                   if filtered.get(synid) !=
+                                   fingerprints[synid]}, self.digest)
+        return [header for header in headers
+                if header['id'] not in excluded and
+                (header['id'] in values or header['id'] not in to_lookup)]
@@ -0,0 +1,247 @@
+"""Synapse request governor
+
+Every Synapse REST call of a connection goes through one governor shared
+by all worker threads:
+
+- a token bucket limits the request rate.  The rate halves whenever
+  Synapse throttles and creeps back up with each successful request, so
+  it settles just under the server's limit.
+- throttled and failed requests are retried with exponential backoff and
+  full jitter, waiting at least as long as Synapse's Retry-After.
+  Throttling pauses every thread, not only the one that was throttled.
+- a circuit breaker fails calls fast after repeated consecutive failures
+  and lets one trial call through after a cool down.
+
+Only REST calls are governed.  Data sent to and from file storage, like
+the upload of a tracking table update or a change list, goes through the
+storage session of the client with the client's own retries.  The REST
+calls that set up these transfers, like creating file handles, are
+governed.
+"""
+import email.utils
+import random
+import threading
+import time
+
+from . import metrics
+
+DEFAULT_MAX_RATE = 50.0
+DEFAULT_MIN_RATE = 1.0
+# Requests per second added to the rate after each successful request
+RATE_INCREASE = 0.1
+DEFAULT_MAX_RETRIES = 8
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+DEFAULT_FAILURE_THRESHOLD = 10
+DEFAULT_RESET_TIMEOUT = 30.0
+THROTTLE_STATUS_CODES = {429, 503}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Names of the requests exceptions of failures worth retrying
+RETRY_EXCEPTIONS = ("ConnectionError", "Timeout", "ChunkedEncodingError")
+
+
+class CircuitOpenError(Exception):
+    """Synapse calls are failing fast after repeated failures"""
+
+
+class TokenBucket:
+    """Thread safe token bucket whose rate adapts to throttling
+
+    Args:
+        max_rate: Maximum requests per second
+        min_rate: Minimum requests per second
+        burst: Maximum number of requests saved up, defaults to a second
+               of requests at the maximum rate
+    """
+    def __init__(self, max_rate=DEFAULT_MAX_RATE, min_rate=DEFAULT_MIN_RATE,
+                 burst=None):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.burst = max(max_rate if burst is None else burst, 1)
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Waits for a token"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.tokens + (now - self._updated) * self.rate,
+                    self.burst
+                )
+                self._updated = now
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def throttled(self, pause=0.0):
+        """Halves the rate and pauses every request for `pause` seconds.
+        Requests throttled during a pause were sent at the rate that was
+        already halved, so they do not halve it again."""
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._paused_until:
+                self.rate = max(self.rate / 2, self.min_rate)
+            self.tokens = min(self.tokens, 0)
+            self._paused_until = max(self._paused_until, now + pause)
+
+    def succeeded(self):
+        """Raises the rate towards the maximum rate"""
+        with self._lock:
+            self.rate = min(self.rate + RATE_INCREASE, self.max_rate)
+
+
+class CircuitBreaker:
+    """Fails calls fast after `failure_threshold` consecutive failures until
+    `reset_timeout` seconds have passed, then lets one trial call through
+
+    Args:
+        failure_threshold: Consecutive failures that open the circuit
+        reset_timeout: Seconds the circuit stays open
+    """
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Raises CircuitOpenError if calls should fail fast"""
+        with self._lock:
+            if self._opened is None:
+                return
+            if (time.monotonic() - self._opened < self.reset_timeout or
+                    self._trial):
+                raise CircuitOpenError(
+                    f"Synapse calls failed {self.failures} times in a row"
+                )
+            self._trial = True
+
+    def record_success(self):
+        """Closes the circuit"""
+        with self._lock:
+            self.failures = 0
+            self._opened = None
+            self._trial = False
+
+    def record_failure(self):
+        """Counts a failure, opening the circuit after too many"""
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self._opened = time.monotonic()
+                self._trial = False
+
+
+def _get_retry_after(response):
+    """Seconds to wait from a Retry-After header, None if there is none"""
+    value = None if response is None else response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(date.timestamp() - time.time(), 0.0)
+
+
+class Governor:
+    """Rate limits, retries and guards Synapse calls
+
+    Args:
+        bucket: TokenBucket shared by all calls
+        breaker: CircuitBreaker shared by all calls
+        max_retries: Maximum number of retries per call
+        base_delay: Seconds before the first retry
+        max_delay: Maximum seconds between retries
+    """
+    def __init__(self, bucket=None, breaker=None,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.bucket = TokenBucket() if bucket is None else bucket
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def call(self, func, *args, **kwargs):
+        """Calls `func`, retrying throttled and failed calls
+
+        Returns:
+            The return value of `func`
+        """
+        # Loaded with synapseclient by the time Synapse is called
+        import requests
+
+        retry_exceptions = tuple(getattr(requests.exceptions, name)
+                                 for name in RETRY_EXCEPTIONS)
+        attempt = 0
+        while True:
+            self.breaker.check()
+            self.bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except requests.exceptions.RequestException as error:
+                response = error.response
+                status = getattr(response, 'status_code', None)
+                if (status not in RETRY_STATUS_CODES and
+                        not isinstance(error, retry_exceptions)):
+                    if response is not None:
+                        # Synapse answered, the request itself is wrong
+                        self.breaker.record_success()
+                    raise
+                if status != 429:
+                    # Throttling is not a failure of Synapse
+                    self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.base_delay * self._jitter(attempt)
+                retry_after = _get_retry_after(response)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                if status in THROTTLE_STATUS_CODES:
+                    self.bucket.throttled(pause=delay)
+                metrics.METRICS.add_retry()
+                attempt += 1
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                self.bucket.succeeded()
+                return result
+
+    def _jitter(self, attempt):
+        """Full jitter multiple of the base delay for a retry"""
+        return random.uniform(0, min(2 ** attempt,
+                                     self.max_delay / self.base_delay))
+
+
+def govern(syn, governor):
+    """Sends every REST call of a Synapse connection through a governor.
+    The Synapse client's own retries are turned off so that the governor
+    decides when to retry.  File storage transfers on the storage session
+    are not governed.
+
+    Args:
+        syn: Synapse connection
+        governor: Governor
+    """
+    rest_call = syn._rest_call
+
+    def governed_rest_call(method, uri, data, endpoint, headers, retryPolicy,
+                           requests_session, **kwargs):
+        retryPolicy = dict(retryPolicy or {}, retries=0)
+        return governor.call(rest_call, method, uri, data, endpoint, headers,
+                             retryPolicy, requests_session, **kwargs)
+    syn._rest_call = governed_rest_call
@@ -0,0 +1,93 @@
+"""Change history summaries
+
+Summarizes the change history the monitor keeps in the local state, i.e.
+
+    synapsemonitor history syn123 --since 7d --by day
+
+counts the new, updated and deleted entities of each of the last seven
+days without querying Synapse.
+"""
+import datetime
+import re
+
+from . import state
+
+_DURATION = re.compile(r"^(\d+(?:\.\d+)?)([hdw])$")
+_DURATION_UNITS = {"h": "hours", "d": "days", "w": "weeks"}
+
+
+def parse_time(value, now=None):
+    """Parses a time of the command line
+
+    Args:
+        value: Duration before now like "12h", "7d" or "2w", or an ISO
+               date or date and time like "2020-01-31", UTC if no time zone
+               is given
+        now: datetime.datetime durations are relative to, defaults to the
+             current time
+
+    Returns:
+        int - Unix epoch time in milliseconds
+    """
+    match = _DURATION.match(value)
+    if match is not None:
+        now = datetime.datetime.now(datetime.timezone.utc) if now is None \
+            else now
+        moment = now - datetime.timedelta(
+            **{_DURATION_UNITS[match.group(2)]: float(match.group(1))}
+        )
+    else:
+        try:
+            moment = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Invalid time {value}, expected a duration "
+                             "like 7d or an ISO date") from None
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def format_time(timestamp):
+    """Formats Unix epoch milliseconds as an ISO UTC time"""
+    return datetime.datetime.fromtimestamp(
+        timestamp / 1000, datetime.timezone.utc
+    ).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def format_counts(counts, by):
+    """Formats `state.count_events` as a text table with a total row
+
+    Args:
+        counts: {group: {event type: count}}
+        by: Grouping of the counts
+
+    Returns:
+        str - table of the counts of each event type per group
+    """
+    if by == "event":
+        rows = [[group, str(sum(events.values()))]
+                for group, events in counts.items()]
+        header = ["event", "count"]
+    else:
+        header = [by] + list(state.EVENTS)
+        rows = [["unknown" if group is None else str(group)] +
+                [str(events.get(event, 0)) for event in state.EVENTS]
+                for group, events in counts.items()]
+    totals = [sum(int(row[column]) for row in rows)
+              for column in range(1, len(header))]
+    rows.append(["total"] + [str(total) for total in totals])
+    widths = [max(len(row[column]) for row in [header] + rows)
+              for column in range(len(header))]
+    return "\n".join(
+        "  ".join([row[0].ljust(widths[0])] +
+                  [cell.rjust(width)
+                   for cell, width in zip(row[1:], widths[1:])])
+        for row in [header] + rows
+    )
+
+
+def format_events(events):
+    """Formats `state.iter_events` one event per line"""
+    for event in events:
+        yield (f"{format_time(event.time)}  {event.projectid}  "
+               f"{event.event:<7}  {event.id}  {event.actor or ''}").rstrip()
@@ -0,0 +1,297 @@
+"""Run instrumentation
+
+Phase spans, Synapse REST calls by endpoint, bytes transferred, retries,
+cache hits and misses and entity counts are accumulated in a process wide
+registry that can be written as JSON lines, as a Prometheus textfile or
+printed as a summary.
+
+Measurements accumulate from the start of the process, which is a single
+run for `synapsemonitor run` and every poll so far for `synapsemonitor
+serve`, so they are exported to Prometheus as counters.
+
+Phases nest: time spent in a nested phase only counts for the nested
+phase.  Projects monitored at the same time each add their own phase time,
+so phase seconds can add up to more than the run took.
+"""
+import collections
+import contextlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+
+_ID_PATTERN = re.compile(r"/(syn)?\d+(\.\d+)?(?=/|$)")
+_API_PREFIX = re.compile(r"^/(repo|file|auth)/v1")
+
+
+class Metrics:
+    """Thread safe instrumentation of a monitoring run"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Clears all measurements and starts a new run"""
+        with self._lock:
+            self.started = time.time()
+            self._start = time.perf_counter()
+            self.phases = collections.Counter()
+            self.requests = collections.Counter()
+            self.bytes = collections.Counter()
+            self.retries = 0
+            self.cache_hits = collections.Counter()
+            self.cache_misses = collections.Counter()
+            self.entities = collections.Counter()
+
+    @contextlib.contextmanager
+    def span(self, phase):
+        """Times a phase"""
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.phases[phase] += elapsed - nested
+
+    def iter_span(self, phase, iterable):
+        """Times the iteration of an iterable as a phase"""
+        iterator = iter(iterable)
+        while True:
+            with self.span(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_request(self, endpoint, sent=0, received=0):
+        """Counts a Synapse REST call
+
+        Args:
+            endpoint: "{method} {path}" with ids replaced by {id}
+            sent: Bytes sent
+            received: Bytes received
+        """
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.bytes['sent'] += sent
+            self.bytes['received'] += received
+
+    def request_count(self):
+        """Number of Synapse REST calls made"""
+        with self._lock:
+            return sum(self.requests.values())
+
+    def add_retry(self):
+        """Counts a retried request"""
+        with self._lock:
+            self.retries += 1
+
+    def add_cache_lookup(self, cache, hit):
+        """Counts a cache hit or miss
+
+        Args:
+            cache: Name of the cache, like "principals"
+            hit: Whether the value was cached
+        """
+        with self._lock:
+            (self.cache_hits if hit else self.cache_misses)[cache] += 1
+
+    def add_entities(self, counts):
+        """Adds numbers of classified entities by status"""
+        with self._lock:
+            self.entities.update(counts)
+
+    def summary(self):
+        """Measurements of the run so far
+
+        Returns:
+            dict - JSON serializable measurements
+        """
+        with self._lock:
+            seconds = time.perf_counter() - self._start
+            crawled = sum(count for status, count in self.entities.items()
+                          if status != "Deleted")
+            return {
+                'started': self.started,
+                'seconds': seconds,
+                'phases': dict(self.phases),
+                'requests': dict(self.requests),
+                'bytes': dict(self.bytes),
+                'retries': self.retries,
+                'cache_hits': dict(self.cache_hits),
+                'cache_misses': dict(self.cache_misses),
+                'entities': dict(self.entities),
+                'entities_per_second': crawled / seconds if seconds else 0.0
+            }
+
+
+def get_endpoint(method, url):
+    """Names the endpoint of a request URL, like "GET /entity/{id}"
+
+    Args:
+        method: HTTP method
+        url: Request URL
+
+    Returns:
+        str - endpoint
+    """
+    path = _API_PREFIX.sub("", urllib.parse.urlsplit(url).path)
+    return f"{method.upper()} {_ID_PATTERN.sub('/{id}', path)}"
+
+
+def _get_length(headers):
+    return int(headers.get('Content-Length') or 0)
+
+
+def instrument(syn, metrics=None):
+    """Counts the HTTP requests of a Synapse connection
+
+    Args:
+        syn: Synapse connection
+        metrics: Metrics to count in, defaults to the process wide metrics
+    """
+    metrics = METRICS if metrics is None else metrics
+
+    def count_response(response, *args, **kwargs):
+        request = response.request
+        body = request.body or b""
+        metrics.add_request(
+            get_endpoint(request.method, request.url),
+            sent=len(body) if isinstance(body, (bytes, str)) else 0,
+            # Reading the content would load streamed downloads in memory
+            received=_get_length(response.headers)
+        )
+    for name in ("_requests_session", "_requests_session_storage"):
+        session = getattr(syn, name, None)
+        if session is not None and hasattr(session, "hooks"):
+            session.hooks['response'].append(count_response)
+
+
+def write_json(summary, path):
+    """Appends a run summary to a JSON lines file"""
+    with open(path, "a") as json_file:
+        json_file.write(json.dumps(summary) + "\n")
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def to_prometheus(summary):
+    """Formats a run summary in the Prometheus text format.  Totals are
+    counters since the monitor started, they reset when it restarts.
+
+    Args:
+        summary: Metrics.summary()
+
+    Returns:
+        str - Prometheus text exposition
+    """
+    metrics = [
+        ("phase_seconds_total", "counter",
+         "Seconds spent in each phase since the monitor started",
+         "phase", summary['phases']),
+        ("requests_total", "counter",
+         "Synapse REST calls by endpoint since the monitor started",
+         "endpoint", summary['requests']),
+        ("bytes_total", "counter",
+         "Bytes transferred since the monitor started",
+         "direction", summary['bytes']),
+        ("cache_hits_total", "counter",
+         "Cache hits by cache since the monitor started",
+         "cache", summary['cache_hits']),
+        ("cache_misses_total", "counter",
+         "Cache misses by cache since the monitor started",
+         "cache", summary['cache_misses']),
+        ("entities_total", "counter",
+         "Entities classified by status since the monitor started",
+         "status", summary['entities']),
+        ("retries_total", "counter",
+         "Retried Synapse REST calls since the monitor started",
+         None, summary['retries']),
+        ("run_seconds", "gauge", "Seconds the monitor has been running",
+         None, summary['seconds']),
+        ("entities_per_second", "gauge",
+         "Entities crawled per second since the monitor started",
+         None, summary['entities_per_second']),
+        ("start_time_seconds", "gauge", "Unix time the monitor started",
+         None, summary['started'])
+    ]
+    lines = []
+    for name, metric_type, description, label, values in metrics:
+        name = f"synapsemonitor_{name}"
+        lines += [f"# HELP {name} {description}",
+                  f"# TYPE {name} {metric_type}"]
+        if label is None:
+            lines.append(f"{name} {values}")
+            continue
+        for key, value in sorted(values.items()):
+            lines.append(f'{name}{{{label}="{_escape(key)}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(summary, path):
+    """Writes a run summary as a Prometheus textfile.  The file is replaced
+    atomically so that collectors never read a partial file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(handle, "w") as prom_file:
+        prom_file.write(to_prometheus(summary))
+    os.replace(temp_path, path)
+
+
+def format_summary(summary):
+    """Formats a run summary as a table
+
+    Args:
+        summary: Metrics.summary()
+
+    Returns:
+        str - summary table
+    """
+    seconds = summary['seconds']
+    lines = [f"{'phase':<50} {'seconds':>10} {'share':>7}"]
+    for phase, phase_seconds in sorted(summary['phases'].items(),
+                                       key=lambda item: -item[1]):
+        share = phase_seconds / seconds if seconds else 0.0
+        lines.append(f"{phase:<50} {phase_seconds:>10.3f} {share:>7.1%}")
+    lines += ["", f"{'endpoint':<50} {'calls':>10}"]
+    for endpoint, calls in sorted(summary['requests'].items(),
+                                  key=lambda item: -item[1]):
+        lines.append(f"{endpoint:<50} {calls:>10}")
+    caches = sorted(set(summary['cache_hits']) | set(summary['cache_misses']))
+    if caches:
+        lines += ["", f"{'cache':<50} {'hits':>10} {'misses':>7}"]
+    for cache in caches:
+        lines.append(f"{cache:<50} {summary['cache_hits'].get(cache, 0):>10} "
+                     f"{summary['cache_misses'].get(cache, 0):>7}")
+    lines += [
+        "",
+        f"run seconds: {seconds:.3f}",
+        f"requests: {sum(summary['requests'].values())}, "
+        f"retries: {summary['retries']}",
+        f"bytes sent: {summary['bytes'].get('sent', 0)}, "
+        f"received: {summary['bytes'].get('received', 0)}",
+        "entities: " + ", ".join(f"{count} {status}" for status, count
+                                 in sorted(summary['entities'].items())),
+        f"entities per second: {summary['entities_per_second']:.1f}"
+    ]
+    return "\n".join(lines)
+
+
+# Process wide metrics
+METRICS = Metrics()
+span = METRICS.span
+iter_span = METRICS.iter_span
@@ -1,121 +1,818 @@
-"""Monitor module"""
-import pandas as pd
-import synapseclient
-from synapsegenie import bootstrap, input_to_database, process_functions
-
-
-def create_tracking_table(syn, parent):
-    """Set up the table that will track project entities"""
-    status_table_col_defs = [
-        {'name': 'id',
-         'columnType': 'ENTITYID'},
-        {'name': 'md5',
-         'columnType': 'STRING',
-         'maximumSize': 1000},
-        {'name': 'name',
-         'columnType': 'STRING',
-         'maximumSize': 1000},
-        {'name': 'modifiedon',
-         'columnType': 'DATE'}
-    ]
-    return bootstrap._create_table(syn, name="Project Monitoring",
-                                   col_config=status_table_col_defs,
-                                   parent=parent)
-
-
-def check_entity(entity, tracking_table):
-    """Checks entity with tracking table
-
-    Args:
-        tracking_table: Tracking Synapse Table query result
-        entity: Synapse Entity
+"""Monitor module
+
+synapseclient is imported when it is first used so that the command line
+starts without loading it.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+import itertools
+import json
+import os
+import re
+import tempfile
+import time
+
+from . import (crawler, dashboard, digest, filters, governor, metrics,
+               notify, pipeline, principals, records, state, writer)
+
+# Allowance for clock skew between this machine and Synapse
+WATERMARK_SKEW = 5 * 60 * 1000
+DEFAULT_PROJECT_WORKERS = 6
+# Maximum number of entity ids per tracking table query
+QUERY_BATCH_SIZE = 500
+TRACKING_TABLE_NAME = "Project Monitoring"
+# Names of the tracking tables of every shard layout
+TRACKING_TABLE_PATTERN = re.compile(
+    rf"^{TRACKING_TABLE_NAME}( \d+ of \d+)?$"
+)
+# Filter rules of the entities the monitor stores in projects, which are
+# not tracked
+MONITORING_EXCLUDE = [
+    {'type': 'table', 'name_regex': TRACKING_TABLE_PATTERN.pattern},
+    {'type': 'file', 'name': digest.ATTACHMENT_NAME}
+]
+# Column definitions of the tracking tables, in writer.TRACKING_COLUMNS order
+TRACKING_TABLE_COLUMNS = [
+    {'name': 'id',
+     'columnType': 'ENTITYID'},
+    {'name': 'md5',
+     'columnType': 'STRING',
+     'maximumSize': 1000},
+    {'name': 'name',
+     'columnType': 'STRING',
+     'maximumSize': 1000},
+    {'name': 'modifiedon',
+     'columnType': 'DATE'},
+    {'name': 'fingerprint',
+     'columnType': 'STRING',
+     'maximumSize': 100},
+    {'name': 'parentid',
+     'columnType': 'ENTITYID'}
+]
+
+
+def get_tracking_table_name(shard, shards):
+    """Name of the tracking table of a shard, "Project Monitoring 1 of 4".
+    Unsharded projects keep a single "Project Monitoring" table."""
+    if shards == 1:
+        return TRACKING_TABLE_NAME
+    return f"{TRACKING_TABLE_NAME} {shard + 1} of {shards}"
+
+
+def create_tracking_table(syn, parent, name=TRACKING_TABLE_NAME):
+    """Set up the table that will track project entities, storing a table
+    schema of the same name gets the existing table"""
+    import synapseclient
+
+    schema = synapseclient.Schema(
+        name=name, parent=parent,
+        columns=[synapseclient.Column(**col) for col in TRACKING_TABLE_COLUMNS]
+    )
+    return syn.store(schema)
+
+
+def _add_tracking_columns(syn, tableid, columns):
+    """Adds tracking columns to a tracking table created by an earlier
+    version
+
+    Args:
+        syn: Synapse connection
+        tableid: Synapse id of the tracking table
+        columns: Names of the missing tracking columns
+    """
+    import synapseclient
+
+    schema = syn.get(tableid)
+    for col in TRACKING_TABLE_COLUMNS:
+        if col['name'] in columns:
+            schema.addColumn(synapseclient.Column(**col))
+    syn.store(schema)
+
+
+def get_tracking_tables(syn, projectid, shards=1, create=True):
+    """Gets the tracking tables of a project, creating the missing ones
+
+    Args:
+        syn: Synapse connection
+        projectid: Synapse project id
+        shards: Number of tracking tables
+        create: Create the missing tracking tables, otherwise their ids are
+                None
 
     Returns:
-        list - [entity Id, entity md5, entity name, entity modified on,
-                entity status]
+        tuple - Synapse ids of the tracking table of each shard, Synapse ids
+                of the tracking tables of other shard layouts
     """
-    tracking_tabledf = tracking_table.asDataFrame()
+    existing = {
+        child['name']: child['id']
+        for child in syn.getChildren(projectid, includeTypes=['table'])
+        if TRACKING_TABLE_PATTERN.match(child['name'])
+    }
+    tableids = []
+    for shard in range(shards):
+        name = get_tracking_table_name(shard, shards)
+        if name not in existing and create:
+            existing[name] = create_tracking_table(syn, projectid, name).id
+        tableids.append(existing.get(name))
+    old_tableids = [tableid for tableid in existing.values()
+                    if tableid not in tableids]
+    return tableids, old_tableids
+
 
-    # Get the current status and errors from the tables.
-    entity_exists = tracking_tabledf[tracking_tabledf['id'] == entity.id]
-    status = "Existing"
+def _record_subfolders(syn, header, snapshot):
+    """Records a folder that is not listed and the folders below it
 
-    if entity_exists.empty:
-        status = "New"
+    Args:
+        syn: Synapse connection
+        header: Entity header of the folder
+        snapshot: state.Snapshot of the project
+    """
+    snapshot.commit()
+    snapshot.add_folders(
+        [(header['id'], header['parentId'])] +
+        [(folder['id'], folder['parentId'])
+         for folder in crawler.iter_subfolders(syn, header['id'])]
+    )
+
+
+def _iter_headers(syn, projectid, crawl_workers=crawler.DEFAULT_WORKERS,
+                  deadline=None, snapshot=None, descend=None):
+    """Crawls the headers of the entities to track
+
+    Args:
+        syn: Synapse connection
+        projectid: Synapse project id
+        crawl_workers: Number of concurrent Synapse requests
+        deadline: time.monotonic() value after which the crawl raises
+                  TimeoutError
+        snapshot: state.Snapshot whose crawl checkpoint the crawl continues
+                  and records its progress in
+        descend: Function called with the header of each sub folder, the
+                 folder is only listed if it returns True
+
+    Yields:
+        dict - Entity header
+    """
+    if snapshot is None:
+        headers = crawler.crawl(syn, projectid, max_workers=crawl_workers,
+                                descend=descend)
     else:
-        # Check if md5 is different if md5 exists
-        diff_md5 = entity_exists['md5'].values[0] != entity.get("md5", 'NA')
-        # Check if entity name is different
-        diff_name = entity_exists['name'].values[0] != entity.name
-        if diff_md5 or diff_name:
-            status = "Updated"
+        headers = itertools.chain(
+            snapshot.get_crawled_headers(),
+            crawler.crawl(syn, projectid, max_workers=crawl_workers,
+                          start=snapshot.get_frontier(),
+                          on_listed=snapshot.add_listing,
+                          descend=descend, before_wait=snapshot.commit)
+        )
+    for header in headers:
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f"Crawling {projectid} timed out")
+        yield header
 
-    return [entity.id, entity.get("md5", 'NA'), entity.name,
-            input_to_database.entity_date_to_timestamp(
-                entity.properties.modifiedOn
-            ),
-            status]
 
+def _query_tracking_table(syn, query):
+    """Queries the tracking table
+
+    Args:
+        syn: Synapse connection
+        query: Tracking table query
+
+    Returns:
+        tuple - records.TrackingTable of the rows, table etag
+    """
+    tracking_table = syn.tableQuery(query)
+    return (records.TrackingTable(_iter_tracked_rows(tracking_table)),
+            tracking_table.etag)
+
+
+def _iter_tracked_rows(tracking_table):
+    """Streams the rows of a tracking table query result
+
+    Args:
+        tracking_table: Tracking table query result
+
+    Yields:
+        state.TrackedRow
+    """
+    with open(tracking_table.filepath, newline="") as tracking_file:
+        for row in csv.DictReader(tracking_file):
+            yield state.TrackedRow(
+                id=row['id'], md5=row['md5'], name=row['name'],
+                modifiedon=int(row['modifiedon']),
+                fingerprint=row.get('fingerprint', ''),
+                parentid=row.get('parentid', ''),
+                row_id=int(row['ROW_ID']), row_version=int(row['ROW_VERSION'])
+            )
+
+
+def _get_missing_columns(tracking_table):
+    """Gets the tracking columns a tracking table query result lacks
+
+    Args:
+        tracking_table: Tracking table query result
+
+    Returns:
+        list - names of the missing tracking columns
+    """
+    with open(tracking_table.filepath, newline="") as tracking_file:
+        header = next(csv.reader(tracking_file), [])
+    return [col for col in writer.TRACKING_COLUMNS if col not in header]
+
+
+def _sync_snapshot(syn, tableids, snapshot):
+    """Brings the local snapshot up to date with the tracking tables, only
+    downloading the shards whose table was changed since the snapshot was
+    taken.  Tables are checked and downloaded concurrently.  Tables created
+    by earlier versions get the tracking columns they lack.
+
+    Args:
+        syn: Synapse connection
+        tableids: Synapse id of the tracking table of each shard
+        snapshot: state.Snapshot of the project
+
+    Returns:
+        dict - {shard: etag} of the tracking tables
+    """
+    local_tables = snapshot.get_tables()
+    if {shard: tableid for shard, (tableid, _) in local_tables.items()} != \
+            dict(enumerate(tableids)):
+        # The shard layout changed
+        snapshot.clear()
+        snapshot.commit()
+        local_tables = {}
+
+    def query(shard, tableid):
+        local_etag = local_tables.get(shard, (None, None))[1]
+        if local_etag is not None:
+            remote_etag = syn.tableQuery(
+                f"select id from {tableid} limit 1"
+            ).etag
+            if remote_etag == local_etag:
+                return None
+        return syn.tableQuery(f"select * from {tableid}")
+
+    etags = {}
+    with ThreadPoolExecutor(max_workers=len(tableids)) as executor:
+        futures = {executor.submit(query, shard, tableid): shard
+                   for shard, tableid in enumerate(tableids)}
+        for future in as_completed(futures):
+            shard = futures[future]
+            tracking_table = future.result()
+            if tracking_table is None:
+                etags[shard] = local_tables[shard][1]
+                continue
+            snapshot.replace(_iter_tracked_rows(tracking_table), shard=shard)
+            snapshot.commit()
+            etag = tracking_table.etag
+            missing = _get_missing_columns(tracking_table)
+            if missing:
+                _add_tracking_columns(syn, tableids[shard], missing)
+                etag = syn.tableQuery(
+                    f"select id from {tableids[shard]} limit 1"
+                ).etag
+            snapshot.set_table_etag(tableids[shard], etag, shard)
+            snapshot.commit()
+            etags[shard] = etag
+    return etags
+
+
+def _resolve_dirty_rows(syn, tableids, snapshot):
+    """Queries the row ids and versions of the rows written during this run
+    back into the local snapshot, unless so many rows of a shard changed
+    that downloading its whole table is cheaper.  Only shards with dirty
+    rows are queried, concurrently.
+
+    Args:
+        syn: Synapse connection
+        tableids: Synapse id of the tracking table of each shard
+        snapshot: state.Snapshot of the project
+    """
+    queries = []
+    for shard, tableid in enumerate(tableids):
+        dirty = snapshot.count_dirty(shard)
+        if dirty > max(QUERY_BATCH_SIZE, snapshot.count(shard) // 10):
+            queries.append((shard, None, f"select * from {tableid}"))
+            continue
+        synids = snapshot.get_dirty_ids(limit=dirty, shard=shard)
+        for batch in pipeline.iter_chunks(synids, QUERY_BATCH_SIZE):
+            query = ", ".join(f"'{synid}'" for synid in batch)
+            queries.append((shard, batch, f"select * from {tableid} "
+                                          f"where id in ({query})"))
+    if not queries:
+        return
+    with ThreadPoolExecutor(
+            max_workers=min(len(queries), len(tableids))) as executor:
+        futures = {executor.submit(syn.tableQuery, query): (shard, synids)
+                   for shard, synids, query in queries}
+        for future in as_completed(futures):
+            shard, synids = futures[future]
+            rows = _iter_tracked_rows(future.result())
+            if synids is None:
+                snapshot.replace(rows, shard=shard)
+            else:
+                snapshot.resolve(synids, rows)
+            snapshot.commit()
+
+
+def _migrate_tables(syn, tableids, old_tableids, snapshot, etags):
+    """Moves the rows of the tracking tables of another shard layout into
+    the tracking tables and deletes the old tables.  Rows already moved by
+    an interrupted migration are skipped.
+
+    Args:
+        syn: Synapse connection
+        tableids: Synapse id of the tracking table of each shard
+        old_tableids: Synapse ids of the tracking tables to migrate
+        snapshot: state.Snapshot of the project, in sync with `tableids`
+        etags: {shard: etag} of the tracking tables
+
+    Returns:
+        dict - {shard: etag} of the tracking tables after the migration
+    """
+    columns = len(writer.TRACKING_COLUMNS)
+
+    def iter_rows(old_tableid):
+        old_rows = _iter_tracked_rows(
+            syn.tableQuery(f"select * from {old_tableid}")
+        )
+        for chunk in pipeline.iter_chunks(old_rows):
+            tracked = snapshot.lookup([row.id for row in chunk])
+            for row in chunk:
+                if row.id not in tracked:
+                    values = row[:columns]
+                    snapshot.upsert(values)
+                    yield snapshot.shard_of(row.id), writer.append_row(values)
+
+    for old_tableid in old_tableids:
+        print(f'{snapshot.projectid}: migrating tracking table '
+              f'{old_tableid}')
+        etags = writer.write_shards(syn, tableids, iter_rows(old_tableid),
+                                    etags=etags, before_store=snapshot.commit)
+        _resolve_dirty_rows(syn, tableids, snapshot)
+        for shard, etag in etags.items():
+            snapshot.set_table_etag(tableids[shard], etag, shard)
+        snapshot.commit()
+        syn.delete(old_tableid)
+    return etags
+
+
+def _login(synapseconfig=None, max_request_rate=governor.DEFAULT_MAX_RATE):
+    """Logs into Synapse.  All REST calls of the connection go through a
+    request governor.
+
+    Args:
+        synapseconfig: Synapse config file with user credentials
+        max_request_rate: Maximum Synapse requests per second
+
+    Returns:
+        Synapse connection
+    """
+    import synapseclient
 
-def monitoring(projectid, synapseconfig=None, userid=None,
-               email_subject="New Synapse Files"):
-    """Invoke monitoring"""
-    # Log into synapse
     if synapseconfig is not None:
         syn = synapseclient.Synapse(skip_checks=True, configPath=synapseconfig)
     else:
         syn = synapseclient.Synapse(skip_checks=True)
+    governor.govern(syn, governor.Governor(
+        governor.TokenBucket(max_rate=max_request_rate)
+    ))
     syn.login(silent=True)
+    metrics.instrument(syn)
+    return syn
 
-    # Obtain user id
-    userid = syn.getUserProfile()['ownerId'] if userid is None else userid
-    username = syn.getUserProfile()['userName']
-    # get files of synapse project
-    project_ent = syn.get(projectid)
 
-    # Get list of entities
-    entity_list = input_to_database.get_center_input_files(
-        syn=syn, synid=projectid, center=project_ent.name,
-        downloadFile=False
+def monitor_project(syn, projectid, full_sync=False, state_dir=None,
+                    crawl_workers=crawler.DEFAULT_WORKERS, timeout=None,
+                    chunk_size=pipeline.DEFAULT_CHUNK_SIZE, resume=False,
+                    statuses=("New",), shards=1, dashboard_settings=None,
+                    principal_cache=None, max_folder_age=0,
+                    filter_settings=None):
+    """Crawls a project and updates its tracking table.  Entities stream
+    through the pipeline `chunk_size` at a time.  The progress of the crawl
+    is checkpointed in the local state so that an interrupted crawl can
+    be resumed.
+
+    Args:
+        syn: Synapse connection
+        projectid: Synapse project id
+        full_sync: Fetch every entity instead of only the entities
+                   modified since the last run
+        state_dir: Directory of local state files
+        crawl_workers: Number of concurrent Synapse requests
+        timeout: Seconds the crawl may take before raising TimeoutError
+        chunk_size: Number of entities classified at a time
+        resume: Continue the last crawl of the project if it was
+                interrupted instead of starting over
+        statuses: Statuses of the entities to report
+        shards: Number of tracking tables entities are spread over.  The
+                tables of another number of shards are migrated.
+        dashboard_settings: Activity dashboard config of the project for
+                            `dashboard.update`, no dashboard if None
+        principal_cache: principals.PrincipalCache to resolve the
+                         contributors of the dashboard
+        max_folder_age: Seconds a folder whose subtree showed no change
+                        may go without being listed, every folder is listed
+                        if 0 or on a full sync.  Changes inside folders
+                        that are not listed are found within this time.
+        filter_settings: Exclude and include rules of the project for
+                         `filters.EntityFilter.from_settings`.  Excluded
+                         folders are not listed and the tracked rows of
+                         excluded entities are kept as they are.
+
+    Returns:
+        tuple - Synapse project, pipeline.Report
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    entity_filter = filters.EntityFilter.from_settings(
+        filter_settings, exclude=MONITORING_EXCLUDE
     )
+    with metrics.span("setup"):
+        # get files of synapse project
+        project_ent = syn.get(projectid)
+
+        # Create tracking tables, gets tables if already exist
+        tableids, old_tableids = get_tracking_tables(syn, projectid, shards)
 
-    print(f'Total number of entities = {len(entity_list) - 1}')
-
-    # Create tracking table, gets table if already exists
-    tracking_table = create_tracking_table(syn, projectid)
-    tracking_table = syn.tableQuery(f"select * from {tracking_table.id}")
-    # Create entity tracking list
-    current_tracking_list = []
-    for entity_lst in entity_list:
-        # Artifact of project GENIE, where 'get_center_input_files' returns
-        # list of lists
-        entity = entity_lst[0]
-        # No need to add in 'Project Monitoring' table
-        if entity.name == "Project Monitoring":
+    watermark = None if full_sync else state.get_watermark(projectid,
+                                                           state_dir)
+    if full_sync:
+        max_folder_age = 0
+    with state.Snapshot(projectid, state_dir, shards=shards,
+                        activity=dashboard_settings is not None) as snapshot:
+        with metrics.span("sync"):
+            etags = _sync_snapshot(syn, tableids, snapshot)
+            if snapshot.count_dirty():
+                # Rows written by an interrupted run
+                _resolve_dirty_rows(syn, tableids, snapshot)
+            if old_tableids:
+                etags = _migrate_tables(syn, tableids, old_tableids,
+                                        snapshot, etags)
+        # Anything modified after the crawl starts is picked up next run
+        crawl_start, saved_report = snapshot.start_crawl(
+            projectid, int(time.time() * 1000) - WATERMARK_SKEW,
+            resume=resume
+        )
+        if saved_report is None:
+            report = pipeline.Report(statuses)
+        else:
+            print(f'{project_ent.name}: resuming interrupted crawl')
+            report = pipeline.Report.from_dict(saved_report)
+
+        def descend(header):
+            if not entity_filter.lists(header):
+                if (not snapshot.is_container(header['id']) and
+                        snapshot.count()):
+                    # The subtree of the tracked entities to keep is not
+                    # known, like with a new state or new exclude rules
+                    _record_subfolders(syn, header, snapshot)
+                snapshot.skip_folder(header['id'])
+                return False
+            if snapshot.should_list(header, max_folder_age):
+                return True
+            # Entities of folders that are not listed are counted unchanged
+            report.counts["Existing"] += snapshot.skip_folder(header['id'])
+            return False
+
+        headers = metrics.iter_span("crawl", entity_filter.iter_included(
+            syn, _iter_headers(syn, projectid, crawl_workers=crawl_workers,
+                               deadline=deadline, snapshot=snapshot,
+                               descend=descend),
+            snapshot=snapshot, chunk_size=chunk_size,
+            crawl_workers=crawl_workers
+        ))
+        # Entities moved into folders that are not listed are not crawled
+        classified = metrics.iter_span("classify", pipeline.classify(
+            syn, headers, snapshot, watermark=watermark,
+            chunk_size=chunk_size, crawl_workers=crawl_workers,
+            verify_unseen=bool(max_folder_age)
+        ))
+
+        def set_table_etags(etags):
+            for shard, etag in etags.items():
+                snapshot.set_table_etag(tableids[shard], etag, shard)
+
+        def checkpoint(etags):
+            set_table_etags(etags)
+            snapshot.checkpoint(report.to_dict())
+
+        with metrics.span("update"):
+            # Update the tracking tables of the shards with changed rows
+            etags = writer.write_shards(
+                syn, tableids,
+                pipeline.iter_changes(classified, snapshot, report,
+                                      checkpoint=True),
+                etags=etags, before_store=snapshot.commit,
+                after_store=checkpoint
+            )
+            snapshot.delete_unseen()
+            snapshot.commit()
+            if snapshot.count_dirty():
+                _resolve_dirty_rows(syn, tableids, snapshot)
+            set_table_etags(etags)
+            snapshot.finish_crawl()
+            snapshot.commit()
+        with metrics.span("notify"):
+            _summarize_report(syn, projectid, snapshot, report)
+        if dashboard_settings is not None:
+            if principal_cache is None:
+                principal_cache = principals.PrincipalCache(syn)
+            try:
+                with metrics.span("dashboard"):
+                    dashboard.update(syn, snapshot, dashboard_settings,
+                                     principal_cache,
+                                     crawl_workers=crawl_workers)
+            except Exception as error:
+                # Counted changes are kept and published next run
+                print(f'{project_ent.name}: updating the dashboard failed - '
+                      f'{error!r}')
+    state.set_watermark(projectid, crawl_start, state_dir)
+    metrics.METRICS.add_entities(report.counts)
+
+    print(f'{project_ent.name}: total number of entities = {report.total}')
+    return project_ent, report
+
+
+def _get_entity_names(syn, synids):
+    """Gets the names of entities with one /entity/header request
+
+    Returns:
+        dict - {Synapse id: entity name}
+    """
+    if not synids:
+        return {}
+    headers = syn.restPOST("/entity/header", body=json.dumps(
+        {'references': [{'targetId': synid} for synid in synids]}
+    ))
+    return {header['id']: header['name'] for header in headers['results']}
+
+
+def _summarize_report(syn, projectid, snapshot, report,
+                      max_rows=digest.DEFAULT_MAX_ROWS,
+                      max_groups=digest.DEFAULT_MAX_GROUPS):
+    """Summarizes the reported statuses with more than `max_rows` entities
+    by folder, type and contributor, and stores the list of every reported
+    entity in the project
+
+    Args:
+        syn: Synapse connection
+        projectid: Synapse project id
+        snapshot: state.Snapshot of the project after the crawl
+        report: pipeline.Report of the crawl
+        max_rows: Number of entities of a status listed in digests
+        max_groups: Number of largest groups of each summary
+    """
+    report.summaries = {
+        status: {title: snapshot.count_reported(status, column, max_groups)
+                 for title, column in digest.SUMMARIES}
+        for status in report.statuses if report.counts[status] > max_rows
+    }
+    if not report.summaries:
+        return
+    import synapseclient
+
+    report.folder_names = _get_entity_names(syn, list({
+        synid for summaries in report.summaries.values()
+        for synid, count in summaries["Folder"] if synid is not None
+    }))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, digest.ATTACHMENT_NAME)
+        digest.write_attachment(snapshot.iter_reported(), path)
+        attachment = syn.store(synapseclient.File(
+            path, parent=projectid, name=digest.ATTACHMENT_NAME
+        ))
+    report.attachment = attachment.id
+
+
+def add_project_result(queue, recipients, project_ent, report,
+                       principal_cache, max_rows=digest.DEFAULT_MAX_ROWS):
+    """Queues the reported entities of a monitored project for its
+    recipients
+
+    Args:
+        queue: notify.NotificationQueue
+        recipients: User ids to notify of the reported entities
+        project_ent: Synapse project
+        report: pipeline.Report of the project
+        principal_cache: principals.PrincipalCache to resolve user names
+        max_rows: Number of entities of a status listed in digests
+    """
+    for status in report.statuses:
+        rows = report.records[status][:max_rows]
+        if not rows:
             continue
-        current_tracking_list.append(check_entity(entity, tracking_table))
+        summaries = report.summaries.get(status, {})
+        with metrics.span("notify"):
+            user_names = principal_cache.get_user_names(
+                [record.modifiedby for record in rows
+                 if record.modifiedby is not None] +
+                [userid for userid, count in summaries.get("Contributor", [])
+                 if userid is not None]
+            )
+        project_digest = digest.ProjectDigest(
+            project_ent.id, project_ent.name, status, report.counts[status],
+            [(record.id, record.name, user_names.get(record.modifiedby))
+             for record in rows],
+            digest.label_summaries(summaries, report.folder_names,
+                                   user_names),
+            report.attachment
+        )
+        for recipient in recipients:
+            queue.add(recipient, project_digest)
 
-    columns = ['id', 'md5', 'name', 'modifiedon', 'status']
-    current_trackingdf = pd.DataFrame(current_tracking_list, columns=columns)
 
-    # Update tracking table
-    process_functions.updateDatabase(
-        syn=syn, database=tracking_table.asDataFrame(),
-        new_dataset=current_trackingdf, database_synid=tracking_table.tableId,
-        primary_key_cols=['id'], to_delete=True
-    )
+def monitor_projects(projects, synapseconfig=None, userid=None,
+                     email_subject="New Synapse Files", full_sync=False,
+                     state_dir=None, crawl_workers=crawler.DEFAULT_WORKERS,
+                     project_workers=DEFAULT_PROJECT_WORKERS,
+                     project_timeout=None, principal_cache=None,
+                     max_request_rate=governor.DEFAULT_MAX_RATE,
+                     resume=False, sinks=None, statuses=("New",),
+                     shards=1, dashboards=None, max_folder_age=0,
+                     entity_filters=None):
+    """Monitors several projects with one Synapse connection and sends one
+    message per recipient listing the reported entities of all their
+    projects
+
+    Args:
+        projects: dict of {Synapse project id: list of recipient user ids}.
+                  Recipients default to `userid` if None.
+        synapseconfig: Synapse config file with user credentials
+        userid: User Id of individual to send report, defaults to current
+                user
+        email_subject: Subject heading of the email
+        full_sync: Fetch every entity instead of only the entities
+                   modified since the last run
+        state_dir: Directory of local state files
+        crawl_workers: Number of concurrent Synapse requests per project
+        project_workers: Number of projects monitored at the same time
+        project_timeout: Seconds each project crawl may take
+        principal_cache: principals.PrincipalCache to resolve user names,
+                         a new cache is used if None
+        max_request_rate: Maximum Synapse requests per second
+        resume: Continue the interrupted crawls of the last run instead of
+                starting over
+        sinks: Notification sink configs for `notify.build_sinks`,
+               defaults to Synapse messages
+        statuses: Statuses of the entities to report
+        shards: Number of tracking tables of each project
+        dashboards: {Synapse project id: dashboard config} of the projects
+                    with an activity dashboard
+        max_folder_age: Seconds a folder whose subtree showed no change
+                        may go without being listed, every folder is listed
+                        if 0
+        entity_filters: {Synapse project id: exclude and include rules} of
+                        the projects with entity filters
+
+    Returns:
+        dict - {Synapse project id: exception} of projects that failed
+    """
+    with metrics.span("login"):
+        syn = _login(synapseconfig, max_request_rate=max_request_rate)
+        if principal_cache is None:
+            principal_cache = principals.PrincipalCache(syn)
+        # Obtain user id
+        profile = principal_cache.get_profile()
+    userid = profile['ownerId'] if userid is None else userid
+    username = profile['userName']
+
+    failures = {}
+    queue = notify.NotificationQueue(notify.build_sinks(syn, sinks),
+                                     username, email_subject)
+    with queue, ThreadPoolExecutor(max_workers=project_workers) as executor:
+        futures = {
+            executor.submit(monitor_project, syn, projectid,
+                            full_sync=full_sync, state_dir=state_dir,
+                            crawl_workers=crawl_workers,
+                            timeout=project_timeout, resume=resume,
+                            statuses=statuses, shards=shards,
+                            dashboard_settings=(dashboards or {}).get(
+                                projectid
+                            ),
+                            principal_cache=principal_cache,
+                            max_folder_age=max_folder_age,
+                            filter_settings=(entity_filters or {}).get(
+                                projectid
+                            )): projectid
+            for projectid in projects
+        }
+        for future in as_completed(futures):
+            projectid = futures[future]
+            try:
+                project_ent, report = future.result()
+            except Exception as error:
+                print(f'{projectid}: monitoring failed - {error!r}')
+                failures[projectid] = error
+                continue
+            add_project_result(queue, projects[projectid] or [userid],
+                               project_ent, report, principal_cache)
+    return failures
+
+
+def _check_project_drift(syn, projectid, state_dir=None, repair=False,
+                         shards=1):
+    """Compares the local snapshot of a project with its tracking tables
+
+    Args:
+        syn: Synapse connection
+        projectid: Synapse project id
+        state_dir: Directory of local state files
+        repair: Write the differences to the tracking tables so that they
+                match the local snapshot, creating the missing tables
+        shards: Number of tracking tables
+
+    Returns:
+        list - writer.Changeset of each shard with the changes that make
+               its tracking table match the local snapshot, every row of
+               the snapshot is missing from a missing tracking table
+    """
+    tableids, _ = get_tracking_tables(syn, projectid, shards, create=False)
+    changesets = []
+    for shard, tableid in enumerate(tableids):
+        if tableid is None:
+            name = get_tracking_table_name(shard, shards)
+            print(f'{projectid}: tracking table "{name}" is missing'
+                  f'{" and was created" if repair else ""}')
+            tracking_table, etag = records.TrackingTable(), None
+            if repair:
+                tableid = create_tracking_table(syn, projectid, name).id
+        elif state.get_table_etag(projectid, tableid, state_dir) is None:
+            raise ValueError(f"{projectid} has no local snapshot of "
+                             f"{tableid}")
+        else:
+            tracking_table, etag = _query_tracking_table(
+                syn, f"select * from {tableid}"
+            )
+        changeset = writer.get_changeset(
+            state.get_snapshot(projectid, state_dir, shard=shard),
+            tracking_table
+        )
+        if repair and (any(changeset) or etag is None):
+            writer.write_changeset(syn, tableid, changeset, etag=etag)
+            tracking_table, etag = _query_tracking_table(
+                syn, f"select * from {tableid}"
+            )
+            state.save_snapshot(projectid, tableid, etag, tracking_table,
+                                state_dir, shard=shard)
+        changesets.append(changeset)
+    return changesets
 
-    # Send email only if there are new files
-    new_files_idx = current_trackingdf['status'] == "New"
-    new_filesdf = current_trackingdf[new_files_idx][['id', 'name']]
 
-    if not new_filesdf.empty:
-        message = (
-            f"Hello {username},<br/><br/>"
-            "These are the new synapse entities for "
-            f"synapse project: <a href='https://www.synapse.org/#!Synapse:{project_ent.id}'>{project_ent.name}</a>"
-            "<br/><br/>"
+def check_drift(projectids, synapseconfig=None, state_dir=None,
+                repair=False, max_request_rate=governor.DEFAULT_MAX_RATE,
+                shards=1):
+    """Compares the local snapshots with the tracking tables and prints the
+    number of rows that differ
+
+    Args:
+        projectids: Synapse project ids
+        synapseconfig: Synapse config file with user credentials
+        state_dir: Directory of local state files
+        repair: Write the differences to the tracking tables so that they
+                match the local snapshots
+        max_request_rate: Maximum Synapse requests per second
+        shards: Number of tracking tables of each project
+
+    Returns:
+        dict - {Synapse project id: list of writer.Changeset per shard}
+    """
+    syn = _login(synapseconfig, max_request_rate=max_request_rate)
+    changesets = {}
+    for projectid in projectids:
+        with metrics.span("drift"):
+            project_changesets = _check_project_drift(
+                syn, projectid, state_dir=state_dir, repair=repair,
+                shards=shards
+            )
+        appends, updates, deletes = (
+            sum(len(changes) for changes in shard_changes)
+            for shard_changes in zip(*project_changesets)
         )
-        syn.sendMessage([userid], email_subject,
-                        message+new_filesdf.to_html(index=False),
-                        contentType = 'text/html')
+        print(f'{projectid}: {appends} missing, {updates} different and '
+              f'{deletes} extra tracking table rows'
+              f'{" repaired" if repair else ""}')
+        changesets[projectid] = project_changesets
+    return changesets
+
+
+def monitoring(projectid, synapseconfig=None, userid=None,
+               email_subject="New Synapse Files", full_sync=False,
+               state_dir=None, crawl_workers=crawler.DEFAULT_WORKERS):
+    """Invoke monitoring
+
+    Args:
+        projectid: Synapse project id
+        synapseconfig: Synapse config file with user credentials
+        userid: User Id of individual to send report
+        email_subject: Subject heading of the email
+        full_sync: Fetch every entity instead of only the entities
+                   modified since the last run
+        state_dir: Directory of local state files
+        crawl_workers: Number of concurrent Synapse requests
+    """
+    failures = monitor_projects(
+        {projectid: None}, synapseconfig=synapseconfig, userid=userid,
+        email_subject=email_subject, full_sync=full_sync,
+        state_dir=state_dir, crawl_workers=crawl_workers
+    )
+    if failures:
+        raise failures[projectid]
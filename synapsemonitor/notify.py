@@ -0,0 +1,334 @@
+"""Notification queue
+
+Project digests are queued per recipient and coalesced: digests of the
+same project and status are merged and each recipient gets one message
+covering all of their projects once their `window` has passed since the
+first queued digest.  Messages are dispatched on a worker thread to every
+sink that accepts the recipient, and failed deliveries are retried with
+exponential backoff without holding up other recipients.
+
+Sinks are configured under "notifications" in the config file, i.e.
+
+    {"notifications": {"sinks": [{"type": "synapse"},
+                                 {"type": "smtp", "host": "smtp.org",
+                                  "sender": "monitor@smtp.org"},
+                                 {"type": "webhook", "url": "https://..."},
+                                 {"type": "file", "path": "digests.jsonl"}],
+                       "statuses": ["New", "Updated", "Deleted"]}}
+
+Synapse messages go to Synapse user ids and SMTP email to recipients that
+are email addresses.  Webhooks and files get every message.
+"""
+from email.message import EmailMessage
+import heapq
+import itertools
+import json
+import os
+import smtplib
+import threading
+import time
+
+from . import digest, metrics
+
+# Seconds the daemon coalesces the digests of a recipient
+DEFAULT_WINDOW = 5 * 60
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_DELAY = 1.0
+# Seconds webhook requests may take
+WEBHOOK_TIMEOUT = 30
+
+
+def _is_email(recipient):
+    return "@" in str(recipient)
+
+
+class SynapseSink:
+    """Sends Synapse messages to Synapse users
+
+    Args:
+        syn: Synapse connection
+    """
+    def __init__(self, syn):
+        self.syn = syn
+
+    def accepts(self, recipient):
+        """Whether the sink can notify a recipient"""
+        return not _is_email(recipient)
+
+    def send(self, recipient, subject, message, project_digests):
+        """Sends a message
+
+        Args:
+            recipient: Synapse user id or email address
+            subject: Subject of the message
+            message: HTML message
+            project_digests: list of digest.ProjectDigest in the message
+        """
+        self.syn.sendMessage([recipient], subject, message,
+                             contentType='text/html')
+
+
+class SmtpSink:
+    """Sends email to email addresses
+
+    Args:
+        host: SMTP server
+        sender: Email address the email is from
+        port: SMTP port
+        username: SMTP user name, no login if None
+        password_env: Environment variable holding the SMTP password
+        starttls: Upgrade the connection to TLS
+    """
+    def __init__(self, host, sender, port=587, username=None,
+                 password_env=None, starttls=True):
+        self.host = host
+        self.sender = sender
+        self.port = port
+        self.username = username
+        self.password_env = password_env
+        self.starttls = starttls
+
+    def accepts(self, recipient):
+        """Whether the sink can notify a recipient"""
+        return _is_email(recipient)
+
+    def send(self, recipient, subject, message, project_digests):
+        """Sends a message, see `SynapseSink.send`"""
+        email = EmailMessage()
+        email['Subject'] = subject
+        email['From'] = self.sender
+        email['To'] = recipient
+        email.set_content(message, subtype='html')
+        with smtplib.SMTP(self.host, self.port) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username is not None:
+                smtp.login(self.username,
+                           os.environ.get(self.password_env or "", ""))
+            smtp.send_message(email)
+
+
+def _to_json(recipient, subject, message, project_digests):
+    """Message as a JSON serializable dict"""
+    return {
+        'recipient': recipient,
+        'subject': subject,
+        'message': message,
+        'projects': [
+            {'projectid': project_digest.projectid,
+             'name': project_digest.project_name,
+             'status': project_digest.status,
+             'total': project_digest.total,
+             'attachment': project_digest.attachment}
+            for project_digest in project_digests
+        ]
+    }
+
+
+class WebhookSink:
+    """Posts every message as JSON
+
+    Args:
+        url: Webhook URL
+    """
+    def __init__(self, url):
+        self.url = url
+
+    def accepts(self, recipient):
+        """Whether the sink can notify a recipient"""
+        return True
+
+    def send(self, recipient, subject, message, project_digests):
+        """Sends a message, see `SynapseSink.send`"""
+        import requests
+
+        response = requests.post(
+            self.url, json=_to_json(recipient, subject, message,
+                                    project_digests),
+            timeout=WEBHOOK_TIMEOUT
+        )
+        response.raise_for_status()
+
+
+class FileSink:
+    """Appends every message to a JSON lines file
+
+    Args:
+        path: Path of the file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def accepts(self, recipient):
+        """Whether the sink can notify a recipient"""
+        return True
+
+    def send(self, recipient, subject, message, project_digests):
+        """Sends a message, see `SynapseSink.send`"""
+        line = json.dumps(_to_json(recipient, subject, message,
+                                   project_digests))
+        with self._lock, open(self.path, "a") as sink_file:
+            sink_file.write(line + "\n")
+
+
+def build_sinks(syn, specs=None):
+    """Builds sinks from their config
+
+    Args:
+        syn: Synapse connection
+        specs: list of sink configs with a "type" of "synapse", "smtp",
+               "webhook" or "file" and the arguments of the sink.  Defaults
+               to a Synapse sink.
+
+    Returns:
+        list - sinks
+    """
+    sinks = []
+    for spec in specs or [{"type": "synapse"}]:
+        spec = dict(spec)
+        sink_type = spec.pop("type")
+        if sink_type == "synapse":
+            sinks.append(SynapseSink(syn))
+        elif sink_type == "smtp":
+            sinks.append(SmtpSink(**spec))
+        elif sink_type == "webhook":
+            sinks.append(WebhookSink(**spec))
+        elif sink_type == "file":
+            sinks.append(FileSink(**spec))
+        else:
+            raise ValueError(f"Unknown notification sink {sink_type}")
+    return sinks
+
+
+class NotificationQueue:
+    """Coalesces project digests per recipient and dispatches them on a
+    worker thread.  Use as a context manager, everything queued is sent
+    when the context exits.
+
+    Args:
+        sinks: Sinks to send messages to
+        username: Synapse user name to greet
+        subject: Subject heading of the messages
+        window: Seconds digests of a recipient are coalesced before they
+                are sent, only sent when the queue closes if None
+        max_attempts: Number of attempts to deliver a message to a sink
+        retry_delay: Seconds before the first retry, doubled every retry
+    """
+    def __init__(self, sinks, username, subject, window=None,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_delay=DEFAULT_RETRY_DELAY):
+        self.sinks = sinks
+        self.username = username
+        self.subject = subject
+        self.window = window
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.sent = 0
+        self.failed = 0
+        # {recipient: (due time or None, {(Synapse project id, status):
+        # digest})}
+        self._pending = {}
+        # Heap of (due time, sequence, recipient, sink, digests, attempt)
+        self._retries = []
+        self._sequence = itertools.count()
+        self._closing = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="notifications", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+
+    def add(self, recipient, project_digest):
+        """Queues a project digest for a recipient"""
+        with self._condition:
+            if recipient not in self._pending:
+                due = (None if self.window is None
+                       else time.monotonic() + self.window)
+                self._pending[recipient] = (due, {})
+            digests = self._pending[recipient][1]
+            key = (project_digest.projectid, project_digest.status)
+            if key in digests:
+                project_digest = digest.merge(digests[key], project_digest)
+            digests[key] = project_digest
+            self._condition.notify()
+
+    def _pop_due(self, now):
+        """Takes the deliveries that are due
+
+        Returns:
+            list - (recipient, sinks, digests, attempt)
+        """
+        due = []
+        for recipient, (due_time, digests) in list(self._pending.items()):
+            if self._closing or due_time is not None and due_time <= now:
+                del self._pending[recipient]
+                due.append((recipient, None, list(digests.values()), 1))
+        while self._retries and self._retries[0][0] <= now:
+            _, _, recipient, sink, digests, attempt = heapq.heappop(
+                self._retries
+            )
+            due.append((recipient, [sink], digests, attempt))
+        return due
+
+    def _next_due(self):
+        """time.monotonic() of the next delivery, None if there is none"""
+        times = [due_time for due_time, _ in self._pending.values()
+                 if due_time is not None]
+        if self._retries:
+            times.append(self._retries[0][0])
+        return min(times) if times else None
+
+    def _run(self):
+        """Dispatches deliveries as they become due"""
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    deliveries = self._pop_due(now)
+                    if deliveries:
+                        break
+                    if self._closing and not self._retries:
+                        return
+                    next_due = self._next_due()
+                    self._condition.wait(
+                        None if next_due is None else next_due - now
+                    )
+            for delivery in deliveries:
+                self._deliver(*delivery)
+
+    def _deliver(self, recipient, sinks, digests, attempt):
+        """Sends one message to sinks, scheduling retries of failures"""
+        digests.sort(key=lambda project_digest: (project_digest.project_name,
+                                                 project_digest.status))
+        with metrics.span("notify"):
+            message = digest.render_message(self.username, digests)
+        sinks = [sink for sink in self.sinks if sink.accepts(recipient)] \
+            if sinks is None else sinks
+        for sink in sinks:
+            try:
+                with metrics.span("notify"):
+                    sink.send(recipient, self.subject, message, digests)
+            except Exception as error:
+                if attempt >= self.max_attempts:
+                    print(f'Notifying {recipient} with '
+                          f'{type(sink).__name__} failed - {error!r}')
+                    self.failed += 1
+                    continue
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                with self._condition:
+                    heapq.heappush(self._retries, (
+                        time.monotonic() + delay, next(self._sequence),
+                        recipient, sink, digests, attempt + 1
+                    ))
+            else:
+                self.sent += 1
@@ -0,0 +1,235 @@
+"""Streaming monitoring pipeline
+
+Entities flow through generator stages in chunks so that memory stays
+bounded regardless of project size:
+
+    crawl -> classify -> changes -> tracking table writes
+                              \\-> report
+
+The local snapshot (`state.Snapshot`) is the tracking index, so tracked
+entities are looked up a chunk at a time instead of being loaded.
+"""
+import collections
+import itertools
+
+from . import crawler, state, writer
+
+DEFAULT_CHUNK_SIZE = 1000
+# Maximum number of entities of each status kept for the report
+DEFAULT_REPORT_ROWS = 1000
+
+
+def iter_chunks(iterable, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields lists of at most `chunk_size` items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_status(record, tracked):
+    """Gets the status of a crawled entity.  Entities are moved when their
+    parent changed, otherwise updated when their fingerprint changed.
+
+    Args:
+        record: crawler.EntityRecord of the crawled entity
+        tracked: state.TrackedRow of the entity, or any record with the
+                 tracking columns, None if untracked
+
+    Returns:
+        str - "New", "Moved", "Updated" or "Existing"
+    """
+    if tracked is None:
+        return "New"
+    if tracked.parentid and tracked.parentid != record.parentid:
+        # Entities tracked before parents were have no parent
+        return "Moved"
+    if tracked.fingerprint:
+        changed = tracked.fingerprint != record.fingerprint
+    else:
+        # Tracked before fingerprints
+        changed = (tracked.md5, tracked.name) != (record.md5, record.name)
+    return "Updated" if changed else "Existing"
+
+
+def _classify_chunk(syn, chunk, snapshot, watermark, crawl_workers):
+    """Classifies a chunk of entity headers, see `classify`"""
+    synids = [header['id'] for header in chunk]
+    tracked_rows = snapshot.lookup(synids)
+    snapshot.mark_seen(synids)
+    records = []
+    to_lookup = []
+    for header in chunk:
+        modifiedon = crawler.entity_date_to_timestamp(header['modifiedOn'])
+        fingerprint = crawler.get_fingerprint(header)
+        tracked = tracked_rows.get(header['id'])
+        if (watermark is not None and tracked is not None and
+                (tracked.fingerprint == fingerprint or
+                 not tracked.fingerprint and modifiedon < watermark)):
+            md5 = tracked.md5
+        elif header['type'] == crawler.FILE_TYPE:
+            md5 = None
+            to_lookup.append(header['id'])
+        else:
+            md5 = 'NA'
+        records.append(crawler.EntityRecord(
+            header['id'], md5, header['name'], modifiedon, fingerprint,
+            header.get('parentId'), header.get('modifiedBy'), header['type']
+        ))
+    snapshot.commit()
+    md5s = crawler.get_file_md5s(syn, to_lookup, max_workers=crawl_workers)
+    for record in records:
+        if record.md5 is None:
+            record = record._replace(md5=md5s.get(record.id, 'NA'))
+        tracked = tracked_rows.get(record.id)
+        yield record, get_status(record, tracked), tracked
+
+
+def classify(syn, headers, snapshot, watermark=None,
+             chunk_size=DEFAULT_CHUNK_SIZE,
+             crawl_workers=crawler.DEFAULT_WORKERS, verify_unseen=False):
+    """Classifies crawled entity headers against the local snapshot a chunk
+    at a time, followed by the tracked entities that were not crawled.
+    Only file entities that are untracked or whose fingerprint changed
+    have their md5 looked up, unchanged entities keep their tracked md5.
+    Entities tracked before fingerprints are unchanged if they were not
+    modified since the watermark.  Entities whose parent changed are moved.
+    Every entity of a reported status is kept in the snapshot for the
+    digest.
+
+    Args:
+        syn: Synapse connection
+        headers: Iterable of entity headers
+        snapshot: state.Snapshot of the project
+        watermark: Unix epoch time in milliseconds of the last run.
+                   Looks up the md5 of every file if None.
+        chunk_size: Number of entities classified at a time
+        crawl_workers: Number of concurrent Synapse requests
+        verify_unseen: Look up the tracked entities that were not crawled
+                       instead of deleting them.  Entities moved into a
+                       folder of the project that was not listed are
+                       classified like crawled entities.
+
+    Yields:
+        tuple - crawler.EntityRecord, status, state.TrackedRow or None
+    """
+    for chunk in iter_chunks(headers, chunk_size):
+        yield from _classify_chunk(syn, chunk, snapshot, watermark,
+                                   crawl_workers)
+
+    unseen = snapshot.iter_unseen()
+    for chunk in iter_chunks(unseen, chunk_size):
+        found = {}
+        if verify_unseen:
+            snapshot.commit()
+            found = crawler.get_entity_headers(
+                syn, [tracked.id for tracked in chunk],
+                max_workers=crawl_workers
+            )
+            found = {synid: header for synid, header in found.items()
+                     if snapshot.is_container(header.get('parentId'))}
+        if found:
+            yield from _classify_chunk(syn, list(found.values()), snapshot,
+                                       watermark, crawl_workers)
+        for tracked in chunk:
+            if tracked.id in found:
+                continue
+            record = crawler.EntityRecord(
+                *tracked[:len(writer.TRACKING_COLUMNS)], modifiedby=None
+            )
+            yield record, "Deleted", tracked
+
+
+def iter_changes(classified, snapshot, report, checkpoint=False):
+    """Turns classified entities into tracking table CSV rows of the
+    entities that changed.  Changed entities are marked dirty in the
+    snapshot and added to its change history, and every entity is added to
+    the report.
+
+    Args:
+        classified: Iterable from `classify`
+        snapshot: state.Snapshot of the project
+        report: Report accumulating the classified entities
+        checkpoint: Mark crawled entities processed and yield a
+                    `writer.FLUSH` row whenever a crawl checkpoint is due
+
+    Yields:
+        tuple - shard, CSV row for `writer.write_shards`
+    """
+    columns = len(writer.TRACKING_COLUMNS)
+    for record, status, tracked in classified:
+        report.add(record, status)
+        if status in report.statuses:
+            snapshot.add_reported(status, record)
+        if status in state.EVENTS:
+            snapshot.add_event(status, record)
+        values = record[:columns]
+        shard = snapshot.shard_of(record.id)
+        if status == "Deleted":
+            snapshot.mark_deleted(record.id)
+            yield shard, writer.delete_row(tracked.row_id,
+                                           tracked.row_version)
+        elif tracked is None:
+            snapshot.upsert(values)
+            yield shard, writer.append_row(values)
+        elif tuple(tracked[:columns]) != tuple(values):
+            snapshot.upsert(values)
+            yield shard, writer.update_row(tracked.row_id,
+                                           tracked.row_version, values)
+        if checkpoint and status != "Deleted":
+            snapshot.mark_processed(record.id)
+        if checkpoint and snapshot.checkpoint_due():
+            yield writer.FLUSH
+
+
+class Report:
+    """Accumulates classified entities for notifications, counting every
+    entity but keeping at most `max_rows` entities of each reported
+    status.
+
+    Args:
+        statuses: Statuses of the entities to keep
+        max_rows: Maximum number of entities kept per status
+    """
+    def __init__(self, statuses=("New",), max_rows=DEFAULT_REPORT_ROWS):
+        self.statuses = statuses
+        self.max_rows = max_rows
+        self.counts = collections.Counter()
+        self.records = {status: [] for status in statuses}
+        # Digest summaries of large change sets, set by the monitor
+        self.summaries = {}
+        self.folder_names = {}
+        self.attachment = None
+
+    def add(self, record, status):
+        """Adds a classified entity"""
+        self.counts[status] += 1
+        records = self.records.get(status)
+        if records is not None and len(records) < self.max_rows:
+            records.append(record)
+
+    def to_dict(self):
+        """Report as a JSON serializable dict"""
+        return {
+            'counts': dict(self.counts),
+            'records': {status: [list(record) for record in records]
+                        for status, records in self.records.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, report, max_rows=DEFAULT_REPORT_ROWS):
+        """Report from `to_dict`"""
+        restored = cls(tuple(report['records']), max_rows=max_rows)
+        restored.counts.update(report['counts'])
+        for status, records in report['records'].items():
+            restored.records[status] = [crawler.EntityRecord(*record)
+                                        for record in records]
+        return restored
+
+    @property
+    def total(self):
+        """Number of entities that were crawled"""
+        return sum(count for status, count in self.counts.items()
+                   if status != "Deleted")
@@ -0,0 +1,107 @@
+"""Principal resolution cache"""
+import collections
+import threading
+import time
+
+from . import metrics
+
+DEFAULT_TTL = 60 * 60
+DEFAULT_MAXSIZE = 10000
+# Maximum number of principal ids per /userGroupHeaders/batch request
+LOOKUP_BATCH_SIZE = 100
+
+
+class PrincipalCache:
+    """Size bounded LRU cache of Synapse user and team headers that expire
+    after `ttl` seconds.  Safe to share between threads.
+
+    Args:
+        syn: Synapse connection
+        ttl: Seconds a cached principal is valid
+        maxsize: Maximum number of cached principals
+    """
+    def __init__(self, syn, ttl=DEFAULT_TTL, maxsize=DEFAULT_MAXSIZE):
+        self.syn = syn
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        """Gets an unexpired cached value, counting hits and misses here
+        and in the run metrics"""
+        with self._lock:
+            cached = self._cache.get(key)
+            hit = cached is not None and cached[0] > time.monotonic()
+            if hit:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.METRICS.add_cache_lookup("principals", hit)
+        return cached[1] if hit else None
+
+    def _set(self, key, value):
+        """Caches a value, evicting the least recently used values"""
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def get_profile(self, principalid=None):
+        """Gets a user profile
+
+        Args:
+            principalid: Synapse user id, defaults to the logged in user
+
+        Returns:
+            dict - Synapse UserProfile with at least ownerId and userName
+        """
+        key = ('profile', principalid)
+        profile = self._get(key)
+        if profile is None:
+            profile = self.syn.getUserProfile(principalid)
+            self._set(key, profile)
+            self._set(('name', str(profile['ownerId'])), profile['userName'])
+        return profile
+
+    def get_user_names(self, principalids):
+        """Gets the user or team names of principals, looking up unknown
+        principals `LOOKUP_BATCH_SIZE` at a time
+
+        Args:
+            principalids: Iterable of Synapse user or team ids
+
+        Returns:
+            dict - {principal id: user or team name}, unknown principals
+                   are left out
+        """
+        names = {}
+        unknown = []
+        for principalid in set(map(str, principalids)):
+            name = self._get(('name', principalid))
+            if name is None:
+                unknown.append(principalid)
+            else:
+                names[principalid] = name
+        for start in range(0, len(unknown), LOOKUP_BATCH_SIZE):
+            ids = ",".join(unknown[start:start + LOOKUP_BATCH_SIZE])
+            response = self.syn.restGET(f"/userGroupHeaders/batch?ids={ids}")
+            for header in response['children']:
+                principalid = str(header['ownerId'])
+                self._set(('name', principalid), header['userName'])
+                names[principalid] = header['userName']
+        return names
+
+    def stats(self):
+        """Gets cache hit and miss counts
+
+        Returns:
+            dict - hits, misses and size of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._cache)}
@@ -0,0 +1,316 @@
+"""Compact tracking records
+
+Tracked entities are kept column-wise in typed arrays instead of DataFrames
+or a Python object per entity: Synapse ids of entities and their parents
+as integers, md5s as 16 raw bytes, names as UTF-8 in one buffer and
+fingerprints as a version number and a modification time.  An entity
+takes about 100 bytes instead of the several hundred of a DataFrame row of
+Python strings.  Values that do not fit their encoding, like the "NA" md5
+of entities without a file, are kept as they are in sparse mappings.
+
+Tables are joined on the entity id by merging their orders by id, so
+diffing tracked entities compares the encoded columns without building an
+object per entity.
+"""
+import array
+import datetime
+import functools
+import re
+
+from .writer import TRACKING_COLUMNS
+
+_MD5 = re.compile(r"[0-9a-f]{32}")
+_SYNID = re.compile(r"syn[1-9]\d*")
+# "{versionNumber}@{modifiedOn}" of `crawler.get_fingerprint`
+_FINGERPRINT = re.compile(
+    r"(0|[1-9]\d*)?@(\d{4}-\d\d-\d\d)T([01]\d|2[0-3]):([0-5]\d):([0-5]\d)"
+    r"\.(\d{3})Z"
+)
+# Fingerprint versions of entities without a version number, of rows
+# tracked before fingerprints and of fingerprints kept as they are
+_NO_VERSION = -1
+_NO_FINGERPRINT = -2
+_IRREGULAR = -3
+# Parent of entities tracked before parents were
+_NO_PARENT = -1
+# Row id and version of rows not stored in a tracking table
+_NO_ROW = -1
+# Default of the sparse mappings, so that irregular values equal to None
+# still differ from encoded values
+_ENCODED = object()
+_POSITION_MASK = (1 << 32) - 1
+_NO_MD5 = bytes(16)
+
+
+def encode_synid(synid):
+    """Synapse id as an integer, "syn123" is 123"""
+    return int(str(synid)[3:])
+
+
+def decode_synid(number):
+    """Synapse id of an integer from `encode_synid`"""
+    return f"syn{number}"
+
+
+@functools.lru_cache(maxsize=4096)
+def _day_ordinal(day):
+    return datetime.date.fromisoformat(day).toordinal()
+
+
+@functools.lru_cache(maxsize=4096)
+def _ordinal_day(ordinal):
+    return datetime.date.fromordinal(ordinal).isoformat()
+
+
+def _encode_fingerprint(fingerprint):
+    """(version, milliseconds since year 1) of a fingerprint, None if it
+    does not fit the encoding"""
+    if fingerprint == "":
+        return _NO_FINGERPRINT, 0
+    if not isinstance(fingerprint, str):
+        return None
+    match = _FINGERPRINT.fullmatch(fingerprint)
+    if match is None:
+        return None
+    version, day, hours, minutes, seconds, millis = match.groups()
+    try:
+        ordinal = _day_ordinal(day)
+    except ValueError:
+        return None
+    seconds = ((ordinal * 24 + int(hours)) * 60 + int(minutes)) * 60 + \
+        int(seconds)
+    return (_NO_VERSION if version is None else int(version),
+            seconds * 1000 + int(millis))
+
+
+def _decode_fingerprint(version, time):
+    """Fingerprint of `_encode_fingerprint`"""
+    if version == _NO_FINGERPRINT:
+        return ""
+    seconds, millis = divmod(time, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    ordinal, hours = divmod(hours, 24)
+    version = "" if version == _NO_VERSION else version
+    return (f"{version}@{_ordinal_day(ordinal)}T{hours:02}:{minutes:02}:"
+            f"{seconds:02}.{millis:03}Z")
+
+
+class TrackingTable:
+    """Tracked entities in compact columns
+
+    Args:
+        rows: Iterable of tracking column values, optionally followed by the
+              row id and version of the tracking table row of the entity
+    """
+    def __init__(self, rows=()):
+        self._ids = array.array('q')
+        self._md5s = bytearray()
+        self._names = bytearray()
+        self._name_ends = array.array('q')
+        self._modifiedons = array.array('q')
+        self._versions = array.array('q')
+        self._times = array.array('q')
+        self._parentids = array.array('q')
+        self._row_ids = array.array('q')
+        self._row_versions = array.array('q')
+        # {position: value} of values that do not fit their encoding
+        self._md5_values = {}
+        self._name_values = {}
+        self._fingerprint_values = {}
+        self._parentid_values = {}
+        # Positions in order of the entity ids, sorted when first joined
+        self._order = None
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        """Yields the tracking column values of each entity followed by its
+        row id and version"""
+        for position in range(len(self)):
+            yield self.values(position) + self.row_ids(position)
+
+    def append(self, row):
+        """Adds an entity
+
+        Args:
+            row: Tracking column values, optionally followed by the row id
+                 and version of the tracking table row of the entity
+        """
+        self.extend([row])
+
+    def extend(self, rows):
+        """Adds entities
+
+        Args:
+            rows: Iterable of tracking column values, optionally followed by
+                  the row id and version of the tracking table row of each
+                  entity
+        """
+        columns = len(TRACKING_COLUMNS)
+        match_md5 = _MD5.fullmatch
+        ids, md5s, names = self._ids, self._md5s, self._names
+        name_ends, modifiedons = self._name_ends, self._modifiedons
+        versions, times = self._versions, self._times
+        parentids = self._parentids
+        row_ids, row_versions = self._row_ids, self._row_versions
+        for position, row in enumerate(rows, len(ids)):
+            synid, md5, name, modifiedon, fingerprint, parentid = \
+                row[:columns]
+            ids.append(encode_synid(synid))
+            if isinstance(md5, str) and match_md5(md5):
+                md5s += bytes.fromhex(md5)
+            else:
+                md5s += _NO_MD5
+                self._md5_values[position] = md5
+            if isinstance(name, str):
+                names += name.encode("utf-8", "surrogatepass")
+            else:
+                self._name_values[position] = name
+            name_ends.append(len(names))
+            modifiedons.append(int(modifiedon))
+            encoded = _encode_fingerprint(fingerprint)
+            if encoded is None:
+                encoded = (_IRREGULAR, 0)
+                self._fingerprint_values[position] = fingerprint
+            versions.append(encoded[0])
+            times.append(encoded[1])
+            if parentid == "":
+                parentids.append(_NO_PARENT)
+            elif isinstance(parentid, str) and _SYNID.fullmatch(parentid):
+                parentids.append(encode_synid(parentid))
+            else:
+                parentids.append(_NO_PARENT)
+                self._parentid_values[position] = parentid
+            row_id, row_version = row[columns:] or (None, None)
+            row_ids.append(_NO_ROW if row_id is None else int(row_id))
+            row_versions.append(_NO_ROW if row_version is None
+                                else int(row_version))
+        self._order = None
+
+    def _md5(self, position):
+        if position in self._md5_values:
+            return self._md5_values[position]
+        return self._md5s[position * 16:position * 16 + 16].hex()
+
+    def _name_bytes(self, position):
+        start = self._name_ends[position - 1] if position else 0
+        return self._names[start:self._name_ends[position]]
+
+    def _name(self, position):
+        if position in self._name_values:
+            return self._name_values[position]
+        return self._name_bytes(position).decode("utf-8", "surrogatepass")
+
+    def _fingerprint(self, position):
+        if position in self._fingerprint_values:
+            return self._fingerprint_values[position]
+        return _decode_fingerprint(self._versions[position],
+                                   self._times[position])
+
+    def _parentid(self, position):
+        if position in self._parentid_values:
+            return self._parentid_values[position]
+        parentid = self._parentids[position]
+        return "" if parentid == _NO_PARENT else decode_synid(parentid)
+
+    def values(self, position):
+        """Tracking column values of an entity
+
+        Args:
+            position: Position of the entity in the table
+
+        Returns:
+            tuple - id, md5, name, modifiedon, fingerprint, parentid
+        """
+        return (decode_synid(self._ids[position]), self._md5(position),
+                self._name(position), self._modifiedons[position],
+                self._fingerprint(position), self._parentid(position))
+
+    def row_ids(self, position):
+        """Row id and version of the tracking table row of an entity, None
+        if it is not known"""
+        row_id = self._row_ids[position]
+        row_version = self._row_versions[position]
+        return (None if row_id == _NO_ROW else row_id,
+                None if row_version == _NO_ROW else row_version)
+
+    def _same_md5(self, position, other, other_position):
+        start, other_start = position * 16, other_position * 16
+        return (self._md5s[start:start + 16] ==
+                other._md5s[other_start:other_start + 16] and
+                self._md5_values.get(position, _ENCODED) ==
+                other._md5_values.get(other_position, _ENCODED))
+
+    def _same_name(self, position, other, other_position):
+        return (self._name_bytes(position) ==
+                other._name_bytes(other_position) and
+                self._name_values.get(position, _ENCODED) ==
+                other._name_values.get(other_position, _ENCODED))
+
+    def _same_fingerprint(self, position, other, other_position):
+        return (self._versions[position] == other._versions[other_position]
+                and self._times[position] == other._times[other_position]
+                and self._fingerprint_values.get(position, _ENCODED) ==
+                other._fingerprint_values.get(other_position, _ENCODED))
+
+    def _same_parentid(self, position, other, other_position):
+        return (self._parentids[position] == other._parentids[other_position]
+                and self._parentid_values.get(position, _ENCODED) ==
+                other._parentid_values.get(other_position, _ENCODED))
+
+    def is_changed(self, position, other, other_position):
+        """Whether any tracking column of an entity differs from `other`"""
+        return not (
+            self._modifiedons[position] == other._modifiedons[other_position]
+            and self._same_fingerprint(position, other, other_position)
+            and self._same_md5(position, other, other_position)
+            and self._same_name(position, other, other_position)
+            and self._same_parentid(position, other, other_position)
+        )
+
+    def _sorted(self):
+        """Positions of the entities in order of their ids"""
+        if self._order is None:
+            keys = sorted(synid << 32 | position
+                          for position, synid in enumerate(self._ids))
+            self._order = array.array(
+                'q', (key & _POSITION_MASK for key in keys)
+            )
+        return self._order
+
+    def join(self, other):
+        """Joins the entities with the entities of another table on their
+        ids, merging the orders of both tables by id
+
+        Args:
+            other: TrackingTable
+
+        Yields:
+            tuple - position of an entity in this table and in `other`,
+                    None in the table without the entity
+        """
+        order, other_order = self._sorted(), other._sorted()
+        ids, other_ids = self._ids, other._ids
+        index = other_index = 0
+        while index < len(order) and other_index < len(other_order):
+            position = order[index]
+            other_position = other_order[other_index]
+            synid, other_synid = ids[position], other_ids[other_position]
+            if synid == other_synid:
+                yield position, other_position
+                index += 1
+                other_index += 1
+            elif synid < other_synid:
+                yield position, None
+                index += 1
+            else:
+                yield None, other_position
+                other_index += 1
+        for position in order[index:]:
+            yield position, None
+        for other_position in other_order[other_index:]:
+            yield None, other_position
+
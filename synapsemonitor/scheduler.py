@@ -0,0 +1,138 @@
+"""Adaptive polling schedule of the daemon
+
+Each project is polled on its own interval.  The interval halves after a
+poll that found changes and grows by half after a poll that found none,
+within the minimum and maximum interval, so busy projects are polled more
+often than idle ones.  Polls are spread out with random jitter.
+"""
+import heapq
+import random
+
+DEFAULT_INTERVAL = 15 * 60
+DEFAULT_MIN_INTERVAL = 60
+DEFAULT_MAX_INTERVAL = 6 * 60 * 60
+DEFAULT_JITTER = 0.1
+# Interval factors after polls with and without changes
+BUSY_FACTOR = 0.5
+IDLE_FACTOR = 1.5
+
+
+class Scheduler:
+    """Polling schedule of several projects
+
+    Args:
+        projectids: Synapse project ids
+        now: Unix time the schedule starts
+        interval: Initial seconds between polls
+        min_interval: Minimum seconds between polls
+        max_interval: Maximum seconds between polls
+        jitter: Fraction of the interval polls are moved at random
+        saved: {Synapse project id: (interval, next poll)} of an earlier
+               schedule, from `state.get_schedule`
+    """
+    def __init__(self, projectids, now, interval=DEFAULT_INTERVAL,
+                 min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL, jitter=DEFAULT_JITTER,
+                 saved=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.random = random.Random()
+        self.intervals = {}
+        self._queue = []
+        saved = {} if saved is None else saved
+        for projectid in projectids:
+            if projectid in saved:
+                project_interval, next_run = saved[projectid]
+            else:
+                # Spread out the first polls
+                project_interval = interval
+                next_run = now + self.random.uniform(0, jitter * interval)
+            self.intervals[projectid] = self._clamp(project_interval)
+            heapq.heappush(self._queue, (next_run, projectid))
+
+    def _clamp(self, interval):
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def next_due_in(self, now):
+        """Seconds until the next poll is due, None if no poll is
+        scheduled"""
+        if not self._queue:
+            return None
+        return max(self._queue[0][0] - now, 0.0)
+
+    def pop_due(self, now):
+        """Removes the project whose poll is due the earliest from the
+        schedule until it is rescheduled
+
+        Returns:
+            str - Synapse project id or None if no poll is due
+        """
+        if not self._queue or self._queue[0][0] > now:
+            return None
+        return heapq.heappop(self._queue)[1]
+
+    def reschedule(self, projectid, changes, now):
+        """Schedules the next poll of a project after a poll
+
+        Args:
+            projectid: Synapse project id
+            changes: Number of entities the poll found changed, None if
+                     the poll failed
+            now: Unix time the poll finished
+
+        Returns:
+            float - Unix time of the next poll
+        """
+        interval = self.intervals[projectid]
+        if changes is not None:
+            interval = self._clamp(
+                interval * (BUSY_FACTOR if changes else IDLE_FACTOR)
+            )
+            self.intervals[projectid] = interval
+        next_run = now + interval * (
+            1 + self.random.uniform(-self.jitter, self.jitter)
+        )
+        heapq.heappush(self._queue, (next_run, projectid))
+        return next_run
+
+
+class RequestBudget:
+    """Global Synapse request rate budget.  Requests are paid for after
+    they are made, polls may start while the budget is not overdrawn.
+
+    Args:
+        rate: Requests per second
+        burst: Maximum number of requests saved up, defaults to a minute
+               of requests
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = 60 * rate if burst is None else burst
+        self.tokens = self.burst
+        self._requests = None
+        self._updated = None
+
+    def update(self, requests, now):
+        """Refills the budget and pays for the requests made since the last
+        update
+
+        Args:
+            requests: Total number of requests made so far
+            now: Unix time
+        """
+        if self._updated is not None:
+            self.tokens = min(
+                self.tokens + (now - self._updated) * self.rate, self.burst
+            )
+            self.tokens -= requests - self._requests
+        self._requests = requests
+        self._updated = now
+
+    def available(self):
+        """Whether a poll may start"""
+        return self.tokens > 0
+
+    def wait_time(self):
+        """Seconds until a poll may start"""
+        return 0.0 if self.available() else -self.tokens / self.rate
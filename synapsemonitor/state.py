@@ -0,0 +1,1123 @@
+"""Local monitoring state
+
+The last known tracking table snapshot of each project, the etags of the
+tracking tables it matches and the crawl watermark are kept in a SQLite
+database so that runs only download a tracking table when it was changed
+by someone else.  Sharded snapshots keep the etag of each shard.  The
+daemon also keeps its polling schedule here.
+
+Every change the monitor detects is appended to a change history, one
+compact row per event of integer project, time, entity, event type and
+contributor, indexed by project and time so that time ranges are
+summarized without querying Synapse.
+
+Crawls are checkpointed in the same database: the folders left to list,
+the listed entities not processed yet, the entities seen so far and the
+report of the run.  The database is in WAL mode and runs commit their
+changes before every Synapse request, so that projects monitored at the
+same time never wait on each other's network I/O.  Changes committed after
+the last checkpoint are made again when an interrupted crawl resumes, and
+the tracked rows they changed stay dirty until they are resolved against
+the tracking table.
+
+Each listed folder leaves a summary of its fingerprint, number of children
+and latest child modification, so that later crawls can skip folders whose
+subtree showed no change the last time it was listed.
+"""
+import collections
+import contextlib
+import itertools
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+from .crawler import FOLDER_TYPE, get_fingerprint
+from .records import TrackingTable, decode_synid, encode_synid
+from .writer import TRACKING_COLUMNS
+
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser("~"), ".synapsemonitor")
+STATE_DB = "state.db"
+# Bumped when the tracking snapshot or crawl checkpoint layout changes,
+# older snapshots are dropped and downloaded again
+SCHEMA_VERSION = 5
+# Maximum number of SQL parameters per statement
+SQL_BATCH_SIZE = 500
+# Seconds between commits of crawl checkpoints
+CHECKPOINT_INTERVAL = 30
+# Days of activity kept for dashboards
+ACTIVITY_DAYS = 31
+DAY = 24 * 60 * 60 * 1000
+
+# Event types of the change history, stored by index
+EVENTS = ("New", "Updated", "Deleted", "Moved")
+# Groupings of `count_events` and their SQL expressions
+EVENT_GROUPS = {
+    "event": "event",
+    "project": "project",
+    "actor": "actor",
+    "day": "date(time / 1000, 'unixepoch')",
+    "week": "strftime('%Y-W%W', time / 1000, 'unixepoch')",
+    "month": "strftime('%Y-%m', time / 1000, 'unixepoch')",
+}
+
+# Change history event, `time` is in Unix epoch milliseconds
+Event = collections.namedtuple(
+    "Event", ["projectid", "time", "event", "id", "actor"]
+)
+
+# Tracking table row in the local snapshot.  Dirty rows were changed locally
+# and written to the tracking table, but their row id and version are not
+# known yet.
+TrackedRow = collections.namedtuple(
+    "TrackedRow", TRACKING_COLUMNS + ["row_id", "row_version"]
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    projectid TEXT PRIMARY KEY,
+    tableid TEXT,
+    etag TEXT,
+    watermark INTEGER
+);
+CREATE TABLE IF NOT EXISTS tables (
+    projectid TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    tableid TEXT,
+    etag TEXT,
+    PRIMARY KEY (projectid, shard)
+);
+CREATE TABLE IF NOT EXISTS tracking (
+    projectid TEXT NOT NULL,
+    shard INTEGER NOT NULL DEFAULT 0,
+    id TEXT NOT NULL,
+    md5 TEXT,
+    name TEXT,
+    modifiedon INTEGER,
+    fingerprint TEXT,
+    parentid TEXT,
+    row_id INTEGER,
+    row_version INTEGER,
+    dirty INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (projectid, id)
+);
+CREATE INDEX IF NOT EXISTS tracking_shard ON tracking (projectid, shard);
+CREATE TABLE IF NOT EXISTS schedule (
+    projectid TEXT PRIMARY KEY,
+    interval REAL,
+    next_run REAL
+);
+CREATE TABLE IF NOT EXISTS crawls (
+    projectid TEXT PRIMARY KEY,
+    started INTEGER,
+    report TEXT
+);
+CREATE TABLE IF NOT EXISTS crawl_frontier (
+    projectid TEXT NOT NULL,
+    folderid TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (projectid, folderid)
+);
+CREATE TABLE IF NOT EXISTS crawl_headers (
+    projectid TEXT NOT NULL,
+    id TEXT NOT NULL,
+    header TEXT,
+    PRIMARY KEY (projectid, id)
+);
+CREATE TABLE IF NOT EXISTS crawl_seen (
+    projectid TEXT NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (projectid, id)
+);
+CREATE TABLE IF NOT EXISTS reported (
+    projectid TEXT NOT NULL,
+    status TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    type TEXT,
+    parentid TEXT,
+    modifiedby TEXT,
+    PRIMARY KEY (projectid, status, id)
+);
+CREATE TABLE IF NOT EXISTS events (
+    project INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    entity INTEGER NOT NULL,
+    event INTEGER NOT NULL,
+    actor INTEGER,
+    PRIMARY KEY (project, time, entity, event)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE TABLE IF NOT EXISTS activity_queue (
+    projectid TEXT NOT NULL,
+    id TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    actor TEXT,
+    PRIMARY KEY (projectid, id, time, event)
+);
+CREATE TABLE IF NOT EXISTS activity (
+    projectid TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    dimension TEXT NOT NULL,
+    value TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (projectid, day, dimension, value)
+);
+CREATE TABLE IF NOT EXISTS dashboards (
+    projectid TEXT PRIMARY KEY,
+    digest TEXT
+);
+CREATE TABLE IF NOT EXISTS folders (
+    projectid TEXT NOT NULL,
+    id TEXT NOT NULL,
+    parentid TEXT,
+    fingerprint TEXT,
+    children INTEGER,
+    last_modifiedon TEXT,
+    listed INTEGER,
+    changed INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (projectid, id)
+);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (projectid, parentid);
+CREATE TABLE IF NOT EXISTS filtered (
+    projectid TEXT NOT NULL,
+    id TEXT NOT NULL,
+    fingerprint TEXT,
+    digest TEXT,
+    PRIMARY KEY (projectid, id)
+);
+CREATE INDEX IF NOT EXISTS tracking_parent ON tracking (projectid, parentid);
+"""
+# Folders of a project below a folder, including the folder
+_SUBTREE = """
+WITH RECURSIVE subtree(id) AS (
+    VALUES (?)
+    UNION
+    SELECT folders.id FROM folders JOIN subtree
+    ON folders.parentid = subtree.id WHERE folders.projectid = ?
+)
+"""
+_CRAWL_TABLES = ["crawls", "crawl_frontier", "crawl_headers", "crawl_seen"]
+
+
+@contextlib.contextmanager
+def _connect(state_dir=None):
+    """Connects to the state database, creating it if needed.  Changes are
+    committed when the context exits without an error."""
+    state_dir = DEFAULT_STATE_DIR if state_dir is None else state_dir
+    os.makedirs(state_dir, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(state_dir, STATE_DB),
+                                 timeout=60)
+    try:
+        # Readers do not block the writer, and commits only sync the log
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            # Dropped snapshots must be downloaded again and crawls
+            # checkpointed against them start over
+            for table in ["tracking"] + _CRAWL_TABLES:
+                connection.execute(f"DROP TABLE IF EXISTS {table}")
+        connection.executescript(_SCHEMA)
+        if version < SCHEMA_VERSION:
+            connection.execute("UPDATE projects SET etag = NULL")
+            connection.execute("DELETE FROM tables")
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            connection.commit()
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def _get_project(connection, projectid):
+    """Gets the (tableid, etag, watermark) of a project"""
+    return connection.execute(
+        "SELECT tableid, etag, watermark FROM projects WHERE projectid = ?",
+        (projectid,)
+    ).fetchone()
+
+
+def _get_legacy_watermark(projectid, state_dir=None):
+    """Gets the watermark of a project from a JSON state file written by
+    earlier versions"""
+    state_dir = DEFAULT_STATE_DIR if state_dir is None else state_dir
+    path = os.path.join(state_dir, f"{projectid}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as state_file:
+        return json.load(state_file).get("watermark")
+
+
+def get_watermark(projectid, state_dir=None):
+    """Gets the high-water mark of the last successful monitoring run
+
+    Args:
+        projectid: Synapse project id
+        state_dir: Directory of state files (defaults to ~/.synapsemonitor)
+
+    Returns:
+        int - Unix epoch time in milliseconds or None if the project has
+              never been monitored
+    """
+    with _connect(state_dir) as connection:
+        project = _get_project(connection, projectid)
+    if project is None:
+        return _get_legacy_watermark(projectid, state_dir)
+    return project[2]
+
+
+def set_watermark(projectid, watermark, state_dir=None):
+    """Sets the high-water mark of a project
+
+    Args:
+        projectid: Synapse project id
+        watermark: Unix epoch time in milliseconds
+        state_dir: Directory of state files (defaults to ~/.synapsemonitor)
+    """
+    with _connect(state_dir) as connection:
+        connection.execute(
+            "INSERT INTO projects (projectid, watermark) VALUES (?, ?) "
+            "ON CONFLICT (projectid) DO UPDATE SET watermark = ?",
+            (projectid, watermark, watermark)
+        )
+
+
+def get_shard(synid, shards):
+    """Gets the tracking table shard of an entity from a stable hash of its
+    Synapse id
+
+    Args:
+        synid: Synapse id
+        shards: Number of tracking tables
+
+    Returns:
+        int - shard index
+    """
+    return zlib.crc32(synid.encode()) % shards
+
+
+def _get_table_etag(connection, projectid, tableid):
+    row = connection.execute(
+        "SELECT etag FROM tables WHERE projectid = ? AND tableid = ?",
+        (projectid, tableid)
+    ).fetchone()
+    return None if row is None else row[0]
+
+
+def get_table_etag(projectid, tableid, state_dir=None):
+    """Gets the tracking table etag the local snapshot matches
+
+    Args:
+        projectid: Synapse project id
+        tableid: Synapse id of the tracking table
+        state_dir: Directory of state files (defaults to ~/.synapsemonitor)
+
+    Returns:
+        str - etag or None if there is no snapshot of this table
+    """
+    with _connect(state_dir) as connection:
+        return _get_table_etag(connection, projectid, tableid)
+
+
+def _filter_events(projectids=None, start=None, end=None):
+    """WHERE clause and parameters of the events of projects in a time
+    range"""
+    clauses, params = ["1"], []
+    if projectids is not None:
+        projectids = list(projectids)
+        clauses.append(f"project IN ({', '.join('?' * len(projectids))})")
+        params += [encode_synid(projectid) for projectid in projectids]
+    if start is not None:
+        clauses.append("time >= ?")
+        params.append(start)
+    if end is not None:
+        clauses.append("time < ?")
+        params.append(end)
+    return " AND ".join(clauses), params
+
+
+def iter_events(projectids=None, start=None, end=None, state_dir=None):
+    """Yields the change history of projects in time order
+
+    Args:
+        projectids: Synapse project ids, every project if None
+        start: Unix epoch time in milliseconds of the first events
+        end: Unix epoch time in milliseconds after the last events
+        state_dir: Directory of state files (defaults to ~/.synapsemonitor)
+
+    Yields:
+        Event
+    """
+    where, params = _filter_events(projectids, start, end)
+    with _connect(state_dir) as connection:
+        cursor = connection.execute(
+            "SELECT project, time, event, entity, actor FROM events "
+            f"WHERE {where} ORDER BY time, project, entity", params
+        )
+        for rows in iter(lambda: cursor.fetchmany(SQL_BATCH_SIZE), []):
+            for project, event_time, event, entity, actor in rows:
+                yield Event(decode_synid(project), event_time, EVENTS[event],
+                            decode_synid(entity),
+                            None if actor is None else str(actor))
+
+
+def count_events(projectids=None, start=None, end=None, by="event",
+                 state_dir=None):
+    """Counts the change history of projects by event type and a grouping
+
+    Args:
+        projectids: Synapse project ids, every project if None
+        start: Unix epoch time in milliseconds of the first events
+        end: Unix epoch time in milliseconds after the last events
+        by: Grouping of EVENT_GROUPS
+        state_dir: Directory of state files (defaults to ~/.synapsemonitor)
+
+    Returns:
+        dict - {group: {event type: count}} in group order
+    """
+    if by not in EVENT_GROUPS:
+        raise ValueError(f"Cannot count events by {by}")
+    decode = {"event": EVENTS.__getitem__, "project": decode_synid,
+              "actor": lambda actor: None if actor is None else str(actor)}
+    where, params = _filter_events(projectids, start, end)
+    counts = {}
+    with _connect(state_dir) as connection:
+        for group, event, count in connection.execute(
+                f"SELECT {EVENT_GROUPS[by]}, event, COUNT(*) FROM events "
+                f"WHERE {where} GROUP BY 1, 2 ORDER BY 1, 2", params):
+            group = decode.get(by, lambda value: value)(group)
+            counts.setdefault(group, {})[EVENTS[event]] = count
+    return counts
+
+
+def get_schedule(state_dir=None):
+    """Gets the polling schedule of the daemon
+
+    Args:
+        state_dir: Directory of state files (defaults to ~/.synapsemonitor)
+
+    Returns:
+        dict - {Synapse project id: (interval in seconds, Unix time of the
+                next poll)}
+    """
+    with _connect(state_dir) as connection:
+        return {projectid: (interval, next_run) for projectid, interval,
+                next_run in connection.execute("SELECT * FROM schedule")}
+
+
+def set_schedule(projectid, interval, next_run, state_dir=None):
+    """Sets the polling interval and next poll of a project
+
+    Args:
+        projectid: Synapse project id
+        interval: Seconds between polls
+        next_run: Unix time of the next poll
+        state_dir: Directory of state files (defaults to ~/.synapsemonitor)
+    """
+    with _connect(state_dir) as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO schedule VALUES (?, ?, ?)",
+            (projectid, interval, next_run)
+        )
+
+
+def get_snapshot(projectid, state_dir=None, shard=0):
+    """Gets the local tracking table snapshot of a project
+
+    Args:
+        projectid: Synapse project id
+        state_dir: Directory of state files (defaults to ~/.synapsemonitor)
+        shard: Tracking table shard
+
+    Returns:
+        records.TrackingTable - tracked entities with their row ids and
+                                versions
+    """
+    with _connect(state_dir) as connection:
+        return TrackingTable(connection.execute(
+            "SELECT id, md5, name, modifiedon, fingerprint, parentid, "
+            "row_id, row_version FROM tracking "
+            "WHERE projectid = ? AND shard = ?",
+            (projectid, shard)
+        ))
+
+
+def save_snapshot(projectid, tableid, etag, tracking_table, state_dir=None,
+                  shard=0):
+    """Replaces the local tracking table snapshot of a project
+
+    Args:
+        projectid: Synapse project id
+        tableid: Synapse id of the tracking table
+        etag: Etag of the tracking table
+        tracking_table: records.TrackingTable of the tracking table rows
+                        with their row ids and versions
+        state_dir: Directory of state files (defaults to ~/.synapsemonitor)
+        shard: Tracking table shard
+    """
+    with _connect(state_dir) as connection:
+        connection.execute(
+            "DELETE FROM tracking WHERE projectid = ? AND shard = ?",
+            (projectid, shard)
+        )
+        connection.executemany(
+            "INSERT INTO tracking VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+            ((projectid, shard) + row for row in tracking_table)
+        )
+        _set_table_etag(connection, projectid, shard, tableid, etag)
+
+
+def _set_table_etag(connection, projectid, shard, tableid, etag):
+    """Sets the tracking table and etag a shard of the local snapshot
+    matches"""
+    connection.execute("INSERT OR REPLACE INTO tables VALUES (?, ?, ?, ?)",
+                       (projectid, shard, tableid, etag))
+
+
+def _iter_batches(iterable, batch_size=SQL_BATCH_SIZE):
+    """Yields lists of at most `batch_size` items"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class Snapshot:
+    """Local tracking table snapshot of a project used as the tracking
+    index during a run, without loading it into memory.  Changes are
+    committed before Synapse requests, at crawl checkpoints and when the
+    context exits without an error, so that the database is never locked
+    while waiting on Synapse.
+
+    Args:
+        projectid: Synapse project id
+        state_dir: Directory of state files (defaults to ~/.synapsemonitor)
+        shards: Number of tracking tables
+        activity: Queue the recent changes for the activity dashboard
+    """
+    _COLUMNS = ", ".join(TrackedRow._fields)
+
+    def __init__(self, projectid, state_dir=None, shards=1, activity=False):
+        self.projectid = projectid
+        self.state_dir = state_dir
+        self.shards = shards
+        self.activity = activity
+        self.connection = None
+        self._context = None
+
+    def __enter__(self):
+        self._context = _connect(self.state_dir)
+        self.connection = self._context.__enter__()
+        self._checkpointed = time.monotonic()
+        self._processed = []
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection = None
+        return self._context.__exit__(*exc_info)
+
+    def shard_of(self, synid):
+        """Tracking table shard of an entity"""
+        return get_shard(synid, self.shards)
+
+    def _where(self, shard):
+        """WHERE clause and parameters of the rows of a shard, or of every
+        row if `shard` is None"""
+        if shard is None:
+            return "projectid = ?", (self.projectid,)
+        return "projectid = ? AND shard = ?", (self.projectid, shard)
+
+    def get_tables(self):
+        """Gets the tracking tables the snapshot matches
+
+        Returns:
+            dict - {shard: (Synapse id of the tracking table, etag)}
+        """
+        return {shard: (tableid, etag) for shard, tableid, etag in
+                self.connection.execute(
+                    "SELECT shard, tableid, etag FROM tables "
+                    "WHERE projectid = ?", (self.projectid,)
+                )}
+
+    def get_table_etag(self, tableid):
+        """Gets the tracking table etag the snapshot matches, None if the
+        snapshot is not of this table"""
+        return _get_table_etag(self.connection, self.projectid, tableid)
+
+    def set_table_etag(self, tableid, etag, shard=0):
+        """Sets the tracking table and etag a shard of the snapshot
+        matches"""
+        _set_table_etag(self.connection, self.projectid, shard, tableid,
+                        etag)
+
+    def clear(self):
+        """Removes every tracked row and tracking table of the snapshot"""
+        for table in ("tracking", "tables"):
+            self.connection.execute(
+                f"DELETE FROM {table} WHERE projectid = ?", (self.projectid,)
+            )
+
+    def count(self, shard=None):
+        """Number of tracked rows, of a shard if `shard` is not None"""
+        where, params = self._where(shard)
+        return self.connection.execute(
+            f"SELECT COUNT(*) FROM tracking WHERE {where}", params
+        ).fetchone()[0]
+
+    def replace(self, rows, shard=None):
+        """Replaces the snapshot, or a shard of it
+
+        Args:
+            rows: Iterable of TrackedRow
+            shard: Shard replaced, every shard if None
+        """
+        where, params = self._where(shard)
+        self.connection.execute(f"DELETE FROM tracking WHERE {where}", params)
+        for batch in _iter_batches(rows):
+            self.connection.executemany(
+                f"INSERT INTO tracking (projectid, shard, {self._COLUMNS}) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(self.projectid, self.shard_of(row.id)) + tuple(row)
+                 for row in batch]
+            )
+
+    def lookup(self, synids):
+        """Gets the tracked rows of entities
+
+        Args:
+            synids: Synapse ids
+
+        Returns:
+            dict - {Synapse id: TrackedRow} of the tracked entities
+        """
+        tracked = {}
+        for batch in _iter_batches(synids):
+            params = ", ".join("?" * len(batch))
+            for row in self.connection.execute(
+                    f"SELECT {self._COLUMNS} FROM tracking "
+                    f"WHERE projectid = ? AND id IN ({params})",
+                    [self.projectid] + batch):
+                tracked[row[0]] = TrackedRow(*row)
+        return tracked
+
+    def start_crawl(self, rootid, started, resume=False):
+        """Starts a crawl checkpoint, or continues the last one
+
+        Args:
+            rootid: Synapse id of the container to crawl
+            started: Unix epoch time in milliseconds the crawl starts
+            resume: Continue the checkpoint of an unfinished crawl if there
+                    is one
+
+        Returns:
+            tuple - time the crawl started, report saved with the last
+                    checkpoint or None
+        """
+        crawl = self.connection.execute(
+            "SELECT started, report FROM crawls WHERE projectid = ?",
+            (self.projectid,)
+        ).fetchone()
+        if resume and crawl is not None:
+            return crawl[0], None if crawl[1] is None else json.loads(crawl[1])
+        self.finish_crawl()
+        self.connection.execute("DELETE FROM reported WHERE projectid = ?",
+                                (self.projectid,))
+        self.connection.execute("INSERT INTO crawls VALUES (?, ?, NULL)",
+                                (self.projectid, started))
+        self.connection.execute(
+            "INSERT INTO crawl_frontier VALUES (?, ?, '')",
+            (self.projectid, rootid)
+        )
+        return started, None
+
+    def get_frontier(self):
+        """Gets the (Synapse id, path) of the containers left to list"""
+        return self.connection.execute(
+            "SELECT folderid, path FROM crawl_frontier WHERE projectid = ?",
+            (self.projectid,)
+        ).fetchall()
+
+    def get_crawled_headers(self):
+        """Gets the headers of the listed entities that were not processed
+        yet.  Crawls only list ahead of processing by a few folders, so
+        there are few of them."""
+        return [json.loads(row[0]) for row in self.connection.execute(
+            "SELECT header FROM crawl_headers WHERE projectid = ?",
+            (self.projectid,)
+        )]
+
+    def add_listing(self, folderid, children):
+        """Records the listing of a container in the crawl checkpoint,
+        replacing the container with its sub folders in the frontier, and
+        updates the summary of the container.  The summary changed if the
+        number of children or their latest modification did.
+
+        Args:
+            folderid: Synapse id of the container
+            children: Headers of the children of the container
+        """
+        self.connection.execute(
+            "DELETE FROM crawl_frontier WHERE projectid = ? AND folderid = ?",
+            (self.projectid, folderid)
+        )
+        last_modifiedon = max((child['modifiedOn'] for child in children),
+                              default=None)
+        self.connection.execute(
+            "INSERT INTO folders (projectid, id, children, last_modifiedon, "
+            "listed) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (projectid, id) DO UPDATE SET "
+            "changed = (children IS NOT excluded.children OR "
+            "last_modifiedon IS NOT excluded.last_modifiedon), "
+            "children = excluded.children, "
+            "last_modifiedon = excluded.last_modifiedon, "
+            "listed = excluded.listed",
+            (self.projectid, folderid, len(children), last_modifiedon,
+             int(time.time() * 1000))
+        )
+        # Forget the sub folders that are no longer in the container
+        subfolders = {child['id'] for child in children
+                      if child['type'] == FOLDER_TYPE}
+        removed = [synid for synid, in self.connection.execute(
+            "SELECT id FROM folders WHERE projectid = ? AND parentid = ?",
+            (self.projectid, folderid)
+        ) if synid not in subfolders]
+        for batch in _iter_batches(removed):
+            self.connection.execute(
+                "DELETE FROM folders WHERE projectid = ? AND "
+                f"id IN ({', '.join('?' * len(batch))})",
+                [self.projectid] + batch
+            )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO crawl_frontier VALUES (?, ?, ?)",
+            [(self.projectid, child['id'], child['path'])
+             for child in children if child['type'] == FOLDER_TYPE]
+        )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO crawl_headers VALUES (?, ?, ?)",
+            [(self.projectid, child['id'], json.dumps(child))
+             for child in children if child['type'] != FOLDER_TYPE]
+        )
+
+    def should_list(self, header, max_age=0):
+        """Decides whether to list a folder of the crawl and records its
+        fingerprint.  Folders are listed unless their fingerprint is
+        unchanged and every folder of their subtree was listed less than
+        `max_age` seconds ago without its summary changing.
+
+        Args:
+            header: Entity header of the folder
+            max_age: Seconds a folder may go without being listed, every
+                     folder is listed if 0
+
+        Returns:
+            bool - whether to list the folder
+        """
+        folderid = header['id']
+        fingerprint = get_fingerprint(header)
+        known = self.connection.execute(
+            "SELECT fingerprint FROM folders WHERE projectid = ? AND id = ?",
+            (self.projectid, folderid)
+        ).fetchone()
+        self.connection.execute(
+            "INSERT INTO folders (projectid, id, parentid, fingerprint) "
+            "VALUES (?, ?, ?, ?) ON CONFLICT (projectid, id) DO UPDATE SET "
+            "parentid = excluded.parentid, "
+            "fingerprint = excluded.fingerprint",
+            (self.projectid, folderid, header['parentId'], fingerprint)
+        )
+        if not max_age or known is None or known[0] != fingerprint:
+            return True
+        return self.connection.execute(
+            _SUBTREE + "SELECT 1 FROM folders WHERE projectid = ? AND "
+            "id IN subtree AND (listed IS NULL OR listed < ? OR changed) "
+            "LIMIT 1",
+            (folderid, self.projectid, self.projectid,
+             int((time.time() - max_age) * 1000))
+        ).fetchone() is not None
+
+    def add_folders(self, folders):
+        """Records the container of folders that are not listed, so that
+        the tracked entities of their subtree can be skipped.  Folders that
+        are already known are left as they are.
+
+        Args:
+            folders: Iterable of (Synapse id, container Synapse id)
+        """
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO folders (projectid, id, parentid) "
+            "VALUES (?, ?, ?)",
+            ((self.projectid, folderid, parentid)
+             for folderid, parentid in folders)
+        )
+
+    def skip_folder(self, folderid):
+        """Removes a folder that is not listed from the frontier and marks
+        the tracked entities of its subtree as crawled, as if it had been.
+        The subtree is made of the known folders below it.
+
+        Args:
+            folderid: Synapse id of the folder
+
+        Returns:
+            int - number of tracked entities marked as crawled
+        """
+        self.connection.execute(
+            "DELETE FROM crawl_frontier WHERE projectid = ? AND folderid = ?",
+            (self.projectid, folderid)
+        )
+        # The rowcount of statements starting with WITH is not set
+        changes = self.connection.total_changes
+        self.connection.execute(
+            _SUBTREE + "INSERT OR IGNORE INTO crawl_seen "
+            "SELECT projectid, id FROM tracking "
+            "WHERE projectid = ? AND parentid IN subtree",
+            (folderid, self.projectid, self.projectid)
+        )
+        return self.connection.total_changes - changes
+
+    def is_container(self, synid):
+        """Whether an entity is the project or one of its known folders"""
+        return synid == self.projectid or self.connection.execute(
+            "SELECT 1 FROM folders WHERE projectid = ? AND id = ?",
+            (self.projectid, synid)
+        ).fetchone() is not None
+
+    def mark_processed(self, synid):
+        """Marks a crawled entity as processed, the next checkpoint removes
+        it from the entities left to process"""
+        self._processed.append(synid)
+
+    def commit(self):
+        """Commits the snapshot changes made so far, ending the write
+        transaction"""
+        self.connection.commit()
+
+    def checkpoint(self, report):
+        """Commits the crawl checkpoint and the snapshot changes made so far
+
+        Args:
+            report: Report of the run as a JSON serializable dict
+        """
+        self.connection.executemany(
+            "DELETE FROM crawl_headers WHERE projectid = ? AND id = ?",
+            [(self.projectid, synid) for synid in self._processed]
+        )
+        self._processed = []
+        self.connection.execute(
+            "UPDATE crawls SET report = ? WHERE projectid = ?",
+            (json.dumps(report), self.projectid)
+        )
+        self.commit()
+        self._checkpointed = time.monotonic()
+
+    def checkpoint_due(self):
+        """Whether the last checkpoint is older than CHECKPOINT_INTERVAL"""
+        return time.monotonic() - self._checkpointed >= CHECKPOINT_INTERVAL
+
+    def finish_crawl(self):
+        """Removes the crawl checkpoint"""
+        for table in _CRAWL_TABLES:
+            self.connection.execute(
+                f"DELETE FROM {table} WHERE projectid = ?", (self.projectid,)
+            )
+
+    def mark_seen(self, synids):
+        """Marks entities as crawled during this crawl"""
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO crawl_seen VALUES (?, ?)",
+            [(self.projectid, synid) for synid in synids]
+        )
+
+    def iter_unseen(self):
+        """Yields the TrackedRow of each clean tracked entity that was not
+        crawled during this crawl"""
+        # Copied so that rows can be changed while iterating
+        self.connection.execute("DROP TABLE IF EXISTS temp.unseen")
+        self.connection.execute(
+            f"CREATE TEMP TABLE unseen AS SELECT {self._COLUMNS} "
+            "FROM tracking WHERE projectid = ? AND dirty = 0 AND id NOT IN "
+            "(SELECT id FROM crawl_seen WHERE projectid = ?)",
+            (self.projectid, self.projectid)
+        )
+        cursor = self.connection.execute("SELECT * FROM temp.unseen")
+        for rows in iter(lambda: cursor.fetchmany(SQL_BATCH_SIZE), []):
+            for row in rows:
+                yield TrackedRow(*row)
+
+    def delete_unseen(self):
+        """Removes the entities that were not crawled during this crawl"""
+        self.connection.execute(
+            "DELETE FROM tracking WHERE projectid = ? AND id NOT IN "
+            "(SELECT id FROM crawl_seen WHERE projectid = ?)",
+            (self.projectid, self.projectid)
+        )
+
+    def mark_deleted(self, synid):
+        """Marks a tracked entity whose row is deleted from the tracking
+        table dirty, until `delete_unseen` or `resolve` removes it"""
+        self.connection.execute(
+            "UPDATE tracking SET dirty = 1 WHERE projectid = ? AND id = ?",
+            (self.projectid, synid)
+        )
+
+    def upsert(self, values):
+        """Adds or changes a tracked entity, keeping the row id and version
+        of a changed entity, and marks it dirty
+
+        Args:
+            values: Tracking column values
+        """
+        self.connection.execute(
+            "INSERT INTO tracking (projectid, shard, id, md5, name, "
+            "modifiedon, fingerprint, parentid, dirty) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1) "
+            "ON CONFLICT (projectid, id) DO UPDATE SET md5 = excluded.md5, "
+            "name = excluded.name, modifiedon = excluded.modifiedon, "
+            "fingerprint = excluded.fingerprint, "
+            "parentid = excluded.parentid, dirty = 1",
+            (self.projectid, self.shard_of(values[0])) +
+            tuple(values[:len(TRACKING_COLUMNS)])
+        )
+
+    def add_reported(self, status, record):
+        """Keeps a reported entity of the crawl for the digest
+
+        Args:
+            status: Status of the entity
+            record: crawler.EntityRecord
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO reported VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (self.projectid, status, record.id, record.name, record.type,
+             record.parentid, record.modifiedby)
+        )
+
+    def add_event(self, status, record):
+        """Appends a change to the change history.  Changes are dated by
+        the modification of the entity, deletions when they are detected.
+
+        Args:
+            status: "New", "Updated", "Deleted" or "Moved"
+            record: crawler.EntityRecord
+        """
+        now = int(time.time() * 1000)
+        event_time = now if status == "Deleted" else record.modifiedon
+        self.connection.execute(
+            "INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?)",
+            (encode_synid(self.projectid), event_time,
+             encode_synid(record.id), EVENTS.index(status),
+             None if record.modifiedby is None else int(record.modifiedby))
+        )
+        if (self.activity and status != "Deleted" and
+                event_time >= now - ACTIVITY_DAYS * DAY):
+            self.connection.execute(
+                "INSERT OR IGNORE INTO activity_queue VALUES (?, ?, ?, ?, ?)",
+                (self.projectid, record.id, event_time, status,
+                 record.modifiedby)
+            )
+
+    def start_activity(self, now):
+        """Queues the recent changes of the change history the first time
+        the activity of the project is kept
+
+        Args:
+            now: Unix epoch time in milliseconds
+        """
+        if self.connection.execute(
+                "SELECT 1 FROM dashboards WHERE projectid = ?",
+                (self.projectid,)).fetchone() is not None:
+            return
+        self.connection.execute(
+            "INSERT OR IGNORE INTO activity_queue "
+            "SELECT ?, 'syn' || entity, time, CASE event "
+            + " ".join(f"WHEN {index} THEN '{event}'"
+                       for index, event in enumerate(EVENTS)) +
+            " END, CAST(actor AS TEXT) FROM events "
+            "WHERE project = ? AND time >= ? AND event != ?",
+            (self.projectid, encode_synid(self.projectid),
+             now - ACTIVITY_DAYS * DAY, EVENTS.index("Deleted"))
+        )
+        self.connection.execute("INSERT INTO dashboards VALUES (?, NULL)",
+                                (self.projectid,))
+
+    def get_activity_queue(self, limit=SQL_BATCH_SIZE):
+        """Gets up to `limit` queued changes
+
+        Returns:
+            list - (Synapse id, time, event type, contributor)
+        """
+        return self.connection.execute(
+            "SELECT id, time, event, actor FROM activity_queue "
+            "WHERE projectid = ? LIMIT ?", (self.projectid, limit)
+        ).fetchall()
+
+    def add_activity(self, changes):
+        """Counts queued changes in the activity of their day and removes
+        them from the queue
+
+        Args:
+            changes: Iterable of ((Synapse id, time, event type,
+                     contributor), {dimension: value})
+        """
+        for (synid, event_time, event, actor), values in changes:
+            for dimension, value in values.items():
+                if value is None:
+                    continue
+                self.connection.execute(
+                    "INSERT INTO activity VALUES (?, ?, ?, ?, 1) "
+                    "ON CONFLICT (projectid, day, dimension, value) "
+                    "DO UPDATE SET count = count + 1",
+                    (self.projectid, event_time // DAY, dimension,
+                     str(value))
+                )
+            self.connection.execute(
+                "DELETE FROM activity_queue WHERE projectid = ? AND id = ? "
+                "AND time = ? AND event = ?",
+                (self.projectid, synid, event_time, event)
+            )
+
+    def prune_activity(self, now):
+        """Removes the activity older than ACTIVITY_DAYS"""
+        self.connection.execute(
+            "DELETE FROM activity WHERE projectid = ? AND day < ?",
+            (self.projectid, (now - ACTIVITY_DAYS * DAY) // DAY)
+        )
+
+    def count_activity(self, dimension, since, limit):
+        """Counts the changes since a time by the values of a dimension
+
+        Args:
+            dimension: Dimension of the activity
+            since: Unix epoch time in milliseconds, counted from the start
+                   of its day
+            limit: Maximum number of values
+
+        Returns:
+            list - (value, count) of the values with the most changes
+        """
+        return self.connection.execute(
+            "SELECT value, SUM(count) FROM activity "
+            "WHERE projectid = ? AND dimension = ? AND day >= ? "
+            "GROUP BY value ORDER BY SUM(count) DESC, value LIMIT ?",
+            (self.projectid, dimension, since // DAY, limit)
+        ).fetchall()
+
+    def get_filtered(self, synids, digest):
+        """Gets the entities excluded by the annotations of a filter
+
+        Args:
+            synids: Synapse ids
+            digest: Digest of the filter
+
+        Returns:
+            dict - {Synapse id: fingerprint when it was excluded}
+        """
+        filtered = {}
+        for batch in _iter_batches(synids):
+            filtered.update(self.connection.execute(
+                "SELECT id, fingerprint FROM filtered WHERE projectid = ? "
+                f"AND digest = ? AND id IN ({', '.join('?' * len(batch))})",
+                [self.projectid, digest] + batch
+            ))
+        return filtered
+
+    def set_filtered(self, fingerprints, digest):
+        """Records entities excluded by the annotations of a filter
+
+        Args:
+            fingerprints: {Synapse id: fingerprint} of the entities
+            digest: Digest of the filter
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO filtered VALUES (?, ?, ?, ?)",
+            [(self.projectid, synid, fingerprint, digest)
+             for synid, fingerprint in fingerprints.items()]
+        )
+
+    def get_dashboard_digest(self):
+        """Gets the digest of the last published dashboard"""
+        row = self.connection.execute(
+            "SELECT digest FROM dashboards WHERE projectid = ?",
+            (self.projectid,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def set_dashboard_digest(self, digest):
+        """Sets the digest of the last published dashboard"""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO dashboards VALUES (?, ?)",
+            (self.projectid, digest)
+        )
+
+    def count_reported(self, status, column, limit):
+        """Counts the reported entities of a status by a column
+
+        Args:
+            status: Status of the entities
+            column: "parentid", "type" or "modifiedby"
+            limit: Maximum number of groups
+
+        Returns:
+            list - (value, count) of the largest groups
+        """
+        if column not in ("parentid", "type", "modifiedby"):
+            raise ValueError(f"Cannot count reported entities by {column}")
+        return self.connection.execute(
+            f"SELECT {column}, COUNT(*) FROM reported "
+            "WHERE projectid = ? AND status = ? "
+            f"GROUP BY {column} ORDER BY COUNT(*) DESC, {column} LIMIT ?",
+            (self.projectid, status, limit)
+        ).fetchall()
+
+    def iter_reported(self):
+        """Yields (status, id, name, type, parentid, modifiedby) of each
+        entity reported by the last crawl"""
+        cursor = self.connection.execute(
+            "SELECT status, id, name, type, parentid, modifiedby "
+            "FROM reported WHERE projectid = ? ORDER BY status, id",
+            (self.projectid,)
+        )
+        for rows in iter(lambda: cursor.fetchmany(SQL_BATCH_SIZE), []):
+            yield from rows
+
+    def count_dirty(self, shard=None):
+        """Number of dirty rows, of a shard if `shard` is not None"""
+        where, params = self._where(shard)
+        return self.connection.execute(
+            f"SELECT COUNT(*) FROM tracking WHERE {where} AND dirty = 1",
+            params
+        ).fetchone()[0]
+
+    def get_dirty_ids(self, limit=SQL_BATCH_SIZE, shard=None):
+        """Gets the Synapse ids of up to `limit` dirty rows, of a shard if
+        `shard` is not None"""
+        where, params = self._where(shard)
+        return [row[0] for row in self.connection.execute(
+            f"SELECT id FROM tracking WHERE {where} AND dirty = 1 LIMIT ?",
+            params + (limit,)
+        )]
+
+    def resolve(self, synids, rows):
+        """Replaces dirty rows with their tracking table rows.  Dirty
+        entities that are not in the tracking table are removed.
+
+        Args:
+            synids: Synapse ids of the dirty rows that were queried
+            rows: TrackedRow of the queried entities in the tracking table
+        """
+        self.connection.executemany(
+            "UPDATE tracking SET md5 = ?, name = ?, modifiedon = ?, "
+            "fingerprint = ?, parentid = ?, row_id = ?, row_version = ?, "
+            "dirty = 0 "
+            "WHERE projectid = ? AND id = ?",
+            [tuple(row[1:]) + (self.projectid, row.id) for row in rows]
+        )
+        self.connection.executemany(
+            "DELETE FROM tracking WHERE projectid = ? AND id = ? "
+            "AND dirty = 1", [(self.projectid, synid) for synid in synids]
+        )
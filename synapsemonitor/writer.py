@@ -0,0 +1,202 @@
+"""Writes changes to the tracking tables"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import os
+import tempfile
+
+TRACKING_COLUMNS = ['id', 'md5', 'name', 'modifiedon', 'fingerprint',
+                    'parentid']
+ROW_COLUMNS = ['ROW_ID', 'ROW_VERSION']
+# Maximum number of rows sent per table update
+WRITE_BATCH_SIZE = 5000
+
+# Row that makes `write_rows` and `write_shards` send the rows they have
+# so far
+FLUSH = object()
+
+Changeset = collections.namedtuple("Changeset",
+                                   ["appends", "updates", "deletes"])
+
+
+def get_changeset(current, tracked):
+    """Computes the minimal set of rows to append, update and delete
+
+    Args:
+        current: records.TrackingTable of the entities to track
+        tracked: records.TrackingTable of the tracking table rows with
+                 their row ids and versions
+
+    Returns:
+        Changeset - lists of tracking column values to append, of row id,
+                    row version and tracking column values to update and
+                    of row id and version to delete
+    """
+    changeset = Changeset(appends=[], updates=[], deletes=[])
+    for position, tracked_position in current.join(tracked):
+        if tracked_position is None:
+            changeset.appends.append(current.values(position))
+        elif position is None:
+            changeset.deletes.append(tracked.row_ids(tracked_position))
+        elif current.is_changed(position, tracked, tracked_position):
+            changeset.updates.append(tracked.row_ids(tracked_position) +
+                                     current.values(position))
+    return changeset
+
+
+def _format_value(value):
+    """Formats a value for table CSV upload, integers stored as floats
+    are written as integers"""
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else str(value)
+    return str(value)
+
+
+def append_row(values):
+    """CSV row appending tracking column `values`"""
+    return ['', ''] + [_format_value(value) for value in values]
+
+
+def update_row(row_id, row_version, values):
+    """CSV row updating a row with tracking column `values`"""
+    return [_format_value(value)
+            for value in [row_id, row_version] + list(values)]
+
+
+def delete_row(row_id, row_version):
+    """CSV row deleting a row, deleted rows only have ROW_ID and
+    ROW_VERSION"""
+    return [_format_value(row_id), _format_value(row_version)] + \
+        [''] * len(TRACKING_COLUMNS)
+
+
+def _iter_changeset_rows(changeset):
+    """Yields CSV rows with ROW_ID, ROW_VERSION and tracking columns"""
+    for values in changeset.appends:
+        yield append_row(values)
+    for row in changeset.updates:
+        yield update_row(row[0], row[1], row[2:])
+    for row_id, row_version in changeset.deletes:
+        yield delete_row(row_id, row_version)
+
+
+def _store_batch(syn, tableid, rows, etag):
+    """Stores a batch of CSV rows and returns the new table etag"""
+    import synapseclient
+
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="",
+                                     delete=False) as update_file:
+        writer = csv.writer(update_file)
+        writer.writerow(ROW_COLUMNS + TRACKING_COLUMNS)
+        writer.writerows(rows)
+    try:
+        stored = syn.store(synapseclient.Table(tableid, update_file.name,
+                                               etag=etag))
+    finally:
+        os.unlink(update_file.name)
+    return getattr(stored, 'etag', None)
+
+
+def write_shards(syn, tableids, rows, etags=None,
+                 batch_size=WRITE_BATCH_SIZE, before_store=None,
+                 after_store=None):
+    """Sends CSV rows to sharded tracking tables in batches of at most
+    `batch_size` rows per table.  Only tables with rows are sent to, the
+    pending batches of different tables are sent concurrently.
+
+    Args:
+        syn: Synapse connection
+        tableids: Synapse id of the tracking table of each shard
+        rows: Iterable of (shard, row) with rows from `append_row`,
+              `update_row` and `delete_row`.  A FLUSH row sends the rows so
+              far.
+        etags: {shard: etag} of the tracking tables the rows are based on
+        batch_size: Maximum number of rows per table update
+        before_store: Function called without arguments before batches are
+                      sent
+        after_store: Function called with {shard: etag} after batches are
+                     sent and at each FLUSH row
+
+    Returns:
+        dict - {shard: etag} of the tracking tables after the update
+    """
+    etags = dict(etags or {})
+    batches = collections.defaultdict(list)
+
+    def store(shards):
+        shards = [shard for shard in shards if batches[shard]]
+        if shards:
+            if before_store is not None:
+                before_store()
+            with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                stored = {
+                    shard: executor.submit(_store_batch, syn, tableids[shard],
+                                           batches[shard], etags.get(shard))
+                    for shard in shards
+                }
+            for shard, future in stored.items():
+                etags[shard] = future.result()
+                batches[shard].clear()
+        if after_store is not None:
+            after_store(dict(etags))
+
+    for row in rows:
+        if row is FLUSH:
+            store(list(batches))
+            continue
+        shard, row = row
+        batches[shard].append(row)
+        if len(batches[shard]) == batch_size:
+            store([shard])
+    if any(batches.values()):
+        store(list(batches))
+    return etags
+
+
+def write_rows(syn, tableid, rows, etag=None, batch_size=WRITE_BATCH_SIZE,
+               before_store=None, after_store=None):
+    """Sends CSV rows to the tracking table in batches of at most
+    `batch_size` rows.  Nothing is sent if there are no rows.
+
+    Args:
+        syn: Synapse connection
+        tableid: Synapse id of the tracking table
+        rows: Iterable of rows from `append_row`, `update_row` and
+              `delete_row`.  A FLUSH row sends the rows so far.
+        etag: Etag of the tracking table the rows are based on
+        batch_size: Maximum number of rows per table update
+        before_store: Function called without arguments before each batch
+                      is sent
+        after_store: Function called with the table etag after each batch
+                     is sent and at each FLUSH row
+
+    Returns:
+        str - Etag of the tracking table after the update
+    """
+    etags = write_shards(
+        syn, [tableid],
+        (row if row is FLUSH else (0, row) for row in rows),
+        etags={0: etag}, batch_size=batch_size, before_store=before_store,
+        after_store=(None if after_store is None
+                     else lambda etags: after_store(etags[0]))
+    )
+    return etags[0]
+
+
+def write_changeset(syn, tableid, changeset, etag=None,
+                    batch_size=WRITE_BATCH_SIZE):
+    """Sends a changeset to the tracking table in batches of at most
+    `batch_size` rows.  Nothing is sent if there are no changes.
+
+    Args:
+        syn: Synapse connection
+        tableid: Synapse id of the tracking table
+        changeset: Changeset from `get_changeset`
+        etag: Etag of the tracking table query the changeset is based on
+        batch_size: Maximum number of rows per table update
+
+    Returns:
+        str - Etag of the tracking table after the update
+    """
+    return write_rows(syn, tableid, _iter_changeset_rows(changeset),
+                      etag=etag, batch_size=batch_size)